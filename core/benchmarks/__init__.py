@@ -0,0 +1,3 @@
+"""
+Нагрузочные тесты бота без сети: запуск из каталога core командой python -m benchmarks.load_test
+"""
@@ -0,0 +1,295 @@
+"""
+Нагрузочный тест обработчиков пользователя
+
+Синтетические обновления проходят через настоящие Dispatcher и обработчики (register_handlers),
+а запросы к Telegram API перехватывает FakeSession - сеть не нужна.
+Каждый виртуальный пользователь выполняет сценарий: /start, /sign_up, запись на тренировку,
+/my_walks и с вероятностью --cancel-share отмену записи.
+
+Запросы к БД выполняются по-настоящему, поэтому нужен локальный Postgres из DBSettings
+(.env: DB_HOST, DB_NAME, ...) и локальный Redis для счетчиков мест и реестра пользователей (REDIS_DB_URL). SQLite не подходит: запросы используют ON CONFLICT по частичному
+индексу и изменяющие CTE. Таблицы создаются как при запуске бота, с --reset предварительно удаляются,
+поэтому лучше указывать отдельную БД.
+
+Пример: python -m benchmarks.load_test --users 2000 --concurrency 200 --reset
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import random
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Any, AsyncGenerator, Dict, List, Mapping, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import (TelegramMethod, SendMessage, EditMessageText, EditMessageReplyMarkup, SendPhoto,
+                             SendMediaGroup)
+from aiogram.methods.base import TelegramType
+from aiogram.types import Update, Message, Chat
+from sqlalchemy import event
+
+from loader import MainSettings
+from database.psql_engine import get_engine, dispose_engine
+from database.requests import StartServiceRequest, ServiceRequests, WorkoutsRequests, UserRequest
+from main import register_handlers
+from utils.middelwares import DbSessionMiddleware, CommitBeforeRequestMiddleware
+from utils.known_users import known_users
+
+FIRST_USER_ID = 10 ** 9  # не пересекается с id администраторов
+
+_current_step: ContextVar[Optional[str]] = ContextVar('load_test_step', default=None)
+
+
+class FakeSession(BaseSession):
+    """
+    Сессия бота, отвечающая на запросы вместо Telegram API
+
+    Отправленные сообщения возвращаются как Message, остальные методы - True.
+    Последняя клавиатура каждого чата сохраняется, чтобы сценарий мог нажимать на ее кнопки
+    """
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.last_markup: Dict[int, Any] = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[TelegramType], timeout: Optional[int] = None) -> TelegramType:
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if isinstance(method, (SendMessage, EditMessageText, EditMessageReplyMarkup)):
+            if method.reply_markup is not None:
+                self.last_markup[method.chat_id] = method.reply_markup
+            return self._message(method.chat_id, getattr(method, 'text', None))
+        if isinstance(method, SendPhoto):
+            return self._message(method.chat_id, None)
+        if isinstance(method, SendMediaGroup):
+            return [self._message(method.chat_id, None) for _ in method.media]
+        return True
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b''
+
+    async def close(self) -> None:
+        pass
+
+    def buttons(self, chat_id: int, prefix: str) -> List[str]:
+        """callback_data кнопок последней клавиатуры чата, начинающихся с prefix"""
+        markup = self.last_markup.get(chat_id)
+        if markup is None:
+            return []
+        return [button.callback_data for row in markup.inline_keyboard for button in row
+                if button.callback_data and button.callback_data.startswith(prefix)]
+
+    def _message(self, chat_id: int, text: Optional[str]) -> Message:
+        return Message(message_id=next(self._message_ids), date=datetime.now(),
+                       chat=Chat(id=chat_id, type='private'), text=text)
+
+
+class UpdateFactory:
+    """Построение синтетических обновлений от пользователя"""
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> Update:
+        return self._build({'message': self._message_data(user_id, text)})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return self._build({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self._user_data(user_id),
+            'chat_instance': str(user_id),
+            'message': self._message_data(user_id, '...'),
+            'data': data,
+        }})
+
+    def _build(self, payload: Mapping[str, Any]) -> Update:
+        return Update.model_validate({'update_id': next(self._update_ids), **payload}, context={'bot': self.bot})
+
+    def _message_data(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(datetime.now().timestamp()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user_data(user_id),
+            'text': text,
+        }
+
+    @staticmethod
+    def _user_data(user_id: int) -> Dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+
+class SqlCounter:
+    """Подсчет SQL-запросов, выполненных через двигатель, в разрезе шагов сценария"""
+    def __init__(self):
+        self.count = 0
+        self.by_step: Dict[Optional[str], int] = defaultdict(int)
+
+    def attach(self) -> None:
+        event.listen(get_engine().sync_engine, 'before_cursor_execute', self._on_execute)
+
+    def detach(self) -> None:
+        event.remove(get_engine().sync_engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args) -> None:
+        self.count += 1
+        self.by_step[_current_step.get()] += 1
+
+
+class LoadTest:
+    """
+    Прогон сценариев пользователей через Dispatcher
+
+    Для каждого шага сценария собираются задержки обработки обновления и число SQL-запросов
+    """
+    def __init__(self, dp: Dispatcher, bot: Bot, session: FakeSession, cancel_share: float):
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.cancel_share = cancel_share
+        self.updates = UpdateFactory(bot)
+        self.sql = SqlCounter()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def run(self, users: int, concurrency: int) -> float:
+        """
+        Запускает users сценариев, не более concurrency одновременно
+
+        :return: длительность прогона в секундах
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_user(user_id: int):
+            async with semaphore:
+                await self.user_scenario(user_id)
+
+        self.sql.attach()
+        started = perf_counter()
+        try:
+            # Обработчики печатают в stdout - не смешиваем это с отчетом
+            with contextlib.redirect_stdout(io.StringIO()):
+                await asyncio.gather(*(run_user(FIRST_USER_ID + i) for i in range(users)))
+        finally:
+            self.sql.detach()
+        return perf_counter() - started
+
+    async def user_scenario(self, user_id: int) -> None:
+        """Сценарий одного пользователя"""
+        await self.step('/start', self.updates.message(user_id, '/start'))
+        await self.step('/sign_up', self.updates.message(user_id, '/sign_up'))
+
+        workouts = self.session.buttons(user_id, 'signup_')
+        if workouts:
+            await self.step('signup_', self.updates.callback(user_id, random.choice(workouts)))
+
+        await self.step('/my_walks', self.updates.message(user_id, '/my_walks'))
+
+        registrations = self.session.buttons(user_id, 'giveup_')
+        if registrations and random.random() < self.cancel_share:
+            registration = registrations[0].split('_')[1]
+            await self.step('giveup_', self.updates.callback(user_id, f'giveup_{registration}'))
+            await self.step('delMy_', self.updates.callback(user_id, f'delMy_{registration}'))
+
+    async def step(self, name: str, update: Update) -> None:
+        """Обработка одного обновления с замером времени"""
+        token = _current_step.set(name)
+        started = perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.errors[name] += 1
+        finally:
+            self.latencies[name].append(perf_counter() - started)
+            _current_step.reset(token)
+
+    def report(self, duration: float) -> str:
+        """Таблица с перцентилями задержки, пропускной способностью и числом SQL-запросов"""
+        lines = [f'{"шаг":<10} {"кол-во":>7} {"p50 мс":>8} {"p95 мс":>8} {"p99 мс":>8} {"SQL/шаг":>8} {"ошибки":>7}']
+        all_latencies = []
+        for name, latencies in self.latencies.items():
+            all_latencies.extend(latencies)
+            lines.append(f'{name:<10} {len(latencies):>7} {percentile(latencies, 0.5):>8.1f} '
+                         f'{percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f} '
+                         f'{self.sql.by_step[name] / len(latencies):>8.2f} {self.errors[name]:>7}')
+
+        lines.append(f'{"всего":<10} {len(all_latencies):>7} {percentile(all_latencies, 0.5):>8.1f} '
+                     f'{percentile(all_latencies, 0.95):>8.1f} {percentile(all_latencies, 0.99):>8.1f} '
+                     f'{self.sql.count / max(len(all_latencies), 1):>8.2f} {sum(self.errors.values()):>7}')
+        lines.append('')
+        lines.append(f'Длительность: {duration:.2f} с, обновлений в секунду: {len(all_latencies) / duration:.0f}, '
+                     f'SQL-запросов: {self.sql.count}')
+        lines.append('Запросы к API: ' + ', '.join(f'{name}={count}' for name, count in sorted(self.session.calls.items())))
+        return '\n'.join(lines)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль p в миллисекундах"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+async def prepare_database(workouts: int, reset: bool) -> None:
+    """
+    Подготовка БД: таблицы и справочники как при запуске бота и workouts будущих тренировок
+
+    :param workouts: количество создаваемых тренировок
+    :param reset: удалить таблицы перед созданием
+    """
+    if reset:
+        await ServiceRequests.drop_all_base()
+    await StartServiceRequest.create_and_fill_db()
+    await known_users.warm_up(UserRequest.get_user_names)
+
+    start = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    for i in range(workouts):
+        await WorkoutsRequests.create_workout(start + timedelta(days=i), i % 4 + 1, MainSettings.ADMIN_LIST[0])
+
+
+async def main(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    await prepare_database(args.workouts, args.reset)
+
+    session = FakeSession(latency=args.api_latency / 1000)
+    session.middleware(CommitBeforeRequestMiddleware())
+    bot = Bot(token='42:BENCHMARK', session=session)
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.update.middleware.register(DbSessionMiddleware())
+    register_handlers(dp)
+
+    load_test = LoadTest(dp, bot, session, args.cancel_share)
+    try:
+        duration = await load_test.run(args.users, args.concurrency)
+        print(load_test.report(duration))
+    finally:
+        await dispose_engine()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='количество виртуальных пользователей')
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременно выполняемых сценариев')
+    parser.add_argument('--workouts', type=int, default=10, help='количество создаваемых тренировок')
+    parser.add_argument('--cancel-share', type=float, default=0.3, help='доля пользователей, отменяющих запись')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа Telegram API, мс')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reset', action='store_true', help='удалить таблицы БД перед прогоном')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
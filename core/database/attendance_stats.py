@@ -0,0 +1,127 @@
+"""
+Модуль сводной статистики посещаемости (таблица attendance_stats)
+
+Отчеты читают только сводную таблицу, поэтому их стоимость не зависит от объема истории записей.
+Запросы, меняющие статус записей, добавляют к себе CTE record_changes - статистика обновляется
+тем же запросом. Серии посещений при этом считаются в порядке отметок, а не дат тренировок,
+поэтому периодически вся таблица пересчитывается по registrations и архиву attendance_history (REBUILD_STATEMENTS)
+"""
+from sqlalchemy import CTE, case, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database.data_models import AttendanceStats, Workout
+
+VISITED_STATUS = 2  # посетил
+CANCELLED_STATUS = 4  # отменил
+MISSED_STATUS = 5  # не посетил
+
+REGISTRATIONS_SOURCE = """
+    SELECT r.user_id, r.status_id, w.workout_id, w.type_id, w.date
+    FROM registrations r
+    JOIN workouts w ON w.workout_id = r.workout_id"""
+
+# Текущие записи и архив прошедших тренировок
+ALL_REGISTRATIONS_SOURCE = REGISTRATIONS_SOURCE + """
+    UNION ALL
+    SELECT h.user_id, h.status_id, w.workout_id, w.type_id, w.date
+    FROM attendance_history h
+    JOIN workouts_history w ON w.workout_id = h.workout_id"""
+
+# Полный пересчет: статистика по всем записям со статусами "Посетил", "Отменил" и "Не посетил".
+# Выход из листа ожидания хранится отдельным статусом и отменой не считается.
+# Серии посещений - группы подряд идущих посещений (разность номеров строк), текущая серия
+# заканчивается на последней отмеченной тренировке
+FILL_TEMPLATE = f"""
+INSERT INTO attendance_stats (user_id, type_id, visits, no_shows, cancellations,
+                              current_streak, best_streak, last_workout_date, updated_at)
+WITH r AS ({{source}}
+),
+marks AS (
+    SELECT r.user_id, r.type_id, r.date, r.status_id,
+           row_number() OVER (PARTITION BY r.user_id, r.type_id ORDER BY r.date, r.workout_id)
+           - row_number() OVER (PARTITION BY r.user_id, r.type_id, r.status_id ORDER BY r.date, r.workout_id) AS grp
+    FROM r
+    WHERE r.status_id IN ({VISITED_STATUS}, {MISSED_STATUS})
+),
+streaks AS (
+    SELECT user_id, type_id, count(*) AS length, max(date) AS ended_at
+    FROM marks
+    WHERE status_id = {VISITED_STATUS}
+    GROUP BY user_id, type_id, grp
+),
+totals AS (
+    SELECT r.user_id, r.type_id,
+           count(*) FILTER (WHERE r.status_id = {VISITED_STATUS}) AS visits,
+           count(*) FILTER (WHERE r.status_id = {MISSED_STATUS}) AS no_shows,
+           count(*) FILTER (WHERE r.status_id = {CANCELLED_STATUS}) AS cancellations,
+           max(r.date) FILTER (WHERE r.status_id IN ({VISITED_STATUS}, {MISSED_STATUS})) AS last_workout_date
+    FROM r
+    WHERE r.status_id IN ({VISITED_STATUS}, {CANCELLED_STATUS}, {MISSED_STATUS})
+    GROUP BY r.user_id, r.type_id
+)
+SELECT t.user_id, t.type_id, t.visits, t.no_shows, t.cancellations,
+       coalesce((SELECT max(s.length) FROM streaks s
+                 WHERE s.user_id = t.user_id AND s.type_id = t.type_id AND s.ended_at = t.last_workout_date), 0),
+       coalesce((SELECT max(s.length) FROM streaks s WHERE s.user_id = t.user_id AND s.type_id = t.type_id), 0),
+       t.last_workout_date, now()
+FROM totals t
+"""
+
+FILL_SQL = FILL_TEMPLATE.format(source=ALL_REGISTRATIONS_SOURCE)
+# Первое заполнение (миграция 6) выполняется до появления архива
+INITIAL_FILL_SQL = FILL_TEMPLATE.format(source=REGISTRATIONS_SOURCE)
+
+# Пересчет выполняется в одной транзакции. EXCLUSIVE-блокировка ждет завершения транзакций, уже
+# обновивших статистику, и задерживает новые до фиксации пересчета, поэтому приращения не теряются
+# и не учитываются дважды
+REBUILD_STATEMENTS = (
+    'LOCK TABLE attendance_stats IN EXCLUSIVE MODE',
+    'DELETE FROM attendance_stats',
+    FILL_SQL,
+)
+
+
+def record_changes(changed: CTE) -> CTE:
+    """
+    Приращение статистики по записям, получившим новый статус
+
+    Добавляется к запросу через Select.add_cte и выполняется в той же транзакции.
+    Отменами считаются только записи, получившие статус CANCELLED_STATUS: выход из листа ожидания
+    получает свой статус и в статистику не попадает
+    :param changed: CTE с колонками user_id, workout_id, status_id (UPDATE registrations ... RETURNING)
+    :return: CTE INSERT ... ON CONFLICT DO UPDATE в attendance_stats
+    """
+    visits = func.count().filter(changed.c.status_id == VISITED_STATUS)
+    no_shows = func.count().filter(changed.c.status_id == MISSED_STATUS)
+    deltas = (
+        select(changed.c.user_id,
+               Workout.type_id,
+               visits,
+               no_shows,
+               func.count().filter(changed.c.status_id == CANCELLED_STATUS),
+               visits,
+               visits,
+               func.max(Workout.date).filter(changed.c.status_id.in_((VISITED_STATUS, MISSED_STATUS))))
+        .join(Workout, Workout.workout_id == changed.c.workout_id)
+        .where(changed.c.status_id.in_((VISITED_STATUS, CANCELLED_STATUS, MISSED_STATUS)))
+        .group_by(changed.c.user_id, Workout.type_id)
+    )
+
+    statement = pg_insert(AttendanceStats).from_select(
+        ['user_id', 'type_id', 'visits', 'no_shows', 'cancellations', 'current_streak', 'best_streak',
+         'last_workout_date'],
+        deltas)
+    excluded = statement.excluded
+    current_streak = case((excluded.no_shows > 0, 0), else_=AttendanceStats.current_streak + excluded.visits)
+    statement = statement.on_conflict_do_update(
+        index_elements=[AttendanceStats.user_id, AttendanceStats.type_id],
+        set_={
+            'visits': AttendanceStats.visits + excluded.visits,
+            'no_shows': AttendanceStats.no_shows + excluded.no_shows,
+            'cancellations': AttendanceStats.cancellations + excluded.cancellations,
+            'current_streak': current_streak,
+            'best_streak': func.greatest(AttendanceStats.best_streak, current_streak),
+            'last_workout_date': func.greatest(AttendanceStats.last_workout_date, excluded.last_workout_date),
+            'updated_at': func.now(),
+        })
+    return statement.cte('attendance_stats_delta')
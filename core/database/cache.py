@@ -0,0 +1,98 @@
+"""
+Модуль кэширования часто запрашиваемых данных
+"""
+import asyncio
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from time import monotonic
+from typing import Awaitable, Callable, List, Optional
+
+from database.pagination import Page, PageCursor, make_page
+from loader import CacheSettings
+
+
+class UpcomingWorkoutsCache:
+    """
+    Кэш списка предстоящих тренировок
+
+    Хранит в памяти результат запроса Workout JOIN WorkoutType не дольше ttl секунд.
+    Список отсортирован по (date, workout_id), поэтому прошедшие тренировки отрезаются при чтении
+    без обращения к БД. Сбрасывается при создании и удалении тренировок.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._rows: Optional[List] = None
+        self._expires_at = 0.0
+        self._version = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, load: Callable[[], Awaitable[List]]) -> List:
+        """
+        Возвращает актуальный список тренировок
+
+        При устаревании кэша только один запрос уходит в БД, остальные ждут его результата
+        :param load: корутина-функция, выполняющая запрос к БД
+        :return: [Row[tuple[Workout, WorkoutType]]
+        """
+        if self._is_fresh():
+            return self._drop_past()
+
+        async with self._lock:
+            if self._is_fresh():
+                return self._drop_past()
+
+            version = self._version
+            rows = await load()
+            if version != self._version:
+                # Кэш сбросили во время запроса - результат мог устареть, не сохраняем его
+                return rows
+
+            self._rows = rows
+            self._expires_at = monotonic() + self.ttl
+            return self._drop_past()
+
+    async def page(self, load: Callable[[], Awaitable[List]], cursor: Optional[PageCursor],
+                   backward: bool, limit: int) -> Page:
+        """
+        Страница списка тренировок по ключу (date, workout_id), аналог database.pagination.fetch_page
+
+        :param load: корутина-функция, выполняющая запрос к БД
+        :param cursor: ключ, от которого строится страница; None - первая страница
+        :param backward: страница перед cursor
+        :param limit: размер страницы
+        """
+        rows = await self.get(load)
+        if cursor is None:
+            start, end = 0, limit
+        elif backward:
+            end = bisect_left(rows, cursor, key=self.row_key)
+            start = max(end - limit, 0)
+            if start == end:  # предыдущих тренировок уже нет - первая страница
+                start, end = 0, limit
+        else:
+            start = bisect_right(rows, cursor, key=self.row_key)
+            end = start + limit
+        return make_page(rows[start:end], self.row_key, has_prev=start > 0, has_next=end < len(rows))
+
+    @staticmethod
+    def row_key(row) -> PageCursor:
+        return PageCursor(row[0].date, row[0].workout_id)
+
+    def invalidate(self) -> None:
+        """Сброс кэша после изменения списка тренировок"""
+        self._version += 1
+        self._rows = None
+        self._expires_at = 0.0
+
+    def _is_fresh(self) -> bool:
+        return self._rows is not None and monotonic() < self._expires_at
+
+    def _drop_past(self) -> List:
+        """Отрезает тренировки, время начала которых уже прошло"""
+        first_actual = bisect_left(self._rows, datetime.now(), key=lambda row: row[0].date)
+        if first_actual:
+            self._rows = self._rows[first_actual:]
+        return self._rows
+
+
+upcoming_workouts_cache = UpcomingWorkoutsCache(CacheSettings.UPCOMING_WORKOUTS_TTL)
@@ -1,7 +1,8 @@
 """
 Модуль объявления таблиц базы данных
 """
-from sqlalchemy import Column, BigInteger, SmallInteger, String, ForeignKey, DateTime, func, Boolean
+from sqlalchemy import Column, BigInteger, SmallInteger, Integer, Float, String, ForeignKey, DateTime, Time, func, \
+    Boolean, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -48,14 +49,66 @@ class Workout(Base):
     Таблица тренировок
 
     workout_id - уникальный идентификатор тренировки
+    capacity - количество мест, NULL - без ограничения
+    template_id - шаблон, по которому создана тренировка, NULL - добавлена вручную
+    ix_workouts_date_workout - выборки тренировок по диапазону дат и постраничные выборки по (date, workout_id)
+    uq_workouts_template_date - по шаблону создается не более одной тренировки на дату
     """
     __tablename__ = 'workouts'
+    __table_args__ = (
+        Index('ix_workouts_date_workout', 'date', 'workout_id'),
+        Index('uq_workouts_template_date', 'template_id', 'date',
+              unique=True, postgresql_where=text('template_id IS NOT NULL')),
+    )
 
-    workout_id = Column(SmallInteger, primary_key=True)
+    workout_id = Column(BigInteger, primary_key=True)
     type_id = Column(SmallInteger, ForeignKey('workout_types.type_id'))
     date = Column(DateTime, nullable=False)
+    capacity = Column(SmallInteger, nullable=True)
     created_by = Column(BigInteger, ForeignKey('admins.admin_id'))
     created_at = Column(DateTime, default=func.now())
+    template_id = Column(Integer, ForeignKey('workout_templates.template_id', ondelete='SET NULL'), nullable=True)
+
+
+class WorkoutTemplate(Base):
+    """
+    Шаблон повторяющейся тренировки: тип, день недели и время
+
+    weekday - день недели ISO (1 - понедельник)
+    valid_until - окончание расписания, NULL - бессрочно
+    generated_until - до какого момента тренировки по шаблону уже созданы: удаленные администратором
+    тренировки повторно не создаются
+    """
+    __tablename__ = 'workout_templates'
+
+    template_id = Column(Integer, primary_key=True)
+    type_id = Column(SmallInteger, ForeignKey('workout_types.type_id'), nullable=False)
+    weekday = Column(SmallInteger, nullable=False)
+    start_time = Column(Time, nullable=False)
+    capacity = Column(SmallInteger, nullable=True)
+    valid_until = Column(DateTime, nullable=True)
+    generated_until = Column(DateTime, nullable=True)
+    active = Column(Boolean, nullable=False, default=True)
+    created_by = Column(BigInteger, ForeignKey('admins.admin_id'))
+    created_at = Column(DateTime, default=func.now())
+
+
+class WorkoutHistory(Base):
+    """
+    Архив прошедших тренировок
+
+    Тренировки старше ArchiveSettings.MONTHS переносятся сюда из workouts вместе с записями
+    (attendance_history) и сохраняют свой workout_id
+    """
+    __tablename__ = 'workouts_history'
+
+    workout_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    type_id = Column(SmallInteger, ForeignKey('workout_types.type_id'))
+    date = Column(DateTime, nullable=False)
+    capacity = Column(SmallInteger, nullable=True)
+    created_by = Column(BigInteger, ForeignKey('admins.admin_id'))
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
 
 
 class Status(Base):
@@ -70,22 +123,81 @@ class Registration(Base):
     """Таблица регистраций пользователей на тренировки
 
     registration_id - уникальнй идентификатор записи
-    в данной таблице будет проводиться проверка оплаты"""
+    в данной таблице будет проводиться проверка оплаты
+    uq_registrations_active_user_workout - не более одной активной записи или места в листе ожидания
+    пользователя на тренировку, он же используется для поиска записей пользователя
+    ix_registrations_workout_status - поиск записей на тренировку по статусу"""
     __tablename__ = 'registrations'
+    __table_args__ = (
+        Index('uq_registrations_active_user_workout', 'user_id', 'workout_id',
+              unique=True, postgresql_where=text('status_id IN (1, 6)')),
+        Index('ix_registrations_workout_status', 'workout_id', 'status_id'),
+    )
 
-    registration_id = Column(SmallInteger, primary_key=True, autoincrement=True)
+    registration_id = Column(BigInteger, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey('users.user_id'))
-    workout_id = Column(SmallInteger, ForeignKey('workouts.workout_id', ondelete='CASCADE'))
+    workout_id = Column(BigInteger, ForeignKey('workouts.workout_id', ondelete='CASCADE'))
     status_id = Column(SmallInteger, ForeignKey('statuses.status_id'), default=1)
     is_payed = Column(Boolean, nullable=True, default=None)
     registered_at = Column(DateTime, default=func.now())
 
 
 class AttendanceHistory(Base):
-    """Лишняя таблица, подлежит удалению"""
+    """
+    Архив записей на прошедшие тренировки
+
+    history_id - registration_id перенесенной записи, workout_id - тренировка из workouts_history
+    ix_attendance_history_workout - записи архивной тренировки
+    """
     __tablename__ = 'attendance_history'
+    __table_args__ = (
+        Index('ix_attendance_history_workout', 'workout_id'),
+    )
 
-    history_id = Column(SmallInteger, primary_key=True)
+    history_id = Column(BigInteger, primary_key=True)
     user_id = Column(BigInteger, ForeignKey('users.user_id'))
-    workout_id = Column(SmallInteger, ForeignKey('workouts.workout_id'))
-    attended_at = Column(DateTime, default=func.now())
+    workout_id = Column(BigInteger, ForeignKey('workouts_history.workout_id'))
+    status_id = Column(SmallInteger, ForeignKey('statuses.status_id'))
+    is_payed = Column(Boolean, nullable=True)
+    registered_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
+
+
+class AttendanceStats(Base):
+    """
+    Сводная статистика посещаемости пользователя по типу тренировок
+
+    Обновляется приращениями при отметке посещаемости и отмене записи (database/attendance_stats.py)
+    и периодически пересчитывается полностью по registrations и архиву attendance_history.
+    current_streak/best_streak - текущая и лучшая серии посещений подряд без пропусков
+    """
+    __tablename__ = 'attendance_stats'
+
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), primary_key=True)
+    type_id = Column(SmallInteger, ForeignKey('workout_types.type_id'), primary_key=True)
+    visits = Column(Integer, nullable=False, default=0)
+    no_shows = Column(Integer, nullable=False, default=0)
+    cancellations = Column(Integer, nullable=False, default=0)
+    current_streak = Column(Integer, nullable=False, default=0)
+    best_streak = Column(Integer, nullable=False, default=0)
+    last_workout_date = Column(DateTime)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class SchemaMigration(Base):
+    """Таблица примененных миграций схемы БД (database/migrations.py)"""
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String, nullable=False)
+    duration_ms = Column(Float)
+    applied_at = Column(DateTime, default=func.now())
+
+
+class ServiceState(Base):
+    """Служебные значения бота: отпечаток схемы и справочников для быстрого запуска и т.п."""
+    __tablename__ = 'service_state'
+
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
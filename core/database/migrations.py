@@ -0,0 +1,318 @@
+"""
+Модуль версионных миграций схемы БД
+
+Миграции применяются по возрастанию версии при запуске бота. Примененные версии хранятся
+в таблице schema_migrations, поэтому каждая миграция выполняется один раз. Несколько экземпляров
+бота не применяют миграции одновременно - на время создания таблиц и применения миграций
+берется advisory lock Postgres.
+
+Новые столбцы и индексы добавляются новой миграцией в конец MIGRATIONS, а в модели data_models
+объявляются так же, чтобы create_all создавал новую БД сразу в актуальном виде.
+Поэтому команды миграций должны быть идемпотентными: IF NOT EXISTS и т.п.
+
+Изменения больших таблиц выполняются без долгих блокировок: нетранзакционной миграцией с порциями
+Batched и CREATE INDEX CONCURRENTLY, а короткая транзакционная миграция только переключает схему
+"""
+import dataclasses
+import hashlib
+import logging
+from time import perf_counter
+from typing import Dict, List, Sequence, Tuple, Union
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from database.psql_engine import get_engine
+from database.data_models import Base, SchemaMigration
+from database.attendance_stats import INITIAL_FILL_SQL
+
+logger = logging.getLogger(__name__)
+
+# Ключ pg_advisory_lock, общий для всех экземпляров бота
+MIGRATIONS_LOCK_KEY = 7_310_014
+# Строк в одной порции Batched
+MIGRATION_BATCH_SIZE = 5000
+
+
+@dataclasses.dataclass(frozen=True)
+class Batched:
+    """
+    Команда, повторяемая, пока она изменяет строки
+
+    В нетранзакционной миграции каждая порция фиксируется отдельно, поэтому блокировки строк
+    удерживаются только на время одной порции
+    """
+    statement: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Migration:
+    """
+    Миграция схемы
+
+    version - порядковый номер, после применения не меняется
+    statements - SQL-команды, выполняемые по порядку
+    transactional - выполнять команды в одной транзакции. False нужен для команд,
+    которые нельзя выполнять в транзакции (CREATE INDEX CONCURRENTLY)
+    """
+    version: int
+    name: str
+    statements: Tuple[Union[str, Batched], ...]
+    transactional: bool = True
+
+
+# Ключи, расширяемые с SMALLINT до BIGINT: таблица - (первичный ключ, внешние ключи на workouts)
+WIDENED_KEYS: Dict[str, Tuple[str, ...]] = {
+    'workouts': ('workout_id',),
+    'registrations': ('registration_id', 'workout_id'),
+    'attendance_history': ('history_id', 'workout_id'),
+}
+# Вторичные индексы по расширяемым столбцам: имя - определение для нового столбца
+WIDENED_INDEXES: Dict[str, str] = {
+    'ix_workouts_date_workout': 'ON workouts (date, workout_id_new)',
+    'ix_registrations_workout_status': 'ON registrations (workout_id_new, status_id)',
+    'uq_registrations_active_user_workout': 'ON registrations (user_id, workout_id_new) WHERE status_id = 1',
+}
+
+
+def widen_keys_prepare() -> Tuple[Union[str, Batched], ...]:
+    """
+    Подготовка расширения ключей без долгих блокировок
+
+    Рядом с каждым ключом создается столбец <ключ>_new BIGINT, триггер копирует в него значения
+    новых и измененных строк, существующие строки заполняются порциями. Индексы по новым столбцам
+    строятся CONCURRENTLY, NOT NULL первичного ключа подтверждается CHECK-ограничением,
+    чтобы SET NOT NULL при переключении не сканировал таблицу
+    """
+    statements = []
+    for table, columns in WIDENED_KEYS.items():
+        key = columns[0]
+        assignments = ' '.join(f'NEW.{column}_new := NEW.{column};' for column in columns)
+        statements.extend(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}_new BIGINT' for column in columns)
+        statements.extend((
+            f'CREATE OR REPLACE FUNCTION {table}_widen_keys() RETURNS trigger AS $$ '
+            f'BEGIN {assignments} RETURN NEW; END $$ LANGUAGE plpgsql',
+            f'DROP TRIGGER IF EXISTS {table}_widen_keys ON {table}',
+            f'CREATE TRIGGER {table}_widen_keys BEFORE INSERT OR UPDATE ON {table} '
+            f'FOR EACH ROW EXECUTE FUNCTION {table}_widen_keys()',
+            Batched(f'UPDATE {table} SET {key}_new = {key} WHERE {key} IN ('
+                    f'SELECT {key} FROM {table} WHERE {key}_new IS NULL LIMIT {MIGRATION_BATCH_SIZE})'),
+            f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{key}_new_not_null',
+            f'ALTER TABLE {table} ADD CONSTRAINT {table}_{key}_new_not_null CHECK ({key}_new IS NOT NULL) NOT VALID',
+            f'ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{key}_new_not_null',
+            # Индекс, недостроенный прерванной попыткой, пересоздается
+            f'DROP INDEX CONCURRENTLY IF EXISTS {table}_pkey_new',
+            f'CREATE UNIQUE INDEX CONCURRENTLY {table}_pkey_new ON {table} ({key}_new)',
+        ))
+    for name, definition in WIDENED_INDEXES.items():
+        unique = 'UNIQUE ' if name.startswith('uq_') else ''
+        statements.extend((
+            f'DROP INDEX CONCURRENTLY IF EXISTS {name}_new',
+            f'CREATE {unique}INDEX CONCURRENTLY {name}_new {definition}',
+        ))
+    return tuple(statements)
+
+
+def widen_keys_switch() -> Tuple[str, ...]:
+    """
+    Переключение на расширенные столбцы в одной короткой транзакции
+
+    Старые столбцы удаляются вместе со своими индексами, новые переименовываются, первичные ключи
+    создаются по готовым индексам. Внешний ключ registrations -> workouts создается NOT VALID
+    и проверяется следующей миграцией без эксклюзивной блокировки
+    """
+    statements = [f'LOCK TABLE {", ".join(WIDENED_KEYS)} IN ACCESS EXCLUSIVE MODE']
+    for table in WIDENED_KEYS:
+        statements.extend((
+            f'DROP TRIGGER IF EXISTS {table}_widen_keys ON {table}',
+            f'DROP FUNCTION IF EXISTS {table}_widen_keys()',
+        ))
+    statements.extend((
+        'ALTER TABLE registrations DROP CONSTRAINT IF EXISTS registrations_workout_id_fkey',
+        'ALTER TABLE attendance_history DROP CONSTRAINT IF EXISTS attendance_history_workout_id_fkey',
+    ))
+    for table, columns in WIDENED_KEYS.items():
+        key = columns[0]
+        statements.extend((
+            f'ALTER TABLE {table} ALTER COLUMN {key}_new SET NOT NULL',
+            f'ALTER TABLE {table} DROP CONSTRAINT {table}_{key}_new_not_null',
+            f'ALTER SEQUENCE IF EXISTS {table}_{key}_seq OWNED BY NONE',
+        ))
+        for column in columns:
+            statements.extend((
+                f'ALTER TABLE {table} DROP COLUMN {column}',
+                f'ALTER TABLE {table} RENAME COLUMN {column}_new TO {column}',
+            ))
+        statements.append(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY USING INDEX {table}_pkey_new')
+    for table in ('workouts', 'registrations'):
+        key = WIDENED_KEYS[table][0]
+        statements.extend((
+            f'ALTER SEQUENCE {table}_{key}_seq AS BIGINT OWNED BY {table}.{key}',
+            f"ALTER TABLE {table} ALTER COLUMN {key} SET DEFAULT nextval('{table}_{key}_seq')",
+        ))
+    # history_id архива берется из registration_id, своя последовательность не нужна
+    statements.append('DROP SEQUENCE IF EXISTS attendance_history_history_id_seq')
+    statements.extend(f'ALTER INDEX {name}_new RENAME TO {name}' for name in WIDENED_INDEXES)
+    statements.append('ALTER TABLE registrations ADD CONSTRAINT registrations_workout_id_fkey '
+                      'FOREIGN KEY (workout_id) REFERENCES workouts (workout_id) ON DELETE CASCADE NOT VALID')
+    return tuple(statements)
+
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(1, 'registrations_unique_active', (
+        # Повторные активные записи переводятся в статус "Отменил", иначе уникальный индекс не создать
+        "UPDATE registrations SET status_id = 4 "
+        "WHERE status_id = 1 AND registration_id NOT IN ("
+        "SELECT min(registration_id) FROM registrations WHERE status_id = 1 GROUP BY user_id, workout_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_registrations_active_user_workout "
+        "ON registrations (user_id, workout_id) WHERE status_id = 1",
+    )),
+    Migration(2, 'registrations_workout_status_index', (
+        "CREATE INDEX IF NOT EXISTS ix_registrations_workout_status ON registrations (workout_id, status_id)",
+        "ANALYZE registrations",
+    )),
+    Migration(3, 'workouts_date_index', (
+        "CREATE INDEX IF NOT EXISTS ix_workouts_date ON workouts (date)",
+        "ANALYZE workouts",
+    )),
+    Migration(4, 'workouts_capacity', (
+        "ALTER TABLE workouts ADD COLUMN IF NOT EXISTS capacity SMALLINT",
+    )),
+    Migration(5, 'workouts_date_workout_index', (
+        # Постраничные выборки по (date, workout_id) заменяют индекс по одной дате
+        "CREATE INDEX IF NOT EXISTS ix_workouts_date_workout ON workouts (date, workout_id)",
+        "DROP INDEX IF EXISTS ix_workouts_date",
+        "ANALYZE workouts",
+    )),
+    Migration(6, 'attendance_stats_fill', (
+        # Таблицу создает create_all, миграция заполняет ее по уже накопленной истории записей
+        INITIAL_FILL_SQL,
+    )),
+    # Расширение workout_id, registration_id и history_id до BIGINT
+    Migration(7, 'widen_keys_prepare', widen_keys_prepare(), transactional=False),
+    Migration(8, 'widen_keys_switch', widen_keys_switch()),
+    Migration(9, 'widen_keys_validate', (
+        'ALTER TABLE registrations VALIDATE CONSTRAINT registrations_workout_id_fkey',
+        'ANALYZE workouts',
+        'ANALYZE registrations',
+    )),
+    Migration(10, 'attendance_history_archive', (
+        # Прежняя attendance_history не использовалась: таблица становится архивом записей,
+        # ее строки без архивной тренировки удаляются. Таблицу workouts_history создает create_all
+        'ALTER TABLE attendance_history ADD COLUMN IF NOT EXISTS status_id SMALLINT REFERENCES statuses (status_id)',
+        'ALTER TABLE attendance_history ADD COLUMN IF NOT EXISTS is_payed BOOLEAN',
+        'ALTER TABLE attendance_history ADD COLUMN IF NOT EXISTS registered_at TIMESTAMP WITHOUT TIME ZONE',
+        'ALTER TABLE attendance_history ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITHOUT TIME ZONE',
+        'ALTER TABLE attendance_history DROP COLUMN IF EXISTS attended_at',
+        'DELETE FROM attendance_history h '
+        'WHERE NOT EXISTS (SELECT 1 FROM workouts_history w WHERE w.workout_id = h.workout_id)',
+        'ALTER TABLE attendance_history ADD CONSTRAINT attendance_history_workout_id_fkey '
+        'FOREIGN KEY (workout_id) REFERENCES workouts_history (workout_id)',
+        'CREATE INDEX IF NOT EXISTS ix_attendance_history_workout ON attendance_history (workout_id)',
+    )),
+    Migration(11, 'workout_templates', (
+        # Таблицу workout_templates создает create_all
+        'ALTER TABLE workouts ADD COLUMN IF NOT EXISTS template_id INTEGER '
+        'REFERENCES workout_templates (template_id) ON DELETE SET NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_workouts_template_date ON workouts (template_id, date) '
+        'WHERE template_id IS NOT NULL',
+    )),
+    Migration(12, 'registrations_unique_active_or_waiting', (
+        # Лист ожидания (статус 6): индекс пересоздается без блокировки записи в registrations
+        "INSERT INTO statuses (status_id, status_name) VALUES (6, 'В листе ожидания') ON CONFLICT DO NOTHING",
+        'DROP INDEX CONCURRENTLY IF EXISTS uq_registrations_active_user_workout_new',
+        'CREATE UNIQUE INDEX CONCURRENTLY uq_registrations_active_user_workout_new '
+        'ON registrations (user_id, workout_id) WHERE status_id IN (1, 6)',
+        'DROP INDEX CONCURRENTLY IF EXISTS uq_registrations_active_user_workout',
+        'ALTER INDEX uq_registrations_active_user_workout_new RENAME TO uq_registrations_active_user_workout',
+    ), transactional=False),
+    Migration(13, 'status_waitlist_left', (
+        # Выход из листа ожидания не считается отменой записи в статистике посещаемости
+        "INSERT INTO statuses (status_id, status_name) VALUES (7, 'Вышел из листа ожидания') ON CONFLICT DO NOTHING",
+    )),
+)
+
+
+async def apply_migrations(migrations: Sequence[Migration] = MIGRATIONS) -> List[Tuple[int, str, float]]:
+    """
+    Создание недостающих таблиц по моделям и применение еще не примененных миграций
+
+    Блокировка удерживается отдельным соединением, каждая миграция выполняется в своем
+    соединении и фиксируется вместе с записью в schema_migrations
+    :param migrations:
+    :return: [(version, name, duration_ms)] примененных миграций
+    """
+    engine = get_engine()
+    applied_now = []
+
+    async with engine.connect() as lock_conn:
+        await lock_conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATIONS_LOCK_KEY})
+        await lock_conn.commit()
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                applied = set((await conn.execute(select(SchemaMigration.version))).scalars())
+
+            for migration in sorted(migrations, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+                duration_ms = await _apply_migration(migration)
+                applied_now.append((migration.version, migration.name, duration_ms))
+                logger.info('Миграция %s %s применена за %.1f мс', migration.version, migration.name, duration_ms)
+        finally:
+            await lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATIONS_LOCK_KEY})
+            await lock_conn.commit()
+
+    return applied_now
+
+
+def schema_fingerprint() -> str:
+    """
+    Отпечаток схемы: DDL таблиц и индексов моделей и список миграций
+
+    Меняется при любом изменении моделей или MIGRATIONS
+    """
+    dialect = postgresql.dialect()
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(str(CreateTable(table).compile(dialect=dialect)))
+        parts.extend(str(CreateIndex(index).compile(dialect=dialect))
+                     for index in sorted(table.indexes, key=lambda index: index.name))
+    parts.extend(repr(migration) for migration in MIGRATIONS)
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+async def _apply_migration(migration: Migration) -> float:
+    """Выполнение команд миграции и запись о ней в schema_migrations, возвращает время в мс"""
+    engine = get_engine()
+    started = perf_counter()
+
+    if migration.transactional:
+        async with engine.begin() as conn:
+            await _execute_statements(conn, migration.statements)
+            duration_ms = (perf_counter() - started) * 1000
+            await _mark_applied(conn, migration, duration_ms)
+        return duration_ms
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await _execute_statements(conn, migration.statements)
+        duration_ms = (perf_counter() - started) * 1000
+        await _mark_applied(conn, migration, duration_ms)
+    return duration_ms
+
+
+async def _execute_statements(conn: AsyncConnection, statements: Sequence[Union[str, Batched]]) -> None:
+    for statement in statements:
+        if isinstance(statement, Batched):
+            while (await conn.execute(text(statement.statement))).rowcount:
+                pass
+        else:
+            await conn.execute(text(statement))
+
+
+async def _mark_applied(conn: AsyncConnection, migration: Migration, duration_ms: float) -> None:
+    await conn.execute(SchemaMigration.__table__.insert().values(
+        version=migration.version, name=migration.name, duration_ms=duration_ms))
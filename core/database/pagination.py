@@ -0,0 +1,78 @@
+"""
+Модуль постраничных выборок тренировок
+
+Страницы строятся по ключу (date, workout_id): следующая страница начинается после последней строки
+текущей, предыдущая - заканчивается перед первой. Запрашивается на одну строку больше размера
+страницы, чтобы узнать, есть ли строки дальше
+"""
+from datetime import datetime
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from sqlalchemy import Select, tuple_, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class PageCursor(NamedTuple):
+    """Ключ строки, от которой отсчитывается страница"""
+    date: datetime
+    workout_id: int
+
+
+class Page(NamedTuple):
+    """
+    Страница выборки
+
+    prev_cursor/next_cursor - ключи для перехода на соседние страницы, None - страницы нет
+    """
+    rows: List[Any]
+    prev_cursor: Optional[PageCursor]
+    next_cursor: Optional[PageCursor]
+
+
+RowKey = Callable[[Any], PageCursor]
+
+
+async def fetch_page(session: AsyncSession, query: Select, date_column, id_column, key: RowKey,
+                     cursor: Optional[PageCursor], backward: bool, limit: int) -> Page:
+    """
+    Выполнение запроса query постранично
+
+    Если предыдущей страницы уже нет (строки удалены), возвращается первая страница
+    :param session:
+    :param query: запрос без сортировки и LIMIT
+    :param date_column: столбец даты ключа
+    :param id_column: столбец id тренировки ключа
+    :param key: получение ключа из строки результата
+    :param cursor: ключ, от которого строится страница; None - первая страница
+    :param backward: страница перед cursor
+    :param limit: размер страницы
+    """
+    page_query = query
+    if cursor is not None:
+        row_key = tuple_(date_column, id_column)
+        cursor_key = tuple_(literal(cursor.date), literal(cursor.workout_id))
+        page_query = page_query.where(row_key < cursor_key if backward else row_key > cursor_key)
+    if backward:
+        page_query = page_query.order_by(date_column.desc(), id_column.desc())
+    else:
+        page_query = page_query.order_by(date_column, id_column)
+
+    rows = list((await session.execute(page_query.limit(limit + 1))).all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if backward:
+        if not rows:
+            return await fetch_page(session, query, date_column, id_column, key, None, False, limit)
+        rows.reverse()
+        return make_page(rows, key, has_prev=has_more, has_next=True)
+    return make_page(rows, key, has_prev=cursor is not None, has_next=has_more)
+
+
+def make_page(rows: List[Any], key: RowKey, has_prev: bool, has_next: bool) -> Page:
+    """Страница с ключами перехода по первой и последней строке"""
+    if not rows:
+        return Page(rows, None, None)
+    return Page(rows,
+                key(rows[0]) if has_prev else None,
+                key(rows[-1]) if has_next else None)
@@ -1,21 +1,148 @@
 """
-Модуль определения подключения к БД Postre
+Модуль определения подключения к БД Postgres
+
+Двигатель создается лениво при первом обращении, параметры подключения и пула берутся из DBSettings
 """
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-import docker
+import asyncio
+import inspect
+from contextlib import asynccontextmanager
+from functools import cache
+from typing import Any, AsyncIterator, Callable, Optional
+
+from sqlalchemy import URL, event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session
 
 from loader import DBSettings
+from utils.metrics import TimedQueuePool, instrument_engine
+
+
+def resolve_db_host() -> str:
+    """
+    Адрес сервера БД
+
+    Если DB_HOST не задан, IP определяется по контейнеру DB_CONTAINER через Docker SDK
+    """
+    if DBSettings.DB_HOST:
+        return DBSettings.DB_HOST
+
+    import docker  # Docker SDK нужен только при запуске без DB_HOST
+
+    container = docker.from_env().containers.get(DBSettings.DB_CONTAINER)
+    return container.attrs['NetworkSettings']['IPAddress']
+
+
+def get_database_url() -> URL:
+    """Строка подключения к БД"""
+    return URL.create(
+        'postgresql+asyncpg',
+        username=DBSettings.POSTGRES_USER,
+        password=DBSettings.POSTGRES_PASSWORD,
+        host=resolve_db_host(),
+        port=DBSettings.DB_PORT,
+        database=DBSettings.DB_NAME,
+        query={'prepared_statement_cache_size': str(DBSettings.STATEMENT_CACHE_SIZE)},
+    )
+
+
+@cache
+def get_engine() -> AsyncEngine:
+    """Создание двигателя для работы с БД при первом обращении
+
+    Время запросов и ожидания соединений пула учитывается в метриках utils.metrics
+    """
+    engine = create_async_engine(
+        get_database_url(),
+        echo=DBSettings.ECHO,
+        pool_size=DBSettings.POOL_SIZE,
+        max_overflow=DBSettings.MAX_OVERFLOW,
+        pool_timeout=DBSettings.POOL_TIMEOUT,
+        pool_pre_ping=DBSettings.POOL_PRE_PING,
+        connect_args={'statement_cache_size': DBSettings.STATEMENT_CACHE_SIZE},
+        poolclass=TimedQueuePool,
+    )
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+@cache
+def get_session_maker() -> async_sessionmaker[AsyncSession]:
+    """Фабрика сессий, привязанная к двигателю"""
+    return async_sessionmaker(get_engine(), expire_on_commit=False, class_=AsyncSession)
+
+
+def async_session() -> AsyncSession:
+    """Новая сессия для работы с БД: async with async_session() as session"""
+    return get_session_maker()()
+
+
+@asynccontextmanager
+async def session_scope(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """
+    Сессия для метода *Requests: async with session_scope(session) as session
+
+    Переданная сессия (сессия обновления из DbSessionMiddleware) используется как есть, транзакцию
+    фиксирует ее владелец. Без нее открывается своя сессия, транзакция фиксируется при выходе из блока,
+    после чего выполняются действия after_commit
+    """
+    if session is not None:
+        yield session
+        return
+
+    async with async_session() as own_session:
+        async with own_session.begin():
+            yield own_session
+        await run_after_commit(own_session)
+
+
+def after_commit(session: AsyncSession, callback: Callable[[], Any]) -> None:
+    """
+    Действие, выполняемое после фиксации текущей транзакции сессии (сброс кэшей, счетчиков в Redis)
+
+    При откате транзакции действие отменяется. callback может быть обычной функцией или корутиной-функцией
+    """
+    session.info.setdefault('after_commit_pending', []).append(callback)
+
+
+async def run_after_commit(session: AsyncSession) -> None:
+    """Выполнение действий after_commit зафиксированных транзакций сессии"""
+    for callback in session.info.pop('after_commit_done', []):
+        result = callback()
+        if inspect.isawaitable(result):
+            await result
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session: Session) -> None:
+    session.info.setdefault('after_commit_done', []).extend(session.info.pop('after_commit_pending', []))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session: Session) -> None:
+    session.info.pop('after_commit_pending', None)
+
+
+async def warm_up_pool(connections: int = DBSettings.WARM_UP_CONNECTIONS) -> None:
+    """
+    Открывает заранее connections соединений пула, чтобы первые запросы не ждали подключения
 
-client_ = docker.from_env()
+    Количество ограничено размером пула - соединения сверх него закрываются сразу после возврата
+    :param connections:
+    """
+    connections = min(connections, DBSettings.POOL_SIZE)
+    if connections <= 0:
+        return
 
-container = client_.containers.get('north_walk_db')
-container_ip = container.attrs['NetworkSettings']['IPAddress']
-print(container_ip)
+    engine = get_engine()
 
+    async def open_connection():
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
 
-# Создание двигателя и сессии для работы с БД
-DATABASE_URL = f'postgresql+asyncpg://{DBSettings.POSTGRES_USER}:{DBSettings.POSTGRES_PASSWORD}@{container_ip}:5432/{DBSettings.DB_NAME}'
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
 
-engine = create_async_engine(DATABASE_URL, echo=True)
 
-async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+async def dispose_engine() -> None:
+    """Закрытие соединений пула, если двигатель был создан"""
+    if get_engine.cache_info().currsize:
+        await get_engine().dispose()
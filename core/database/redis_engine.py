@@ -0,0 +1,20 @@
+"""
+Модуль определения подключения к Redis для кэшей и служебных данных бота
+"""
+from functools import cache
+
+from redis.asyncio import Redis
+
+from loader import RedisSettings
+
+
+@cache
+def get_redis() -> Redis:
+    """Клиент Redis, создается при первом обращении"""
+    return Redis.from_url(RedisSettings.REDIS_HOST, decode_responses=True)
+
+
+async def close_redis() -> None:
+    """Закрытие соединений с Redis, если клиент был создан"""
+    if get_redis.cache_info().currsize:
+        await get_redis().aclose()
@@ -2,88 +2,179 @@
 Модуль определения запросов к БД
 Запросы преимущественно пишутся под конкретную задачу и используются только для нее
 Запросы реализованы через методы классов и разделены по месту|таблице применения
+
+Методы UserRequest, WorkoutsRequests и RegistrationRequests принимают необязательную session - сессию
+обновления из DbSessionMiddleware. Тогда запросы одного обновления выполняются в одной транзакции,
+которую фиксирует middleware. Без session метод открывает свою сессию и сам фиксирует транзакцию
 """
 import asyncio
+import hashlib
+import logging
 from datetime import datetime, timedelta
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
 
-from sqlalchemy import text, func, update, inspect, Table, Column
+from sqlalchemy import text, func, update, delete, and_, or_, not_, exists, literal, BigInteger, case, Row, \
+    union_all, true
 from sqlalchemy.future import select
-from sqlalchemy.exc import IntegrityError
-
-from database.psql_engine import async_session, engine
-from database.data_models import Base, WorkoutType, Status, User, Workout, Admin, Registration
-from utils.workouts_types import workout_types
-from loader import MainSettings
-
-
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.orm import aliased
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.psql_engine import async_session, get_engine, session_scope, after_commit
+from database.cache import upcoming_workouts_cache
+from database.migrations import apply_migrations, schema_fingerprint
+from database.pagination import Page, PageCursor, fetch_page
+from database.attendance_stats import record_changes, REBUILD_STATEMENTS
+from database.data_models import Base, WorkoutType, Status, User, Workout, Admin, Registration, ServiceState, \
+    AttendanceStats, WorkoutHistory, AttendanceHistory, WorkoutTemplate
+from utils.workouts_types import workout_types, statuses
+from utils.metrics import tag_queries
+from utils.seats import seat_counter
+from utils.keyboard_cache import sign_up_keyboard_cache
+from loader import MainSettings, CapacitySettings, KeyboardSettings
+
+logger = logging.getLogger(__name__)
+
+# Класс ключей pg_advisory_xact_lock для записи на тренировки с ограниченным числом мест
+SEATS_LOCK_CLASS = 7_310_016
+# Статус записи в листе ожидания
+WAITLIST_STATUS = 6
+# Статус записи, покинувшей лист ожидания: в отличие от отмены (4) не учитывается в статистике
+WAITLIST_LEFT_STATUS = 7
+# Верхняя граница capacity (SMALLINT) - число мест тренировки без ограничения
+MAX_SEATS = 32767
+
+
+@tag_queries
 class UserRequest:
     """
     Запросы к таблице users.
     """
     @staticmethod
-    async def add_user(user_id: int, name: str, balance: int = 0):
+    async def add_user(user_id: int, name: str, balance: int = 0, session: Optional[AsyncSession] = None) -> None:
         """
-        Добавление пользователя в БД.
+        Добавление пользователя в БД или обновление его имени.
 
-        Проверка дублирования реализована средствами SQLAlchemy
+        Одним запросом INSERT ... ON CONFLICT DO UPDATE, строка перезаписывается только если имя изменилось
         :param user_id:
         :param name:
         :param balance:
-        :return: User object
         """
-        async with async_session() as session:
-            new_user = User(user_id=user_id, name=name, balance=balance, created_at=datetime.now())
-            session.add(new_user)
+        async with session_scope(session) as session:
+            statement = pg_insert(User).values(user_id=user_id, name=name, balance=balance, created_at=datetime.now())
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[User.user_id],
+                set_={'name': statement.excluded.name},
+                where=User.name != statement.excluded.name))
 
-            try:
-                await session.commit()
-            except IntegrityError as e:
-                print(e)
-            await session.refresh(new_user)
+    @staticmethod
+    async def get_user_names(session: Optional[AsyncSession] = None) -> Dict[int, str]:
+        """
+        Имена всех пользователей для прогрева реестра known_users
+
+        :return: {user_id: name}
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(select(User.user_id, User.name))
+            return dict(result.all())
 
 
+@tag_queries
 class WorkoutsRequests:
     """
     Запросы к таблице workouts.
     """
 
     @staticmethod
-    async def create_workout(workout_date: datetime, type_id: int, created_by: int):
+    async def create_workout(workout_date: datetime, type_id: int, created_by: int,
+                             capacity: Optional[int] = CapacitySettings.DEFAULT_CAPACITY or None,
+                             session: Optional[AsyncSession] = None):
         """
         Создание новой тренировки в БД
 
         :param workout_date:
         :param type_id:
         :param created_by:
+        :param capacity: количество мест, None - без ограничения
         :return:
         """
-        async with async_session() as session:
-            new_workout = Workout(date=workout_date, type_id=type_id, created_by=created_by)
+        async with session_scope(session) as session:
+            new_workout = Workout(date=workout_date, type_id=type_id, created_by=created_by, capacity=capacity)
             session.add(new_workout)
-            await session.commit()
+            await session.flush()
+            after_commit(session, upcoming_workouts_cache.invalidate)
+            after_commit(session, sign_up_keyboard_cache.bump)
             return new_workout
 
+    @staticmethod
+    async def set_capacity(workout_id: int, capacity: Optional[int],
+                           session: Optional[AsyncSession] = None) -> Optional[List[Row]]:
+        """
+        Изменение количества мест на тренировке
+
+        Если мест стало больше, на них в той же транзакции переводятся пользователи из листа ожидания.
+        Счетчик мест в Redis сбрасывается и заново заполняется из БД при следующем обращении
+        :param workout_id:
+        :param capacity: количество мест, None - без ограничения
+        :return: переведенные из листа ожидания (см. RegistrationRequests.promote_waitlist)
+            или None, если тренировка не найдена
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                update(Workout).where(Workout.workout_id == workout_id).values(capacity=capacity)
+            )
+            if not result.rowcount:
+                return None
+            after_commit(session, upcoming_workouts_cache.invalidate)
+            after_commit(session, lambda: seat_counter.reset(workout_id))
+            after_commit(session, sign_up_keyboard_cache.bump)
+            return await RegistrationRequests.promote_waitlist(workout_id, session=session)
+
     @staticmethod
     async def show_workouts():
         """
         Запрос всех доступных тренировок.
 
-        Фильтрует тренировки по дате-времени, выдает только тренировки, которые будут
+        Фильтрует тренировки по дате-времени, выдает только тренировки, которые будут.
+        Результат берется из кэша upcoming_workouts_cache
         :return: [Row[tuple[Workout, WorkoutType]]
         """
-        async with async_session() as session:
+        return await upcoming_workouts_cache.get(WorkoutsRequests.fetch_upcoming_workouts)
+
+    @staticmethod
+    async def fetch_upcoming_workouts(session: Optional[AsyncSession] = None):
+        """
+        Запрос всех предстоящих тренировок из БД в обход кэша
+
+        :return: [Row[tuple[Workout, WorkoutType]]
+        """
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(Workout, WorkoutType)
                 .where(Workout.date >= datetime.now())
-                .join(WorkoutType).order_by(Workout.date)
+                .join(WorkoutType).order_by(Workout.date, Workout.workout_id)
             )
             workouts = result.all()
-            # print(result.scalar_one_or_none())
             return workouts
 
     @staticmethod
-    async def get_workout_by_id(workout_id: int):
+    async def show_workouts_page(cursor: Optional[PageCursor] = None, backward: bool = False,
+                                 limit: int = KeyboardSettings.PAGE_SIZE) -> Page:
+        """
+        Страница доступных тренировок по ключу (date, workout_id)
+
+        Страница вырезается из кэша upcoming_workouts_cache без запроса к БД
+        :param cursor: ключ, от которого строится страница; None - первая страница
+        :param backward: страница перед cursor
+        :param limit: размер страницы
+        :return: Page со строками Row[tuple[Workout, WorkoutType]]
+        """
+        return await upcoming_workouts_cache.page(WorkoutsRequests.fetch_upcoming_workouts, cursor, backward, limit)
+
+    @staticmethod
+    async def get_workout_by_id(workout_id: int, session: Optional[AsyncSession] = None):
         """
         Запрос тренировки по её ID.
 
@@ -91,7 +182,7 @@ class WorkoutsRequests:
         :param workout_id:
         :return: [tuple[Workout, WorkoutType]]
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(Workout, WorkoutType)
                 .where(Workout.workout_id == workout_id)
@@ -101,7 +192,7 @@ class WorkoutsRequests:
         return workout
 
     @staticmethod
-    async def delete_workout(workout_id: int):
+    async def delete_workout(workout_id: int, session: Optional[AsyncSession] = None):
         """
         Удаление тренировки по её ID.
 
@@ -109,7 +200,7 @@ class WorkoutsRequests:
         :param workout_id:
         :return: str
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(Workout)
                 .filter_by(workout_id=workout_id))
@@ -118,35 +209,154 @@ class WorkoutsRequests:
             # Если тренировка найдена, удаляем её
             if workout:
                 await session.delete(workout)
-                await session.commit()
+                await session.flush()
+                after_commit(session, upcoming_workouts_cache.invalidate)
+                after_commit(session, lambda: seat_counter.reset(workout_id))
+                after_commit(session, sign_up_keyboard_cache.bump)
                 print("Тренировка и связанные записи успешно удалены.")
                 return "Тренировка и связанные записи успешно удалены."
 
             return 'Возникла проблема при удалении просьба обратиться к администраору'
 
     @staticmethod
-    async def get_last_week_workouts(day_before: int):
+    async def get_last_week_workouts(day_before: int, cursor: Optional[PageCursor] = None, backward: bool = False,
+                                     limit: int = KeyboardSettings.PAGE_SIZE,
+                                     session: Optional[AsyncSession] = None) -> Page:
         """
         Запрос прошедших за неделю тренировок.
 
-        Фильтрует тренировки по дате-времени, выдает только тренировки, которые были в течении day_before дней
+        Фильтрует тренировки по дате-времени, выдает только тренировки, которые были в течении day_before дней.
+        Результат разбит на страницы по ключу (date, workout_id)
         :param day_before:
-        :return: [Row[tuple[Workout, WorkoutType]]
+        :param cursor: ключ, от которого строится страница; None - первая страница
+        :param backward: страница перед cursor
+        :param limit: размер страницы
+        :return: Page со строками Row[tuple[Workout, WorkoutType]]
         """
         date = datetime.now() - timedelta(days=day_before)
 
-        async with async_session() as session:
-            result = await session.execute(
+        async with session_scope(session) as session:
+            return await fetch_page(
+                session,
                 select(Workout, WorkoutType)
                 .where(Workout.date >= date, Workout.date <= datetime.now())
-                .join(WorkoutType)
-                .order_by(Workout.date)
+                .join(WorkoutType),
+                Workout.date, Workout.workout_id,
+                key=lambda row: PageCursor(row[0].date, row[0].workout_id),
+                cursor=cursor, backward=backward, limit=limit,
             )
-        workout_for_check = result.all()
 
-        return workout_for_check
 
+@tag_queries
+class TemplateRequests:
+    """
+    Запросы к шаблонам повторяющихся тренировок workout_templates.
+    """
+    @staticmethod
+    async def create_templates(templates: List[Dict], session: Optional[AsyncSession] = None) -> List[int]:
+        """
+        Создание шаблонов одним запросом
 
+        :param templates: [{type_id, weekday, start_time, capacity, valid_until, created_by}]
+        :return: template_id созданных шаблонов
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                pg_insert(WorkoutTemplate).values(templates).returning(WorkoutTemplate.template_id)
+            )
+            return list(result.scalars())
+
+    @staticmethod
+    async def get_active_templates(session: Optional[AsyncSession] = None):
+        """
+        Действующие шаблоны по дням недели
+
+        :return: [WorkoutTemplate]
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                select(WorkoutTemplate)
+                .where(WorkoutTemplate.active)
+                .order_by(WorkoutTemplate.weekday, WorkoutTemplate.start_time, WorkoutTemplate.template_id)
+            )
+            return result.scalars().all()
+
+    @staticmethod
+    async def deactivate_template(template_id: int, session: Optional[AsyncSession] = None) -> bool:
+        """
+        Остановка шаблона: новые тренировки по нему не создаются, уже созданные остаются
+
+        :return: True, если действующий шаблон найден
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                update(WorkoutTemplate)
+                .where(WorkoutTemplate.template_id == template_id, WorkoutTemplate.active)
+                .values(active=False)
+            )
+        return result.rowcount > 0
+
+    @staticmethod
+    async def materialize_workouts(horizon_end: datetime, template_ids: Optional[List[int]] = None,
+                                   session: Optional[AsyncSession] = None):
+        """
+        Создание тренировок по действующим шаблонам до horizon_end одним запросом
+
+        Даты перебираются generate_series от generated_until шаблона (не раньше текущего момента)
+        до horizon_end или окончания расписания включительно: тренировка ровно в момент окончания
+        создается, а следующий вызов начинает строго после него. В том же запросе generated_until сдвигается,
+        поэтому повторный вызов ничего не создает, а удаленные тренировки не появляются снова.
+        uq_workouts_template_date защищает от дублей при одновременных вызовах
+        :param horizon_end: до какого момента создаются тренировки
+        :param template_ids: только эти шаблоны, None - все действующие
+        :return: [Row(workout_id, date)] созданных тренировок
+        """
+        now = datetime.now()
+        start = func.greatest(WorkoutTemplate.generated_until, now)
+        until = func.least(WorkoutTemplate.valid_until, horizon_end)
+        templates = [WorkoutTemplate.active]
+        if template_ids is not None:
+            templates.append(WorkoutTemplate.template_id.in_(template_ids))
+
+        days = func.generate_series(func.date_trunc('day', start), until, timedelta(days=1)) \
+            .table_valued('day').render_derived(name='days')
+        workout_date = days.c.day + WorkoutTemplate.start_time
+        advanced = (
+            update(WorkoutTemplate)
+            .where(*templates)
+            .values(generated_until=func.greatest(WorkoutTemplate.generated_until, until))
+            .returning(WorkoutTemplate.template_id)
+            .cte('advanced')
+        )
+        statement = (
+            pg_insert(Workout)
+            .from_select(
+                ['type_id', 'date', 'capacity', 'created_by', 'template_id'],
+                select(WorkoutTemplate.type_id, workout_date, WorkoutTemplate.capacity, WorkoutTemplate.created_by,
+                       WorkoutTemplate.template_id)
+                .select_from(WorkoutTemplate)
+                .join(days, true())
+                .where(*templates,
+                       func.extract('isodow', days.c.day) == WorkoutTemplate.weekday,
+                       workout_date > start,
+                       workout_date <= until)
+            )
+            .on_conflict_do_nothing(index_elements=['template_id', 'date'],
+                                    index_where=Workout.template_id.isnot(None))
+            .returning(Workout.workout_id, Workout.date)
+            .add_cte(advanced)
+        )
+
+        async with session_scope(session) as session:
+            result = await session.execute(statement)
+            workouts = result.all()
+            if workouts:
+                after_commit(session, upcoming_workouts_cache.invalidate)
+                after_commit(session, sign_up_keyboard_cache.bump)
+            return workouts
+
+
+@tag_queries
 class RegistrationRequests:
     """
     Запросы к таблице registrations.
@@ -173,35 +383,62 @@ class RegistrationRequests:
     #             return True
 
     @staticmethod
-    async def sign_in(user_id: int, workout_id: int):
+    async def sign_in(user_id: int, workout_id: int, check_capacity: bool = True,
+                      session: Optional[AsyncSession] = None):
         """
         Запрос на регистрацию на тренировку пользователем.
 
-        Используется в паре с is_already_exists
+        Запись выполняется одним запросом: INSERT ... ON CONFLICT DO NOTHING по частичному
+        уникальному индексу активных записей, данные тренировки возвращаются тем же запросом.
+        Записаться можно только на тренировку, которая еще не началась и на которой есть места.
+        При check_capacity записи на одну тренировку выполняются по очереди (pg_advisory_xact_lock),
+        чтобы параллельные запросы не превысили количество мест
         :param user_id:
         :param workout_id:
+        :param check_capacity: False - по счетчику мест известно, что количество мест не ограничено
+        :return: Row(date, type_name, is_new, is_full, is_registered, is_waiting) или None,
+            если тренировка недоступна. is_new = False - пользователь уже был записан (is_registered = True),
+            стоит в листе ожидания (is_waiting = True) или мест нет (is_full = True)
         """
-        # TODO нет проверки выполнения запроса
-        async with async_session() as session:
-            # проверка есть ли уже такая регистрация со статусом 1
+        now = datetime.now()
+        active_count = (
+            select(func.count())
+            .select_from(Registration)
+            .where(Registration.workout_id == workout_id, Registration.status_id == 1)
+            .scalar_subquery()
+        )
+        has_seats = or_(Workout.capacity.is_(None), active_count < Workout.capacity)
+        available_workout = (
+            select(literal(user_id, BigInteger), Workout.workout_id)
+            .where(Workout.workout_id == workout_id, Workout.date >= now, has_seats)
+        )
+        new_registration = (
+            pg_insert(Registration)
+            .from_select(['user_id', 'workout_id'], available_workout)
+            .on_conflict_do_nothing(index_elements=['user_id', 'workout_id'],
+                                    index_where=text('status_id IN (1, 6)'))
+            .returning(Registration.registration_id)
+            .cte('new_registration')
+        )
+        is_registered = exists().where(Registration.workout_id == workout_id, Registration.user_id == user_id,
+                                       Registration.status_id == 1)
+        is_waiting = exists().where(Registration.workout_id == workout_id, Registration.user_id == user_id,
+                                    Registration.status_id == WAITLIST_STATUS)
+
+        async with session_scope(session) as session:
+            if check_capacity:
+                await session.execute(select(func.pg_advisory_xact_lock(SEATS_LOCK_CLASS, workout_id)))
             result = await session.execute(
-                select(Registration)
-                .filter_by(user_id=user_id,
-                           workout_id=workout_id,
-                           status_id=1))
-
-            existing_registration = result.scalars().first()
-            if existing_registration:
-                print('Вы уже записаны на эту тренировку')
-                return 'Вы уже записаны на эту тренировку'
-
-            new_registration = Registration(user_id=user_id, workout_id=workout_id)
-            session.add(new_registration)
-
-            try:
-                await session.commit()
-            except Exception as e:
-                print("Все пошло не так_________", e)
+                select(Workout.date,
+                       WorkoutType.type_name,
+                       exists(select(new_registration.c.registration_id)).label('is_new'),
+                       not_(has_seats).label('is_full'),
+                       is_registered.label('is_registered'),
+                       is_waiting.label('is_waiting'))
+                .join(WorkoutType, Workout.type_id == WorkoutType.type_id)
+                .where(Workout.workout_id == workout_id, Workout.date >= now)
+            )
+            return result.first()
 
     # @staticmethod
     # async def change_status(user_id: int, workout_id: int):
@@ -227,108 +464,361 @@ class RegistrationRequests:
     #         print("Ошибка при изменении статуса тренировки.")
 
     @staticmethod
-    async def update_user_status(workout_id: int, user_id: int, status: int, is_payed: bool=True):
+    async def update_user_status(workout_id: int, user_id: int, status: int, is_payed: bool=True,
+                                 session: Optional[AsyncSession] = None):
         """
         Обновление статуса регистрации|оплаты
 
-        может менять статус оплаты
+        может менять статус оплаты. Статистика посещаемости обновляется тем же запросом
         :param workout_id: необходим для идентификации
         :param user_id: необходим для идентификации
         :param status: новый статус тренировки
         :param is_payed: новый статус тренировки
         :return: str - если статус успешно изменен возвращает сообщение, что статус изменен
         """
-        async with async_session() as session:
+        changed = (
+            update(Registration)
+            .filter(Registration.workout_id == workout_id,
+                    Registration.user_id == user_id,
+                    Registration.status_id == 1)  # Запись не отменялась
+            .values(status_id=status, is_payed=is_payed)  # TODO при запуске оплаты изменить на False
+            .returning(Registration.user_id, Registration.workout_id, Registration.status_id)
+            .cte('changed')
+        )
+        async with session_scope(session) as session:
             result = await session.execute(
-                update(Registration)
-                .filter(Registration.workout_id == workout_id,
-                        Registration.user_id == user_id,
-                        Registration.status_id == 1)  # Запись не отменялась
-                .values(status_id=status, is_payed=is_payed)  # TODO при запуске оплаты изменить на False
+                select(func.count()).select_from(changed).add_cte(record_changes(changed))
             )
-            await session.commit()
             if result:
                 return 'Статус пользователя успешно изменен.'
 
     @staticmethod
-    async def give_up_registration(registration_id: int):
+    async def update_user_status_many(workout_id: int, statuses: Dict[int, int], is_payed: bool = True,
+                                      session: Optional[AsyncSession] = None) -> int:
         """
-        Отмена записи на тренировку
+        Обновление статусов записей нескольких пользователей на тренировку одним запросом
 
-        :param registration_id: используется для идентификации
-        :return: str - сообщение об успешной отмене
+        Меняются только активные (не отмененные) записи. Статистика посещаемости обновляется тем же запросом
+        :param workout_id: необходим для идентификации
+        :param statuses: {user_id: новый статус тренировки}
+        :param is_payed: новый статус оплаты
+        :return: int - количество измененных записей
         """
-        async with async_session() as session:
-            await session.execute(
-                update(Registration).where(Registration.registration_id == registration_id).values(status_id=4)
+        if not statuses:
+            return 0
+
+        changed = (
+            update(Registration)
+            .filter(Registration.workout_id == workout_id,
+                    Registration.user_id.in_(list(statuses)),
+                    Registration.status_id == 1)  # Запись не отменялась
+            .values(status_id=case(statuses, value=Registration.user_id), is_payed=is_payed)
+            .returning(Registration.user_id, Registration.workout_id, Registration.status_id)
+            .cte('changed')
+        )
+        async with session_scope(session) as session:
+            result = await session.execute(
+                select(func.count()).select_from(changed).add_cte(record_changes(changed))
             )
-            await session.commit()
-            return True
+            return result.scalar_one()
 
     @staticmethod
-    async def get_workouts_by_user_id(user_id: int):
+    async def join_waitlist(user_id: int, workout_id: int, session: Optional[AsyncSession] = None):
         """
-        Получение всех записей на тренировки для конкретного пользователя
+        Постановка в лист ожидания тренировки, на которой нет мест
 
+        Выполняется под той же блокировкой мест тренировки, что и запись, поэтому пользователь не попадает
+        в лист ожидания, если место освободилось. Очередь упорядочена по registration_id
         :param user_id:
-        :return: Workout.date, WorkoutType.type_name, Registration.registration_id
+        :param workout_id:
+        :return: Row(date, type_name, is_new, has_seats, is_active, position) или None, если тренировка недоступна.
+            is_active - пользователь уже записан, has_seats - места есть и можно записаться,
+            position - место в очереди (None, если пользователь не в листе ожидания)
         """
-        async with async_session() as session:
-            result = await session.execute(select(Workout.date, WorkoutType.type_name, Registration.registration_id)
-            .join(Registration, Registration.workout_id == Workout.workout_id)
-            .join(WorkoutType, Workout.type_id == WorkoutType.type_id)
-            .filter(Registration.user_id == user_id).filter(
-                Workout.date >= datetime.now(),
-                Registration.status_id == 1)
-            .order_by(Workout.date)
+        now = datetime.now()
+        active_count = (
+            select(func.count())
+            .select_from(Registration)
+            .where(Registration.workout_id == workout_id, Registration.status_id == 1)
+            .scalar_subquery()
+        )
+        has_seats = or_(Workout.capacity.is_(None), active_count < Workout.capacity)
+        own_status = (
+            select(Registration.status_id)
+            .where(Registration.workout_id == workout_id, Registration.user_id == user_id,
+                   Registration.status_id.in_((1, WAITLIST_STATUS)))
+            .scalar_subquery()
+        )
+        own_entry = (
+            select(Registration.registration_id)
+            .where(Registration.workout_id == workout_id, Registration.user_id == user_id,
+                   Registration.status_id == WAITLIST_STATUS)
+            .scalar_subquery()
+        )
+        waiting = aliased(Registration)
+        position = (
+            select(func.count())
+            .where(waiting.workout_id == workout_id, waiting.status_id == WAITLIST_STATUS,
+                   waiting.registration_id <= own_entry)
+            .scalar_subquery()
+        )
+
+        async with session_scope(session) as session:
+            await session.execute(select(func.pg_advisory_xact_lock(SEATS_LOCK_CLASS, workout_id)))
+            inserted = await session.execute(
+                pg_insert(Registration)
+                .from_select(['user_id', 'workout_id', 'status_id'],
+                             select(literal(user_id, BigInteger), Workout.workout_id, literal(WAITLIST_STATUS))
+                             .where(Workout.workout_id == workout_id, Workout.date >= now, not_(has_seats)))
+                .on_conflict_do_nothing(index_elements=['user_id', 'workout_id'],
+                                        index_where=text('status_id IN (1, 6)'))
+                .returning(Registration.registration_id)
+            )
+            is_new = inserted.first() is not None
+            result = await session.execute(
+                select(Workout.date,
+                       WorkoutType.type_name,
+                       literal(is_new).label('is_new'),
+                       has_seats.label('has_seats'),
+                       (own_status == 1).label('is_active'),
+                       case((own_entry.is_not(None), position)).label('position'))
+                .join(WorkoutType, Workout.type_id == WorkoutType.type_id)
+                .where(Workout.workout_id == workout_id, Workout.date >= now)
+            )
+            return result.first()
+
+    @staticmethod
+    async def promote_waitlist(workout_id: int, session: Optional[AsyncSession] = None) -> List[Row]:
+        """
+        Перевод пользователей из листа ожидания в записавшиеся на свободные места
+
+        Вызывается в транзакции, освободившей или добавившей места. Блокировка мест тренировки
+        упорядочивает одновременные отмены и записи: каждая транзакция видит места, освобожденные
+        предыдущими, и переводит из очереди не больше свободных мест, FIFO по registration_id
+        :param workout_id:
+        :return: [Row(registration_id, user_id, date, type_id)] переведенных записей
+        """
+        active_count = (
+            select(func.count())
+            .select_from(Registration)
+            .where(Registration.workout_id == workout_id, Registration.status_id == 1)
+            .scalar_subquery()
+        )
+        # Для тренировки без ограничения мест переводятся все ожидающие, для прошедшей - никто
+        free_seats = func.coalesce(
+            select(func.greatest(func.coalesce(Workout.capacity, MAX_SEATS) - active_count, 0))
+            .where(Workout.workout_id == workout_id, Workout.date >= datetime.now())
+            .scalar_subquery(),
+            0)
+        next_in_line = (
+            select(Registration.registration_id)
+            .where(Registration.workout_id == workout_id, Registration.status_id == WAITLIST_STATUS)
+            .order_by(Registration.registration_id)
+            .limit(free_seats)
+            .with_for_update(skip_locked=True)
+        )
+
+        promoted = (
+            update(Registration)
+            .where(Registration.registration_id.in_(next_in_line))
+            .values(status_id=1, registered_at=func.now())
+            .returning(Registration.registration_id, Registration.user_id, Registration.workout_id)
+            .cte('promoted')
+        )
+
+        async with session_scope(session) as session:
+            await session.execute(select(func.pg_advisory_xact_lock(SEATS_LOCK_CLASS, workout_id)))
+            result = await session.execute(
+                select(promoted.c.registration_id, promoted.c.user_id, Workout.date, Workout.type_id)
+                .join(Workout, Workout.workout_id == promoted.c.workout_id)
+                .order_by(promoted.c.registration_id)
             )
             return result.all()
 
     @staticmethod
-    async def get_all_available_workouts():
+    async def give_up_registration(registration_id: int,
+                                   session: Optional[AsyncSession] = None) -> Optional[List[Row]]:
         """
-        Получение всех доступных для записи тренировок
+        Отмена записи на тренировку или выход из листа ожидания
 
-        :return: [tuple[Workout, WorkoutType]]
+        Освободившееся место в той же транзакции занимает первый в листе ожидания (promote_waitlist),
+        если очередь пуста - место освобождается в счетчике мест. Отмена записи учитывается в статистике
+        посещаемости, выход из листа ожидания (статус WAITLIST_LEFT_STATUS) - нет: места у пользователя не было
+        :param registration_id: используется для идентификации
+        :return: переведенные из листа ожидания (см. promote_waitlist) или None, если запись уже отменена
         """
-        async with async_session() as session:
+        previous = aliased(Registration)
+        changed = (
+            update(Registration)
+            .where(Registration.registration_id == registration_id,
+                   Registration.status_id.in_((1, WAITLIST_STATUS)),
+                   previous.registration_id == Registration.registration_id)
+            .values(status_id=case((previous.status_id == WAITLIST_STATUS, WAITLIST_LEFT_STATUS), else_=4))
+            .returning(Registration.user_id, Registration.workout_id, Registration.status_id,
+                       previous.status_id.label('previous_status_id'))
+            .cte('changed')
+        )
+        async with session_scope(session) as session:
             result = await session.execute(
-                select(Workout, WorkoutType)
-                .where(Workout.date >= datetime.now())
-                .join(WorkoutType).order_by(Workout.date)
+                select(changed.c.workout_id, changed.c.previous_status_id).add_cte(record_changes(changed))
             )
-            workouts = result.all()
-            return workouts
+            cancelled = result.first()
+            if cancelled is None:
+                return None
+            if cancelled.previous_status_id == WAITLIST_STATUS:
+                return []
+
+            workout_id = cancelled.workout_id
+            promoted = await RegistrationRequests.promote_waitlist(workout_id, session=session)
+            if not promoted:
+                after_commit(session, lambda: RegistrationRequests.release_seat(workout_id))
+            return promoted
 
     @staticmethod
-    async def count_signs_for_workouts():
+    async def release_seat(workout_id: int) -> None:
+        """Освобождение места в счетчике мест, клавиатура записи покажет его при следующем чтении счетчиков"""
+        await seat_counter.release(workout_id)
+
+    @staticmethod
+    async def get_seats(workout_ids: List[int],
+                        session: Optional[AsyncSession] = None) -> Dict[int, Tuple[Optional[int], int]]:
         """
-        Считает количество зарегистрированных на тренировку пользователей
+        Количество мест и активных записей для списка тренировок одним запросом
 
-        :return: [tuple[Workout.workout_id, int]]
+        Используется для заполнения счетчиков мест utils.seats
+        :param workout_ids:
+        :return: {workout_id: (capacity или None, количество активных записей)}
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
+                select(Workout.workout_id, Workout.capacity, func.count(Registration.registration_id))
+                .outerjoin(Registration, and_(Registration.workout_id == Workout.workout_id,
+                                              Registration.status_id == 1))
+                .where(Workout.workout_id.in_(workout_ids))
+                .group_by(Workout.workout_id)
+            )
+            return {workout_id: (capacity, taken) for workout_id, capacity, taken in result.all()}
+
+    @staticmethod
+    async def get_workouts_by_user_id(user_id: int, cursor: Optional[PageCursor] = None, backward: bool = False,
+                                      limit: int = KeyboardSettings.PAGE_SIZE,
+                                      session: Optional[AsyncSession] = None) -> Page:
+        """
+        Получение записей на тренировки для конкретного пользователя
+
+        Результат разбит на страницы по ключу (date, workout_id)
+        :param user_id:
+        :param cursor: ключ, от которого строится страница; None - первая страница
+        :param backward: страница перед cursor
+        :param limit: размер страницы
+        :return: Page со строками (Workout.date, WorkoutType.type_name, Registration.registration_id,
+            Workout.workout_id, Registration.status_id), включая места в листе ожидания
+        """
+        async with session_scope(session) as session:
+            return await fetch_page(
+                session,
+                select(Workout.date, WorkoutType.type_name, Registration.registration_id, Workout.workout_id,
+                       Registration.status_id)
+                .join(Registration, Registration.workout_id == Workout.workout_id)
+                .join(WorkoutType, Workout.type_id == WorkoutType.type_id)
+                .filter(Registration.user_id == user_id)
+                .filter(Workout.date >= datetime.now(), Registration.status_id.in_((1, WAITLIST_STATUS))),
+                Workout.date, Workout.workout_id,
+                key=lambda row: PageCursor(row.date, row.workout_id),
+                cursor=cursor, backward=backward, limit=limit,
+            )
+
+    @staticmethod
+    async def get_all_available_workouts():
+        """
+        Получение всех доступных для записи тренировок
+
+        Использует общий с WorkoutsRequests.show_workouts кэш
+        :return: [tuple[Workout, WorkoutType]]
+        """
+        return await WorkoutsRequests.show_workouts()
+
+    @staticmethod
+    async def get_available_workouts_with_signs_count(cursor: Optional[PageCursor] = None, backward: bool = False,
+                                                      limit: int = KeyboardSettings.PAGE_SIZE,
+                                                      session: Optional[AsyncSession] = None) -> Page:
+        """
+        Получение доступных тренировок с количеством записавшихся пользователей
+
+        Тренировки без записей попадают в выборку с нулевым количеством.
+        Результат разбит на страницы по ключу (date, workout_id)
+        :param cursor: ключ, от которого строится страница; None - первая страница
+        :param backward: страница перед cursor
+        :param limit: размер страницы
+        :return: Page со строками (Workout.workout_id, Workout.date, WorkoutType.type_name, registration_count)
+        """
+        async with session_scope(session) as session:
+            return await fetch_page(
+                session,
                 select(
                     Workout.workout_id,
-                    func.count(Registration.user_id).label("registration_count"))
-                .join(Registration, Workout.workout_id == Registration.workout_id)
-                .filter(Workout.date >= datetime.now(), Registration.status_id == 1)
-                .group_by(Workout.workout_id, Workout.date)
-                .order_by(Workout.date))
+                    Workout.date,
+                    WorkoutType.type_name,
+                    func.count(Registration.registration_id).label("registration_count"))
+                .join(WorkoutType, Workout.type_id == WorkoutType.type_id)
+                .outerjoin(Registration, and_(Registration.workout_id == Workout.workout_id,
+                                              Registration.status_id == 1))
+                .filter(Workout.date >= datetime.now())
+                .group_by(Workout.workout_id, Workout.date, WorkoutType.type_name),
+                Workout.date, Workout.workout_id,
+                key=lambda row: PageCursor(row.date, row.workout_id),
+                cursor=cursor, backward=backward, limit=limit,
+            )
 
-        walks = result.all()
-        return walks
+    @staticmethod
+    async def stream_registrations(date_from: datetime, date_to: datetime, chunk_size: int,
+                                   session: Optional[AsyncSession] = None) -> AsyncIterator[Sequence[Row]]:
+        """
+        Выгрузка записей на тренировки за период порциями по chunk_size строк, включая архив
+
+        Строки читаются курсором на стороне сервера (stream + yield_per), поэтому в памяти
+        одновременно находится только одна порция
+        :param date_from: начало периода по дате тренировки, включительно
+        :param date_to: конец периода, не включительно
+        :param chunk_size:
+        :return: порции строк (registration_id, registered_at, workout_id, date, type_name,
+            user_id, name, status_name, is_payed)
+        """
+        registrations = union_all(
+            select(Registration.registration_id, Registration.registered_at, Workout.workout_id, Workout.date,
+                   Workout.type_id, Registration.user_id, Registration.status_id, Registration.is_payed)
+            .join(Workout, Workout.workout_id == Registration.workout_id)
+            .where(Workout.date >= date_from, Workout.date < date_to),
+            select(AttendanceHistory.history_id, AttendanceHistory.registered_at, WorkoutHistory.workout_id,
+                   WorkoutHistory.date, WorkoutHistory.type_id, AttendanceHistory.user_id,
+                   AttendanceHistory.status_id, AttendanceHistory.is_payed)
+            .join(WorkoutHistory, WorkoutHistory.workout_id == AttendanceHistory.workout_id)
+            .where(WorkoutHistory.date >= date_from, WorkoutHistory.date < date_to),
+        ).subquery()
+
+        async with session_scope(session) as session:
+            result = await session.stream(
+                select(registrations.c.registration_id, registrations.c.registered_at, registrations.c.workout_id,
+                       registrations.c.date, WorkoutType.type_name, User.user_id, User.name, Status.status_name,
+                       registrations.c.is_payed)
+                .join(WorkoutType, WorkoutType.type_id == registrations.c.type_id)
+                .join(User, User.user_id == registrations.c.user_id)
+                .join(Status, Status.status_id == registrations.c.status_id)
+                .order_by(registrations.c.date, registrations.c.workout_id, registrations.c.registration_id)
+                .execution_options(yield_per=chunk_size)
+            )
+            async for rows in result.partitions():
+                yield rows
 
     @staticmethod
-    async def get_workout_users(workout_id: int) -> List[str]:
+    async def get_workout_users(workout_id: int, session: Optional[AsyncSession] = None) -> List[str]:
         """
         Получение имен пользователей, записанных на тренировку
 
         :param workout_id: id Тренировки
         :return: Список имен пользователей
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(User.name)
                 .join(Registration, Registration.user_id == User.user_id)
@@ -338,7 +828,7 @@ class RegistrationRequests:
         return users
 
     @staticmethod
-    async def get_workout_username_and_id(workout_id: int):
+    async def get_workout_username_and_id(workout_id: int, session: Optional[AsyncSession] = None):
         """
         Получение Имени пользователя, его ID и информации о тренировке
 
@@ -347,7 +837,7 @@ class RegistrationRequests:
         :param workout_id:
         :return: [tuple[User.name, User.user_id, Workout.date, WorkoutType.type_name]]
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(User.name, User.user_id, Workout.date, WorkoutType.type_name)
                 .join(Registration, Registration.user_id == User.user_id)
@@ -359,14 +849,14 @@ class RegistrationRequests:
             return users
 
     @staticmethod
-    async def get_workout_info_by_reg_id(registration_id: int):
+    async def get_workout_info_by_reg_id(registration_id: int, session: Optional[AsyncSession] = None):
         """
         Получение информации о тренировке по registration_id
 
         :param registration_id:
         :return: [tuple[Workout.date, WorkoutType.type_name]]
         """
-        async with async_session() as session:
+        async with session_scope(session) as session:
             result = await session.execute(
                 select(Workout.date, WorkoutType.type_name)
                 .join(Registration, Registration.workout_id == Workout.workout_id)
@@ -377,6 +867,156 @@ class RegistrationRequests:
             return workout_info
 
 
+@tag_queries
+class AttendanceRequests:
+    """
+    Запросы к сводной статистике посещаемости attendance_stats.
+
+    Отчеты читают только сводную таблицу - их стоимость не зависит от объема истории записей
+    """
+    @staticmethod
+    async def get_type_totals(session: Optional[AsyncSession] = None):
+        """
+        Итоги посещаемости по типам тренировок
+
+        :return: [Row(type_name, users, visits, no_shows, cancellations)]
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                select(WorkoutType.type_name,
+                       func.count().label('users'),
+                       func.sum(AttendanceStats.visits).label('visits'),
+                       func.sum(AttendanceStats.no_shows).label('no_shows'),
+                       func.sum(AttendanceStats.cancellations).label('cancellations'))
+                .join(WorkoutType, WorkoutType.type_id == AttendanceStats.type_id)
+                .group_by(WorkoutType.type_id, WorkoutType.type_name)
+                .order_by(WorkoutType.type_id)
+            )
+            return result.all()
+
+    @staticmethod
+    async def get_top_users(limit: int, session: Optional[AsyncSession] = None):
+        """
+        Пользователи с наибольшим количеством посещений по всем типам тренировок
+
+        :param limit:
+        :return: [Row(user_id, name, visits, no_shows, cancellations, best_streak)]
+        """
+        async with session_scope(session) as session:
+            totals = (
+                select(AttendanceStats.user_id,
+                       func.sum(AttendanceStats.visits).label('visits'),
+                       func.sum(AttendanceStats.no_shows).label('no_shows'),
+                       func.sum(AttendanceStats.cancellations).label('cancellations'),
+                       func.max(AttendanceStats.best_streak).label('best_streak'))
+                .group_by(AttendanceStats.user_id)
+                .order_by(func.sum(AttendanceStats.visits).desc(), AttendanceStats.user_id)
+                .limit(limit)
+                .subquery()
+            )
+            result = await session.execute(
+                select(totals.c.user_id, User.name, totals.c.visits, totals.c.no_shows,
+                       totals.c.cancellations, totals.c.best_streak)
+                .join(User, User.user_id == totals.c.user_id)
+                .order_by(totals.c.visits.desc(), totals.c.user_id)
+            )
+            return result.all()
+
+    @staticmethod
+    async def get_user_stats(user_id: int, session: Optional[AsyncSession] = None):
+        """
+        Статистика пользователя по типам тренировок
+
+        :param user_id:
+        :return: [Row(type_name, visits, no_shows, cancellations, current_streak, best_streak, last_workout_date)]
+        """
+        async with session_scope(session) as session:
+            result = await session.execute(
+                select(WorkoutType.type_name, AttendanceStats.visits, AttendanceStats.no_shows,
+                       AttendanceStats.cancellations, AttendanceStats.current_streak, AttendanceStats.best_streak,
+                       AttendanceStats.last_workout_date)
+                .join(WorkoutType, WorkoutType.type_id == AttendanceStats.type_id)
+                .where(AttendanceStats.user_id == user_id)
+                .order_by(WorkoutType.type_id)
+            )
+            return result.all()
+
+    @staticmethod
+    async def rebuild_stats(session: Optional[AsyncSession] = None) -> int:
+        """
+        Полный пересчет статистики по registrations и архиву attendance_history
+
+        Исправляет расхождения приращений, например серии посещений при отметке тренировок не по порядку
+        :return: количество строк статистики
+        """
+        async with session_scope(session) as session:
+            for statement in REBUILD_STATEMENTS:
+                result = await session.execute(text(statement))
+            return result.rowcount
+
+
+@tag_queries
+class ArchiveRequests:
+    """
+    Перенос прошедших тренировок и записей на них в архив workouts_history/attendance_history.
+
+    В workouts и registrations остаются недавние и будущие тренировки, по которым работают выборки бота
+    """
+    @staticmethod
+    async def archive_workouts(before: datetime, limit: int, session: Optional[AsyncSession] = None) -> int:
+        """
+        Перенос в архив не более limit тренировок, прошедших до before, вместе с записями
+
+        Выполняется одним запросом из CTE: удаленные строки сразу вставляются в архив.
+        Тренировки, заблокированные другой транзакцией, пропускаются до следующего запуска
+        :param before:
+        :param limit:
+        :return: количество перенесенных тренировок, 0 - переносить больше нечего
+        """
+        batch = (
+            select(Workout.workout_id)
+            .where(Workout.date < before)
+            .order_by(Workout.date, Workout.workout_id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .cte('batch')
+        )
+        moved_workouts = (
+            delete(Workout)
+            .where(Workout.workout_id.in_(select(batch.c.workout_id)))
+            .returning(Workout.workout_id, Workout.type_id, Workout.date, Workout.capacity, Workout.created_by,
+                       Workout.created_at)
+            .cte('moved_workouts')
+        )
+        moved_registrations = (
+            delete(Registration)
+            .where(Registration.workout_id.in_(select(batch.c.workout_id)))
+            .returning(Registration.registration_id, Registration.user_id, Registration.workout_id,
+                       Registration.status_id, Registration.is_payed, Registration.registered_at)
+            .cte('moved_registrations')
+        )
+        archived_workouts = (
+            pg_insert(WorkoutHistory)
+            .from_select(['workout_id', 'type_id', 'date', 'capacity', 'created_by', 'created_at'],
+                         select(moved_workouts))
+            .returning(WorkoutHistory.workout_id)
+            .cte('archived_workouts')
+        )
+        archived_registrations = (
+            pg_insert(AttendanceHistory)
+            .from_select(['history_id', 'user_id', 'workout_id', 'status_id', 'is_payed', 'registered_at'],
+                         select(moved_registrations))
+            .cte('archived_registrations')
+        )
+
+        async with session_scope(session) as session:
+            result = await session.execute(
+                select(func.count()).select_from(archived_workouts).add_cte(archived_registrations)
+            )
+            return result.scalar_one()
+
+
+@tag_queries
 class ServiceRequests:
     """
     Класс сервисных запросов PostgreSQL
@@ -386,44 +1026,30 @@ class ServiceRequests:
     async def add_workout_types():
         """
         Добавление типов тренировок
+
+        Один запрос INSERT ... ON CONFLICT DO NOTHING, id берутся из utils.workouts_types
         """
         async with async_session() as session:
-            for workout_type in workout_types.values():
-                # Проверяем, существует ли уже такой тип тренировки
-                result = await session.execute(
-                    select(WorkoutType).where(WorkoutType.type_name == workout_type)
-                )
-                existing_type = result.scalar_one_or_none()
-
-                if not existing_type:
-                    # Добавляем тип тренировки, если его нет
-                    new_type = WorkoutType(type_name=workout_type)
-                    session.add(new_type)
-                # print(await session.execute(text('SELECT * FROM WorkoutType')))
-
+            await session.execute(
+                pg_insert(WorkoutType)
+                .values([{'type_id': type_id, 'type_name': type_name} for type_id, type_name in workout_types.items()])
+                .on_conflict_do_nothing()
+            )
             await session.commit()
 
     @staticmethod
     async def add_statuses_types():
         """
         Добавление статусов тренировок
-        """
-        status_types = ['Записан', 'Посетил', 'Ожидает подтверждения', 'Отменил', 'Не посетил']
 
+        Один запрос INSERT ... ON CONFLICT DO NOTHING, id берутся из utils.workouts_types
+        """
         async with async_session() as session:
-            for status in status_types:
-                # Проверяем, существует ли уже такой тип тренировки
-                result = await session.execute(
-                    select(Status).where(Status.status_name == status)
-                )
-                existing_type = result.scalar_one_or_none()
-
-                if not existing_type:
-                    # Добавляем тип тренировки, если его нет
-                    new_type = Status(status_name=status)
-                    session.add(new_type)
-                # print(await session.execute(text('SELECT * FROM WorkoutType')))
-
+            await session.execute(
+                pg_insert(Status)
+                .values([{'status_id': status_id, 'status_name': name} for status_id, name in statuses.items()])
+                .on_conflict_do_nothing()
+            )
             await session.commit()
 
     @staticmethod
@@ -431,7 +1057,7 @@ class ServiceRequests:
         """
         Создание таблиц в базе данных PostgreSQL
         """
-        async with engine.begin() as conn:
+        async with get_engine().begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
 
     @staticmethod
@@ -479,72 +1105,98 @@ class ServiceRequests:
             await session.refresh(new_admin)
             print(new_admin)
 
+    @staticmethod
+    async def add_admins(admins: Dict[int, str]):
+        """
+        Добавление администраторов одним запросом, уже существующие пропускаются
+
+        :param admins: {admin_id: name}
+        """
+        async with async_session() as session:
+            await session.execute(
+                pg_insert(Admin)
+                .values([{'admin_id': admin_id, 'name': name} for admin_id, name in admins.items()])
+                .on_conflict_do_nothing()
+            )
+            await session.commit()
+
+    @staticmethod
+    async def get_state(key: str) -> Optional[str]:
+        """
+        Чтение служебного значения из service_state
+
+        :param key:
+        :return: значение или None, если его (или самой таблицы) еще нет
+        """
+        async with async_session() as session:
+            try:
+                result = await session.execute(select(ServiceState.value).where(ServiceState.key == key))
+            except ProgrammingError:  # таблица еще не создана
+                return None
+            return result.scalar_one_or_none()
+
+    @staticmethod
+    async def set_state(key: str, value: str):
+        """
+        Запись служебного значения в service_state
+
+        :param key:
+        :param value:
+        """
+        async with async_session() as session:
+            statement = pg_insert(ServiceState).values(key=key, value=value)
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[ServiceState.key],
+                set_={'value': statement.excluded.value, 'updated_at': func.now()}))
+            await session.commit()
+
     @staticmethod
     async def drop_all_base():
         """
         Удаление всех таблиц из БД
         """
-        async with engine.begin() as conn:
+        async with get_engine().begin() as conn:
             await conn.run_sync(Base.metadata.drop_all)
 
 
+@tag_queries
 class StartServiceRequest:
     """
     Класс для запуска работы с базой данных PostgreSQL
     """
+    FINGERPRINT_KEY = 'startup_fingerprint'
+
     @staticmethod
     async def create_and_fill_db():
         """
-        Создание таблиц БД и их заполнение
-        """
-        await ServiceRequests.create_tables()
-        await ServiceRequests.add_workout_types()
-        await ServiceRequests.add_statuses_types()
-        await StartServiceRequest.check_column_in_tables()
-        try:
-            await ServiceRequests.add_admin(MainSettings.ADMIN_LIST[0], 'Alexey')
-            await ServiceRequests.add_admin(MainSettings.ADMIN_LIST[1], 'Natasha')
-        except IntegrityError as e:
-            print('\nДанные уже есть в таблице', e)
+        Создание таблиц БД, применение миграций схемы и заполнение справочников
 
-    @staticmethod
-    async def add_column_to_table(conn, table: Table, column: Column):
+        Если отпечаток схемы и справочников совпадает с сохраненным при прошлом запуске,
+        подготовка пропускается - запуск стоит одного запроса к БД
         """
-        Добавляет недостающий столбец в таблицу.
-        """
-        column_type = column.type.compile(dialect=conn.dialect)
-        column_default = f"DEFAULT {column.default}" if column.default is not None else ""
-        nullable = "NULL" if column.nullable else "NOT NULL"
+        fingerprint = StartServiceRequest.startup_fingerprint()
+        if await ServiceRequests.get_state(StartServiceRequest.FINGERPRINT_KEY) == fingerprint:
+            logger.info('Схема БД и справочники не изменились, подготовка БД пропущена')
+            return
 
-        alter_query = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} {nullable} {column_default}"
-        print('Столбец добавлен')
-        await conn.execute(text(alter_query))
-        await conn.commit()
+        await apply_migrations()
+        await ServiceRequests.add_workout_types()
+        await ServiceRequests.add_statuses_types()
+        await ServiceRequests.add_admins(StartServiceRequest.admins())
+        await ServiceRequests.set_state(StartServiceRequest.FINGERPRINT_KEY, fingerprint)
 
     @staticmethod
-    async def get_existing_columns(table_name, conn):
-        """
-        Возвращает список имен существующих столбцов в таблице.
-        """
-        return await conn.run_sync(
-            lambda sync_conn: {col["name"] for col in inspect(sync_conn).get_columns(table_name)})
+    def admins() -> Dict[int, str]:
+        """Администраторы, добавляемые при запуске: {admin_id: name}"""
+        return {MainSettings.ADMIN_LIST[0]: 'Alexey', MainSettings.ADMIN_LIST[1]: 'Natasha'}
 
     @staticmethod
-    async def check_column_in_tables():
-        """
-        Проверяет соответствие столбцов БД и столбцов моделей таблиц. Добавляетстолбцы, если в БД их нет
-        """
-        async with engine.connect() as conn:
-            # Получаем список таблиц и их столбцов через sync-инспектор
-            for table_name, table in Base.metadata.tables.items():
-                # Проверяем, существует ли таблица
-                existing_columns = await StartServiceRequest.get_existing_columns(table_name, conn)
+    def startup_fingerprint() -> str:
+        """Отпечаток схемы БД, миграций и данных справочников"""
+        seed = repr((schema_fingerprint(), sorted(workout_types.items()), sorted(statuses.items()),
+                     sorted(StartServiceRequest.admins().items())))
+        return hashlib.sha256(seed.encode()).hexdigest()
 
-                # Сравниваем столбцы и добавляем недостающие
-                for column_name, column in table.columns.items():
-                    if column_name not in existing_columns:
-                        print(f"Добавляем отсутствующий столбец '{column_name}' в таблицу '{table_name}'")
-                        await StartServiceRequest.add_column_to_table(conn, table, column)
 
 # asyncio.run(ServiceRequests.clear_all_data())
 # print((asyncio.run(WorkoutsRequests.get_type_workout_by_id(1))))
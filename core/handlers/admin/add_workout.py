@@ -10,15 +10,14 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram_calendar import SimpleCalendar
 
 from database.data_models import Workout
 from database.requests import ServiceRequests, WorkoutsRequests
 from utils.workouts_types import workout_types
 from utils.states import ChooseWorkoutTimeState
-from utils.support_func import get_formatted_list_of_users_by_workout_id
-
-from loader import MainSettings
+from utils.reminders import schedule_workout_reminders
 
 
 async def add_workout(message: Message):
@@ -65,7 +64,8 @@ async def choose_time_for_workout_handler(call: CallbackQuery, state: FSMContext
     await call.answer('Время выбрано')
 
 
-async def set_time_for_workout(call: CallbackQuery, state: FSMContext, scheduler: AsyncIOScheduler):
+async def set_time_for_workout(call: CallbackQuery, state: FSMContext, scheduler: AsyncIOScheduler,
+                               session: AsyncSession):
     """
     Обработка, выбранного времени для тренировки
     """
@@ -80,16 +80,14 @@ async def set_time_for_workout(call: CallbackQuery, state: FSMContext, scheduler
         await call.message.answer('Введите время тренировки в формате ЧЧ:MM')
         await state.set_state(ChooseWorkoutTimeState.CHOOSE_TIME)
     await state.update_data(time=time)
-    workout_data = await add_workout_to_db(call, state)
-    # создание задачи на отправку сообщения за час до начала тренировки
-    scheduler.add_job(remainder_with_list_of_users,
-                      trigger='date',
-                      run_date=workout_data.date - timedelta(hours=1),
-                      kwargs={'workout_id': workout_data.workout_id})
+    workout_data = await add_workout_to_db(call, state, session)
+    # создание задач на рассылку напоминаний перед началом тренировки
+    schedule_workout_reminders(scheduler, workout_data.workout_id, workout_data.date)
     await call.answer('Время выбрано')
 
 
-async def custom_time_handler(message: Message, bot: Bot, state: FSMContext, scheduler: AsyncIOScheduler):
+async def custom_time_handler(message: Message, bot: Bot, state: FSMContext, scheduler: AsyncIOScheduler,
+                              session: AsyncSession):
     """
     Обработчик ввода времени для тренировки вручную
     """
@@ -99,16 +97,13 @@ async def custom_time_handler(message: Message, bot: Bot, state: FSMContext, sch
         await state.update_data(time=time)
         await state.set_state(ChooseWorkoutTimeState.ADD_WORKOUT)
 
-        workout_data = await add_workout_to_db(message, state)
-        scheduler.add_job(remainder_with_list_of_users,
-                          trigger='date',
-                          run_date=workout_data.date - timedelta(hours=1),
-                          kwargs={'workout_id': workout_data.workout_id})
+        workout_data = await add_workout_to_db(message, state, session)
+        schedule_workout_reminders(scheduler, workout_data.workout_id, workout_data.date)
     else:
         await message.answer('Введите время тренировки в формате ЧЧ:MM')
 
 
-async def add_workout_to_db(message: Message | CallbackQuery, state: FSMContext) -> Workout:
+async def add_workout_to_db(message: Message | CallbackQuery, state: FSMContext, session: AsyncSession) -> Workout:
     """
     Добавление тренировки в базу данных
     """
@@ -120,7 +115,7 @@ async def add_workout_to_db(message: Message | CallbackQuery, state: FSMContext)
     new_date = date + time
 
     workout_type_id = data.get('workout_type_id')
-    workout = await WorkoutsRequests.create_workout(new_date, workout_type_id, user_id)
+    workout = await WorkoutsRequests.create_workout(new_date, workout_type_id, user_id, session=session)
     answer_message = (f'Тренировка <b>{workout_types[workout.type_id]}</b> добавлена на <b>{workout.date.strftime("%d.%m")}</b>'
                       f' в <b>{workout.date.strftime("%H:%M")}</b>.\n '
                       f'Вы можете добавить еще тренировки.')
@@ -132,21 +127,6 @@ async def add_workout_to_db(message: Message | CallbackQuery, state: FSMContext)
     return workout
 
 
-async def remainder_with_list_of_users(bot: Bot, workout_id: int):
-    """
-    Отправляет уведомления тренеру, сообщая список участников за час до занятия
-    :param bot:
-    :param workout_id:
-    :return:
-    """
-    users_list = await get_formatted_list_of_users_by_workout_id(workout_id)
-    for user_id in (MainSettings.SUPERUSER, 6416472110):
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"Записаны:\n{users_list}",
-        )
-
-
 async def choose_workout_type_kb() -> InlineKeyboardMarkup:
     """
     Клавиатура для выбора типа тренировки
@@ -0,0 +1,45 @@
+"""
+Модуль изменения количества мест на тренировке
+"""
+from aiogram.filters import CommandObject
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.psql_engine import after_commit
+from database.requests import WorkoutsRequests
+from utils.waitlist import notify_promoted
+
+MAX_CAPACITY = 32767  # SmallInteger
+
+
+async def set_capacity_handler(message: Message, command: CommandObject, session: AsyncSession):
+    """
+    Обработчик команды /set_capacity <id тренировки> <количество мест>
+
+    0 мест снимает ограничение. id тренировки показывается в /show_walk при просмотре тренировки.
+    Добавленные места занимают пользователи из листа ожидания
+    """
+    args = (command.args or '').split()
+    if len(args) != 2 or not all(arg.isdigit() for arg in args) or int(args[1]) > MAX_CAPACITY:
+        await message.answer('Использование: /set_capacity <id тренировки> <количество мест>\n'
+                             '0 - без ограничения')
+        return
+
+    workout_id, capacity = int(args[0]), int(args[1])
+    promoted = await WorkoutsRequests.set_capacity(workout_id, capacity or None, session=session)
+    if promoted:
+        after_commit(session, lambda: notify_promoted(message.bot, promoted))
+    # Блокировка мест тренировки (pg_advisory_xact_lock) не должна удерживаться на время ответа
+    await session.commit()
+
+    if promoted is None:
+        await message.answer('Тренировка не найдена')
+        return
+
+    if capacity:
+        text = f'Количество мест на тренировке {workout_id}: {capacity}'
+    else:
+        text = f'Ограничение мест на тренировке {workout_id} снято'
+    if promoted:
+        text += f'\nЗаписаны из листа ожидания: {len(promoted)}'
+    await message.answer(text)
@@ -1,32 +1,46 @@
 """
 Модуль логики проверки посещаемости
 """
+from typing import Dict, Optional
+
 from aiogram import Bot
-from aiogram.types import CallbackQuery, Message
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.context import FSMContext
+from aiogram.types import CallbackQuery, InlineKeyboardButton, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from database.pagination import PageCursor
 from database.requests import RegistrationRequests, WorkoutsRequests
+from loader import KeyboardSettings
+from utils.keyboard_pages import add_page_buttons, parse_page_callback
+from utils.profile_photos import profile_photo_cache
+
+VISITED_STATUS = 2  # посетил
+MISSED_STATUS = 5  # не посетил
+ROSTER_MARKS = {None: '▫️', VISITED_STATUS: '✅', MISSED_STATUS: '❌'}
 
 
-async def check_workouts(message: Message):
+async def check_workouts(message: Message, session: AsyncSession):
     """
     Обрабртка команды /check_walks
 
     Запускае т сценарий проверки присутвия людей на тренировках.
     """
-    await message.answer('Выберите тренировку для проверки:', reply_markup=await moderate_workout_kb())
+    await message.answer('Выберите тренировку для проверки:', reply_markup=await moderate_workout_kb(session))
 
 
-async def moderate_workout_kb() -> InlineKeyboardMarkup:
+async def moderate_workout_kb(session: AsyncSession, cursor: Optional[PageCursor] = None,
+                              backward: bool = False) -> InlineKeyboardMarkup:
     """
     Клавиатура для проверки посещаемости тренировки
+
+    Показывает одну страницу тренировок за последнюю неделю с кнопками перелистывания
     """
     moderate_workout_kb_builder = InlineKeyboardBuilder()
 
-    last_week_workouts = await WorkoutsRequests.get_last_week_workouts(7)
+    page = await WorkoutsRequests.get_last_week_workouts(7, cursor, backward, session=session)
 
-    for workout, workout_type in last_week_workouts:
+    for workout, workout_type in page.rows:
         date = (workout.date.strftime('%d.%m | %H:%M')
                 .replace('08:30', '08:30☀')
                 .replace('20:30', '20:30🌓'))
@@ -37,30 +51,158 @@ async def moderate_workout_kb() -> InlineKeyboardMarkup:
                                            callback_data=f'check_{workout_id}')
 
     moderate_workout_kb_builder.adjust(1)
+    add_page_buttons(moderate_workout_kb_builder, 'chpg', page)
     return moderate_workout_kb_builder.as_markup()
 
 
-async def check_workout_kb_handler(call: CallbackQuery, bot: Bot):
+async def moderate_workout_page_handler(call: CallbackQuery, session: AsyncSession):
+    """Перелистывание клавиатуры проверки посещаемости в том же сообщении"""
+    cursor, backward = parse_page_callback(call.data)
+    await call.message.edit_reply_markup(reply_markup=await moderate_workout_kb(session, cursor, backward))
+    await call.answer('')
+
+
+async def check_workout_kb_handler(call: CallbackQuery, state: FSMContext, session: AsyncSession):
     """
     Обработка обновлений от moderate_workout_kb
 
+    Отправляет администратору одно сообщение со списком участников тренировки.
+    Отметки о посещении хранятся в FSM до нажатия "Сохранить"
+    """
+    workout_id = int(call.data.split('_')[1])
+    users = await RegistrationRequests.get_workout_username_and_id(workout_id, session=session)
+    if not users:
+        await call.answer('На тренировку никто не записан')
+        return
+
+    date = users[0].date.strftime('%d.%m | %H:%M').replace('08:30', '08:30☀').replace('20:30', '20:30🌓')
+    roster = {
+        'names': {str(user.user_id): user.name for user in users},
+        'statuses': {},
+    }
+    await state.update_data({f'roster_{workout_id}': roster})
+
+    await call.message.answer(f'{date} | {users[0].type_name} #{workout_id}\n'
+                              f'Отметьте присутствовавших и нажмите "Сохранить"',
+                              reply_markup=await roster_kb(workout_id, roster['names'], roster['statuses']))
+    await call.answer('Отметьте присутствовавших участников')
+
+
+async def roster_kb(workout_id: int, names: Dict[str, str], statuses: Dict[str, int],
+                    page: int = 0) -> InlineKeyboardMarkup:
+    """
+    Клавиатура отметки посещаемости всей тренировки
+
+    Кнопка участника переключает его статус: не отмечен -> Был -> Не был -> Был.
+    Участники показываются страницами по KeyboardSettings.ROSTER_PAGE_SIZE, отметки всех страниц
+    сохраняются вместе
+    :param page: номер страницы с 0
+    """
+    roster_kb_builder = InlineKeyboardBuilder()
+
+    page_size = KeyboardSettings.ROSTER_PAGE_SIZE
+    user_ids = list(names)
+    page_user_ids = user_ids[page * page_size:(page + 1) * page_size]
+    for user_id in page_user_ids:
+        mark = ROSTER_MARKS[statuses.get(user_id)]
+        roster_kb_builder.button(text=f'{mark} {names[user_id]}', callback_data=f'rost_{workout_id}_{user_id}')
+
+    roster_kb_builder.button(text='💾 Сохранить', callback_data=f'rsave_{workout_id}')
+    roster_kb_builder.button(text='📷 По одному с фото', callback_data=f'checkph_{workout_id}')
+    roster_kb_builder.adjust(*[1] * len(page_user_ids), 2)
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'rpg_{workout_id}_{page - 1}'))
+    if (page + 1) * page_size < len(user_ids):
+        buttons.append(InlineKeyboardButton(text='Вперед ➡️', callback_data=f'rpg_{workout_id}_{page + 1}'))
+    if buttons:
+        roster_kb_builder.row(*buttons)
+    return roster_kb_builder.as_markup()
+
+
+async def roster_page_handler(call: CallbackQuery, state: FSMContext):
+    """Перелистывание списка участников roster_kb в том же сообщении"""
+    _, workout_id, page = call.data.split('_')
+    roster = await get_roster(state, int(workout_id))
+    if roster is None:
+        await call.answer('Список устарел, откройте проверку заново')
+        return
+
+    await call.message.edit_reply_markup(
+        reply_markup=await roster_kb(int(workout_id), roster['names'], roster['statuses'], int(page)))
+    await call.answer('')
+
+
+async def roster_toggle_handler(call: CallbackQuery, state: FSMContext):
+    """
+    Обработка нажатия на участника в roster_kb
+
+    Меняет отметку участника и перерисовывает клавиатуру в том же сообщении
+    """
+    _, workout_id, user_id = call.data.split('_')
+    roster = await get_roster(state, int(workout_id))
+    if roster is None:
+        await call.answer('Список устарел, откройте проверку заново')
+        return
+
+    current_status = roster['statuses'].get(user_id)
+    roster['statuses'][user_id] = VISITED_STATUS if current_status != VISITED_STATUS else MISSED_STATUS
+    await state.update_data({f'roster_{workout_id}': roster})
+
+    page = list(roster['names']).index(user_id) // KeyboardSettings.ROSTER_PAGE_SIZE
+    await call.message.edit_reply_markup(
+        reply_markup=await roster_kb(int(workout_id), roster['names'], roster['statuses'], page))
+    await call.answer('')
+
+
+async def roster_save_handler(call: CallbackQuery, state: FSMContext, session: AsyncSession):
+    """
+    Обработка кнопки "Сохранить" в roster_kb
+
+    Записывает все отметки в таблицу Registration одним запросом
+    """
+    workout_id = int(call.data.split('_')[1])
+    roster = await get_roster(state, workout_id)
+    if roster is None:
+        await call.answer('Список устарел, откройте проверку заново')
+        return
+
+    statuses = {int(user_id): status for user_id, status in roster['statuses'].items()}
+    updated = await RegistrationRequests.update_user_status_many(workout_id, statuses, session=session)
+    await state.update_data({f'roster_{workout_id}': None})
+
+    lines = [f'{ROSTER_MARKS[roster["statuses"].get(user_id)]} {name}' for user_id, name in roster['names'].items()]
+    header = call.message.text.split('\n')[0]
+    await call.message.edit_text(f'{header}\n' + '\n'.join(lines) + f'\n\nСохранено отметок: {updated}')
+    await call.answer('Посещаемость сохранена')
+
+
+async def get_roster(state: FSMContext, workout_id: int) -> Optional[dict]:
+    """Список участников проверяемой тренировки из FSM"""
+    data = await state.get_data()
+    return data.get(f'roster_{workout_id}')
+
+
+async def check_workout_photos_handler(call: CallbackQuery, bot: Bot, session: AsyncSession):
+    """
+    Обработка кнопки "По одному с фото" в roster_kb
+
     Отправляет администратору всех участников с ФИ/username и клавиатурой user_status_change_kb
     """
     workout_id = int(call.data.split('_')[1])
-    users = await RegistrationRequests.get_workout_username_and_id(workout_id)
+    users = await RegistrationRequests.get_workout_username_and_id(workout_id, session=session)
     await call.answer('Выберите присутствовавших участников')
+    photos = await profile_photo_cache.get_many(bot, [user.user_id for user in users])
     for user_and_workout_info in users:
         date = user_and_workout_info.date.strftime('%d.%m | %H:%M').replace('08:30', '08:30☀').replace('20:30', '20:30🌓')
         text = (f'{user_and_workout_info.name}\n'
                 f'{date} | {user_and_workout_info.type_name} #{workout_id}')
-        try:  # обработка исключения, если нет аватарки
-            file = await bot.get_user_profile_photos(user_and_workout_info.user_id)
-        except TelegramBadRequest as e:
-            print(e)
+        photo = photos.get(user_and_workout_info.user_id)
+        if photo is None:  # у пользователя нет аватарки
             await call.message.answer(text, reply_markup=await user_status_change_kb(user_and_workout_info.user_id))
             continue
 
-        photo = file.photos[0][0].file_id
         await call.message.answer_photo(photo, caption=text, reply_markup=await user_status_change_kb(user_and_workout_info.user_id))
 
 
@@ -79,7 +221,7 @@ async def user_status_change_kb(user_id) -> InlineKeyboardMarkup:
     return status_kb.as_markup()
 
 
-async def user_status_change_kb_handler(call: CallbackQuery, bot: Bot):
+async def user_status_change_kb_handler(call: CallbackQuery, bot: Bot, session: AsyncSession):
     """
     Обработка нажатия клавиатуры для изменения статута записи пльзователя
 
@@ -107,7 +249,7 @@ async def user_status_change_kb_handler(call: CallbackQuery, bot: Bot):
         text = call.message.text.split('#')[0]
         await bot.edit_message_text(message_id=message_id, chat_id=chat_id, text=f'{text.strip()} {adding_text}')
 
-    result = await RegistrationRequests.update_user_status(workout_id, user_id, status)
+    result = await RegistrationRequests.update_user_status(workout_id, user_id, status, session=session)
     if result:
         await call.answer('Статус изменен')
 
@@ -0,0 +1,22 @@
+"""
+Модуль просмотра состояния очереди исходящих сообщений
+"""
+from aiogram.types import Message
+
+from utils.delivery import outbound_queue
+
+
+async def delivery_stats_handler(message: Message):
+    """
+    Обработчик команды /queue_stats
+
+    Показывает администратору глубину очереди отправки и задержку доставки
+    """
+    stats = outbound_queue.stats()
+    await message.answer(f'Очередь отправки:\n'
+                         f'В очереди: {stats["queued"]}, отложено: {stats["delayed"]}, '
+                         f'отправляется: {stats["in_flight"]}\n'
+                         f'Отправлено: {stats["sent"]}, ошибок: {stats["failed"]}, '
+                         f'повторов: {stats["retried"]}, схлопнуто: {stats["collapsed"]}\n'
+                         f'Задержка p50/p95/max: {stats["latency_p50_ms"]}/{stats["latency_p95_ms"]}/'
+                         f'{stats["latency_max_ms"]} мс')
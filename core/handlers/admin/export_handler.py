@@ -0,0 +1,54 @@
+"""
+Модуль выгрузки записей на тренировки
+"""
+from datetime import datetime, timedelta
+
+from aiogram.filters import CommandObject
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from loader import ExportSettings
+from utils.export import FORMATS, export_registrations, xlsx_available
+
+USAGE = 'Использование: /export [ДД.ММ.ГГГГ ДД.ММ.ГГГГ] [csv|xlsx]'
+
+
+async def export_handler(message: Message, command: CommandObject, session: AsyncSession):
+    """
+    Обработчик команды /export [с по] [формат]
+
+    Отправляет документ с записями на тренировки, даты которых попадают в период (обе даты включительно).
+    Без дат выгружаются последние ExportSettings.DEFAULT_DAYS дней, формат по умолчанию - csv
+    """
+    args = (command.args or '').split()
+    file_format = 'csv'
+    if args and args[-1].lower() in FORMATS:
+        file_format = args.pop().lower()
+
+    try:
+        if len(args) == 2:
+            date_from = datetime.strptime(args[0], '%d.%m.%Y')
+            date_to = datetime.strptime(args[1], '%d.%m.%Y') + timedelta(days=1)
+        elif not args:
+            date_to = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            date_from = date_to - timedelta(days=ExportSettings.DEFAULT_DAYS)
+        else:
+            raise ValueError
+    except ValueError:
+        await message.answer(USAGE)
+        return
+
+    if date_from >= date_to:
+        await message.answer('Дата начала периода позже даты окончания')
+        return
+    if file_format == 'xlsx' and not xlsx_available():
+        await message.answer('Выгрузка в XLSX недоступна: на сервере не установлен openpyxl. Используйте csv')
+        return
+
+    document, rows_count = await export_registrations(date_from, date_to, file_format, session=session)
+    try:
+        await message.answer_document(
+            document,
+            caption=f'Записи с {date_from:%d.%m.%Y} по {date_to - timedelta(days=1):%d.%m.%Y}: {rows_count}')
+    finally:
+        document.file.close()
@@ -0,0 +1,140 @@
+"""
+Модуль повторяющегося расписания тренировок
+"""
+from datetime import datetime, time, timedelta
+from typing import List, Optional, Tuple
+
+from aiogram.filters import CommandObject
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.psql_engine import after_commit
+from database.requests import TemplateRequests
+from loader import CapacitySettings, TemplateSettings
+from utils.jobstores import BulkRedisJobStore
+from utils.reminders import schedule_reminders_bulk
+from utils.workouts_types import workout_types, weekdays
+
+USAGE = ('Использование: /add_schedule [недель] <дни> <ЧЧ:ММ> <тип>[, <дни> <ЧЧ:ММ> <тип>...]\n'
+         'Например: /add_schedule 12 вт/чт 20:30 Длительная, сб 09:00 Ноги\n'
+         'Без количества недель расписание бессрочное, остановить шаблон - /stop_schedule <id>')
+
+# (день недели ISO, время, тип тренировки)
+ScheduleItem = Tuple[int, time, int]
+
+
+async def add_schedule_handler(message: Message, command: CommandObject, jobstore: BulkRedisJobStore,
+                               session: AsyncSession):
+    """
+    Обработчик команды /add_schedule
+
+    Создает шаблон на каждый день недели и сразу создает тренировки по ним: до окончания расписания
+    или на TemplateSettings.HORIZON_DAYS дней для бессрочного, дальше расписание продлевает ежедневная задача.
+    Напоминания создаются пакетно после фиксации транзакции
+    """
+    try:
+        weeks, items = parse_schedule(command.args or '')
+    except ValueError as error:
+        await message.answer(f'{error}\n\n{USAGE}')
+        return
+
+    now = datetime.now()
+    valid_until = now + timedelta(weeks=weeks) if weeks else None
+    template_ids = await TemplateRequests.create_templates(
+        [dict(type_id=type_id, weekday=weekday, start_time=start_time,
+              capacity=CapacitySettings.DEFAULT_CAPACITY or None, valid_until=valid_until,
+              created_by=message.from_user.id)
+         for weekday, start_time, type_id in items],
+        session=session)
+    workouts = await TemplateRequests.materialize_workouts(
+        valid_until or now + timedelta(days=TemplateSettings.HORIZON_DAYS), template_ids, session=session)
+    after_commit(session, lambda: schedule_reminders_bulk(jobstore, workouts))
+
+    period = f'до {valid_until.strftime("%d.%m.%Y")}' if valid_until else 'бессрочно'
+    lines = [f'Расписание добавлено ({period}), создано тренировок: {len(workouts)}']
+    lines.extend(format_item(template_id, item) for template_id, item in zip(template_ids, items))
+    await message.answer('\n'.join(lines))
+
+
+async def schedules_handler(message: Message, session: AsyncSession):
+    """Обработчик команды /schedules: действующие шаблоны расписания"""
+    templates = await TemplateRequests.get_active_templates(session=session)
+    if not templates:
+        await message.answer(f'Действующих шаблонов нет\n\n{USAGE}')
+        return
+
+    lines = ['<b>Шаблоны расписания</b>']
+    for template in templates:
+        period = f', до {template.valid_until.strftime("%d.%m.%Y")}' if template.valid_until else ''
+        lines.append(format_item(template.template_id, (template.weekday, template.start_time, template.type_id))
+                     + period)
+    await message.answer('\n'.join(lines))
+
+
+async def stop_schedule_handler(message: Message, command: CommandObject, session: AsyncSession):
+    """Обработчик команды /stop_schedule <id шаблона>: уже созданные тренировки остаются"""
+    args = (command.args or '').split()
+    if len(args) != 1 or not args[0].isdigit():
+        await message.answer('Использование: /stop_schedule <id шаблона>\nid показывается в /schedules')
+        return
+
+    if await TemplateRequests.deactivate_template(int(args[0]), session=session):
+        await message.answer('Шаблон остановлен, новые тренировки по нему создаваться не будут')
+    else:
+        await message.answer('Действующий шаблон не найден')
+
+
+def parse_schedule(args: str) -> Tuple[Optional[int], List[ScheduleItem]]:
+    """
+    Разбор аргументов /add_schedule
+
+    :return: (количество недель или None, [(день недели, время, тип тренировки)])
+    :raises ValueError: с описанием ошибки для администратора
+    """
+    weeks = None
+    first, _, rest = args.strip().partition(' ')
+    if first.isdigit():
+        weeks = int(first)
+        args = rest
+        if not 0 < weeks <= TemplateSettings.MAX_WEEKS:
+            raise ValueError(f'Количество недель: от 1 до {TemplateSettings.MAX_WEEKS}')
+
+    items = []
+    for item in filter(None, (part.strip() for part in args.split(','))):
+        parts = item.split(maxsplit=2)
+        if len(parts) != 3:
+            raise ValueError(f'Не удалось разобрать "{item}"')
+        days, clock, type_name = parts
+
+        weekday_ids = [weekdays.get(day.lower()) for day in days.split('/')]
+        if None in weekday_ids:
+            raise ValueError(f'Неизвестный день недели в "{days}", используйте {", ".join(weekdays)}')
+        try:
+            start_time = datetime.strptime(clock, '%H:%M').time()
+        except ValueError:
+            raise ValueError(f'Неверное время "{clock}", нужен формат ЧЧ:ММ') from None
+        type_id = find_workout_type(type_name)
+        if type_id is None:
+            raise ValueError(f'Неизвестный тип тренировки "{type_name}"')
+
+        items.extend((weekday, start_time, type_id) for weekday in weekday_ids)
+
+    if not items:
+        raise ValueError('Не указано ни одной тренировки')
+    return weeks, items
+
+
+def find_workout_type(name: str) -> Optional[int]:
+    """Тип тренировки по номеру или началу названия без учета регистра"""
+    if name.isdigit():
+        return int(name) if int(name) in workout_types else None
+    for type_id, type_name in workout_types.items():
+        if type_name.lower().startswith(name.lower()):
+            return type_id
+    return None
+
+
+def format_item(template_id: int, item: ScheduleItem) -> str:
+    weekday, start_time, type_id = item
+    weekday_name = next(name for name, number in weekdays.items() if number == weekday)
+    return f'#{template_id} {weekday_name} {start_time.strftime("%H:%M")} {workout_types[type_id]}'
@@ -1,56 +1,64 @@
 """
 Модуль для управления существующими тренировками
 """
+from typing import Optional
+
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from database.pagination import PageCursor
 from database.requests import RegistrationRequests, WorkoutsRequests
+from utils.keyboard_pages import add_page_buttons, parse_page_callback
 from utils.support_func import get_formatted_list_of_users_by_workout_id
+from utils.reminders import remove_workout_reminders
 
 
-async def show_walks_handler(message: Message):
+async def show_walks_handler(message: Message, session: AsyncSession):
     """
     Обработчик команды /show_walk
 
     Выводи список доступных тренировок администратору с кнопокй для удаления тренировок
     """
-    await message.answer('Нажмите на чтобы увидеть подробности или удалить ее', reply_markup=await all_workouts_info_kb())
+    await message.answer('Нажмите на чтобы увидеть подробности или удалить ее', reply_markup=await all_workouts_info_kb(session))
 
 
-async def all_workouts_info_kb() -> InlineKeyboardMarkup:
+async def all_workouts_info_kb(session: AsyncSession, cursor: Optional[PageCursor] = None,
+                               backward: bool = False) -> InlineKeyboardMarkup:
     """
     Клавиатура с информацией о всех доступных тренировках
+
+    Показывает одну страницу тренировок с кнопками перелистывания
     """
     show_workouts_kb_builder = InlineKeyboardBuilder()
 
-    available_walks = await RegistrationRequests.get_all_available_workouts()
-    count_walkers_on_registration = await RegistrationRequests.count_signs_for_workouts()
-    pair_id_count = {str(pair[0]): pair[1] for pair in count_walkers_on_registration}
+    page = await RegistrationRequests.get_available_workouts_with_signs_count(cursor, backward, session=session)
 
-    if available_walks:
-        for workout, type_ in available_walks:
-            date = workout.date.strftime('%d.%m | %H:%M').replace('09:00', '09:00☀').replace('20:30', '20:30🌓')
-            workout_type = type_.type_name
-            workout_id = str(workout.workout_id)
-
-            if workout_id not in pair_id_count.keys():
-                count_of_walkers = 0
-            else:
-                count_of_walkers = pair_id_count[workout_id]
-            show_workouts_kb_builder.button(text=f'{date} | {workout_type} | {count_of_walkers}',
-                                            callback_data=f'walks_{workout_id}')
+    for walk in page.rows:
+        date = walk.date.strftime('%d.%m | %H:%M').replace('09:00', '09:00☀').replace('20:30', '20:30🌓')
+        show_workouts_kb_builder.button(text=f'{date} | {walk.type_name} | {walk.registration_count}',
+                                        callback_data=f'walks_{walk.workout_id}')
 
     show_workouts_kb_builder.adjust(1)
+    add_page_buttons(show_workouts_kb_builder, 'swpg', page)
     return show_workouts_kb_builder.as_markup()
 
 
-async def inspect_workout(call: CallbackQuery):
+async def all_workouts_page_handler(call: CallbackQuery, session: AsyncSession):
+    """Перелистывание клавиатуры доступных тренировок в том же сообщении"""
+    cursor, backward = parse_page_callback(call.data)
+    await call.message.edit_reply_markup(reply_markup=await all_workouts_info_kb(session, cursor, backward))
+    await call.answer('')
+
+
+async def inspect_workout(call: CallbackQuery, session: AsyncSession):
     """
     Обработчик кнопки проверки информации о тренировке
     """
     workout_id = int(call.data.split('_')[1])
-    listed_walkers = await get_formatted_list_of_users_by_workout_id(workout_id)
-    await call.message.answer(f"Информация о тренировке:\n{listed_walkers}",
+    listed_walkers = await get_formatted_list_of_users_by_workout_id(workout_id, session)
+    await call.message.answer(f"Информация о тренировке {workout_id}:\n{listed_walkers}",
                               reply_markup=await delete_workout_kb(workout_id))
     await call.answer('')
 
@@ -64,11 +72,14 @@ async def delete_workout_kb(workout_id: int) -> InlineKeyboardMarkup:
     return moderate_workout_kb_builder.as_markup()
 
 
-async def delete_workout_kb_handler(call: CallbackQuery):
+async def delete_workout_kb_handler(call: CallbackQuery, scheduler: AsyncIOScheduler, session: AsyncSession):
     """
     Обработчик кнопки подтверждения удаления тренировки администратором
+
+    Удаляет тренировку и задачи напоминаний о ней
     """
     workout_id = int(call.data.split('_')[1])
-    result = await WorkoutsRequests.delete_workout(workout_id)
+    result = await WorkoutsRequests.delete_workout(workout_id, session=session)
+    remove_workout_reminders(scheduler, workout_id)
     await call.message.answer(result)
     await call.answer('')
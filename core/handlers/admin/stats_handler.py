@@ -0,0 +1,59 @@
+"""
+Модуль просмотра статистики посещаемости
+"""
+from aiogram.filters import CommandObject
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.requests import AttendanceRequests
+from loader import StatsSettings
+
+
+async def stats_handler(message: Message, command: CommandObject, session: AsyncSession):
+    """
+    Обработчик команды /stats [id пользователя]
+
+    Без аргумента показывает итоги по типам тренировок и самых активных участников,
+    с id пользователя - его статистику по типам тренировок. Данные берутся из сводной таблицы
+    """
+    args = (command.args or '').split()
+    if args and not args[0].isdigit():
+        await message.answer('Использование: /stats [id пользователя]')
+        return
+
+    if args:
+        await message.answer(await user_stats_text(int(args[0]), session))
+    else:
+        await message.answer(await summary_stats_text(session))
+
+
+async def summary_stats_text(session: AsyncSession) -> str:
+    """Итоги по типам тренировок и список самых активных участников"""
+    totals = await AttendanceRequests.get_type_totals(session=session)
+    if not totals:
+        return 'Статистики посещаемости пока нет'
+
+    lines = ['<b>По типам тренировок</b> (посещений / пропусков / отмен, участников):']
+    lines.extend(f'{row.type_name}: {row.visits} / {row.no_shows} / {row.cancellations}, {row.users}'
+                 for row in totals)
+
+    top_users = await AttendanceRequests.get_top_users(StatsSettings.TOP_USERS, session=session)
+    lines.append('\n<b>Самые активные</b> (посещений / пропусков / отмен, лучшая серия):')
+    lines.extend(f'{number}. {user.name} #{user.user_id}: {user.visits} / {user.no_shows} / {user.cancellations}, '
+                 f'{user.best_streak}'
+                 for number, user in enumerate(top_users, 1))
+    return '\n'.join(lines)
+
+
+async def user_stats_text(user_id: int, session: AsyncSession) -> str:
+    """Статистика пользователя по типам тренировок"""
+    rows = await AttendanceRequests.get_user_stats(user_id, session=session)
+    if not rows:
+        return f'Статистики посещаемости пользователя {user_id} нет'
+
+    lines = [f'<b>Пользователь {user_id}</b> (посещений / пропусков / отмен, серия сейчас / лучшая):']
+    for row in rows:
+        last_date = row.last_workout_date.strftime('%d.%m.%Y') if row.last_workout_date else '-'
+        lines.append(f'{row.type_name}: {row.visits} / {row.no_shows} / {row.cancellations}, '
+                     f'{row.current_streak} / {row.best_streak}, последняя тренировка {last_date}')
+    return '\n'.join(lines)
@@ -1,13 +1,20 @@
 """
 Модель для проверки пользователем своих записей на тренировки и отмены существующих
 """
+from typing import Optional
+
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.requests import RegistrationRequests
+from database.pagination import PageCursor
+from database.psql_engine import after_commit
+from database.requests import RegistrationRequests, WAITLIST_STATUS
+from utils.keyboard_pages import add_page_buttons, parse_page_callback
+from utils.waitlist import notify_promoted
 
 
-async def show_my_registrations(message: Message):
+async def show_my_registrations(message: Message, session: AsyncSession):
     """
     Обработчик для команды /my_walks
 
@@ -16,34 +23,52 @@ async def show_my_registrations(message: Message):
     user_id = message.from_user.id
     await message.answer('Если необходимо отменить запись - нажмите на тренировку и подтвердите отмену.'
                          '\nВаши тренировки:',
-                         reply_markup=await show_all_my_registrations_kb(user_id))
+                         reply_markup=await show_all_my_registrations_kb(user_id, session))
 
 
-async def show_all_my_registrations_kb(user_id: int) -> InlineKeyboardMarkup:
+async def show_all_my_registrations_kb(user_id: int, session: AsyncSession, cursor: Optional[PageCursor] = None,
+                                       backward: bool = False) -> InlineKeyboardMarkup:
     """
     Клавиатура для демонстрации всех записей пользователя на тренировки
+
+    Показывает одну страницу записей с кнопками перелистывания, места в листе ожидания отмечены
     :param user_id:
+    :param session:
+    :param cursor: ключ страницы из кнопки перелистывания
+    :param backward: перелистывание назад
     """
     show_my_registration_kb_builder = InlineKeyboardBuilder()
 
-    registrations = await RegistrationRequests.get_workouts_by_user_id(user_id)
+    page = await RegistrationRequests.get_workouts_by_user_id(user_id, cursor, backward, session=session)
 
-    for registration in registrations:
+    for registration in page.rows:
         date = registration.date.strftime("%m.%d в %H:%M")
         workout_type = registration.type_name
-        show_my_registration_kb_builder.button(text=f'{date} | {workout_type}',
+        text = f'{date} | {workout_type}'
+        if registration.status_id == WAITLIST_STATUS:
+            text += ' | ожидание'
+        show_my_registration_kb_builder.button(text=text,
                                                callback_data=f'giveup_{registration.registration_id}')
 
     show_my_registration_kb_builder.adjust(1)
+    add_page_buttons(show_my_registration_kb_builder, 'mypg', page)
     return show_my_registration_kb_builder.as_markup()
 
 
-async def give_up_handler(call: CallbackQuery):
+async def my_registrations_page_handler(call: CallbackQuery, session: AsyncSession):
+    """Перелистывание клавиатуры записей пользователя в том же сообщении"""
+    cursor, backward = parse_page_callback(call.data)
+    await call.message.edit_reply_markup(
+        reply_markup=await show_all_my_registrations_kb(call.from_user.id, session, cursor, backward))
+    await call.answer('')
+
+
+async def give_up_handler(call: CallbackQuery, session: AsyncSession):
     """
     Обработчик кнопки "Отменить запись"
     """
     registration_id = int(call.data.split('_')[1])
-    workout_info = await RegistrationRequests.get_workout_info_by_reg_id(registration_id)
+    workout_info = await RegistrationRequests.get_workout_info_by_reg_id(registration_id, session=session)
     info_for_send = workout_info[0].date.strftime("%d.%m в %H:%M |") + workout_info[0][1]
 
     await call.message.answer(f'Вы уверены, что хотите удалить тренировку\n{info_for_send}',
@@ -63,11 +88,12 @@ async def delete_confirm_kb(registration_id: int) -> InlineKeyboardMarkup:
     return delete_kb.as_markup()
 
 
-async def delete_registration(call: CallbackQuery):
+async def delete_registration(call: CallbackQuery, session: AsyncSession):
     """
     Обработчик клавиатуры подтверждения удаления тренировки.
 
-    Вносит изменения в БД, сообщает об успешном удалении
+    Вносит изменения в БД, сообщает об успешном удалении.
+    Получившим освободившееся место из листа ожидания сообщения отправляются после фиксации транзакции
     :param call:
     """
     answer = call.data.split('_')[1]
@@ -76,7 +102,15 @@ async def delete_registration(call: CallbackQuery):
         await call.answer('Ну нет так нет...')
         return
 
-    answer = await RegistrationRequests.give_up_registration(int(answer))
-    if answer:
-        await call.message.answer('Запись на тренировку успешно отменена.')
-        await call.answer('Удаление прошло успешно')
+    promoted = await RegistrationRequests.give_up_registration(int(answer), session=session)
+    if promoted:
+        after_commit(session, lambda: notify_promoted(call.bot, promoted))
+    # Блокировка мест тренировки (pg_advisory_xact_lock) не должна удерживаться на время ответов пользователю
+    await session.commit()
+
+    if promoted is None:
+        await call.answer('Запись уже отменена')
+        return
+
+    await call.message.answer('Запись на тренировку успешно отменена.')
+    await call.answer('Удаление прошло успешно')
@@ -1,71 +1,178 @@
 """
 Модуль отвечает за Запись пользователя на тренировку
 """
+from functools import partial
+from typing import List, Optional, Tuple
+
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from database.pagination import PageCursor
 from database.requests import WorkoutsRequests, RegistrationRequests
+from utils.keyboard_pages import add_page_buttons, parse_page_callback
+from utils.keyboard_cache import sign_up_keyboard_cache
+from utils.seats import seat_counter
 
 
-async def sign_up_workout_handler(message: Message):
-    """Обработчик записи на тренировки - команда /sign_up"""
-    await message.answer('Выберите тренировку для записи:', reply_markup=await choose_workout_kb())
+async def sign_up_workout_handler(message: Message, session: AsyncSession):
+    """Обработчик записи на тренировки - команда /sign_up
 
+    Клавиатура одинакова для всех пользователей и берется из общего кэша sign_up_keyboard_cache
+    """
+    markup = await sign_up_keyboard(session, 'first')
+    await message.answer('Выберите тренировку для записи:', reply_markup=markup)
 
-async def choose_workout_kb() -> InlineKeyboardMarkup:
-    """Клавиатура выбора тренировки"""
-    choose_workout_kb_builder = InlineKeyboardBuilder()
 
-    available_workouts = await WorkoutsRequests.show_workouts()
-    # print(available_workouts)
-    if available_workouts:
-        for workout, type_ in available_workouts:
-            date = workout.date.strftime('%d.%m | %H:%M').replace('09:00', '09:00☀').replace('20:30', '20:30🌓')
-            workout_type = type_.type_name
-            workout_id = workout.workout_id
-            choose_workout_kb_builder.button(text=f'{date} | {workout_type}', callback_data=f'signup_{workout_id}')
+async def sign_up_keyboard(session: AsyncSession, page_key: str, cursor: Optional[PageCursor] = None,
+                           backward: bool = False) -> InlineKeyboardMarkup:
+    """Страница клавиатуры выбора тренировки из кэша с текущим числом свободных мест
 
-    else:
+    Клавиатура и счетчики мест ее тренировок читаются из Redis одним обращением,
+    для тренировок с ограниченным количеством мест к кнопке добавляется число свободных мест
+    """
+    markup, counters = await sign_up_keyboard_cache.get(page_key,
+                                                        partial(choose_workout_kb, session, cursor, backward))
+    remaining_seats = await seat_counter.remaining(counters, partial(RegistrationRequests.get_seats, session=session),
+                                                   values=counters)
+    for row in markup.inline_keyboard:
+        for button in row:
+            if not (button.callback_data or '').startswith('signup_'):
+                continue
+            seats = remaining_seats.get(int(button.callback_data.split('_')[-1]))
+            if seats is not None:
+                button.text += f' | мест: {seats}' if seats else ' | мест нет'
+    return markup
+
+
+async def choose_workout_kb(session: AsyncSession, cursor: Optional[PageCursor] = None,
+                            backward: bool = False) -> Tuple[InlineKeyboardMarkup, List[int]]:
+    """Клавиатура выбора тренировки для кэша
+
+    Показывает одну страницу тренировок с кнопками перелистывания. Число свободных мест в клавиатуру
+    не входит - его добавляет sign_up_keyboard по счетчикам мест при каждом показе
+    :return: (клавиатура, id тренировок страницы)
+    """
+    choose_workout_kb_builder = InlineKeyboardBuilder()
+
+    page = await WorkoutsRequests.show_workouts_page(cursor, backward)
+    available_workouts = page.rows
+    for workout, type_ in available_workouts:
+        date = workout.date.strftime('%d.%m | %H:%M').replace('09:00', '09:00☀').replace('20:30', '20:30🌓')
+        choose_workout_kb_builder.button(text=f'{date} | {type_.type_name}',
+                                         callback_data=f'signup_{workout.workout_id}')
+    if not available_workouts:
         choose_workout_kb_builder.button(text='Нет доступных тренировок',
                                          callback_data='None')
 
     choose_workout_kb_builder.adjust(1)
-    return choose_workout_kb_builder.as_markup()
+    add_page_buttons(choose_workout_kb_builder, 'supg', page)
+    return choose_workout_kb_builder.as_markup(), [workout.workout_id for workout, _ in available_workouts]
+
+
+async def choose_workout_page_handler(call: CallbackQuery, session: AsyncSession) -> None:
+    """Перелистывание клавиатуры выбора тренировки в том же сообщении"""
+    cursor, backward = parse_page_callback(call.data)
+    markup = await sign_up_keyboard(session, call.data.split('_', 1)[1], cursor, backward)
+    await call.message.edit_reply_markup(reply_markup=markup)
+    await call.answer('')
 
 
-async def sign_up_workout_to_db(call: CallbackQuery) -> None:
+async def sign_up_workout_to_db(call: CallbackQuery, session: AsyncSession) -> None:
     """Формирует запись на тренировку в БД
 
-    Принимает информацию от inline-кнопки
-    проверяет наличие такой записи, если запись уже существует, сообщает пользователю.
-    Если записи нет - добавляет запись в БД и сообщает пользователю, что он записан
+    Принимает информацию от inline-кнопки и одним запросом добавляет запись в БД.
+    Сначала резервирует место в счетчике мест: если мест нет, отвечает сразу, не обращаясь к БД.
+    Если запись уже существует или тренировка недоступна, сообщает об этом пользователю
+    и освобождает зарезервированное место. Если мест нет, предлагает встать в лист ожидания
     """
     workout_id = int(call.data.split('_')[-1])
     user_id = call.from_user.id
-    # existing_check = await RegistrationRequests.is_already_exists(user_id, workout_id)
-    #
-    # if existing_check:
-    #     await call.message.answer('Вы уже записаны на эту тренировку')
-    #     await call.answer('Уже записаны')
-    #     return
-
-    sign_in_result = await RegistrationRequests.sign_in(user_id, workout_id)
-
-    if sign_in_result:
-        await call.message.answer(sign_in_result)
-        await call.answer('Вы записаны')
+
+    reserved = await seat_counter.reserve(workout_id, partial(RegistrationRequests.get_seats, session=session))
+    if reserved is False:
+        await offer_waitlist(call, workout_id)
+        return
+
+    sign_in_result = await RegistrationRequests.sign_in(user_id, workout_id, check_capacity=reserved is not None,
+                                                        session=session)
+    # Блокировка мест тренировки (pg_advisory_xact_lock) не должна удерживаться на время ответов пользователю
+    await session.commit()
+    if reserved and (sign_in_result is None or not sign_in_result.is_new):
+        await seat_counter.release(workout_id)
+
+    if sign_in_result is None:
+        await call.message.answer('Запись на эту тренировку уже недоступна')
+        await call.answer('Тренировка недоступна')
         return
 
-    workout_data = await WorkoutsRequests.get_workout_by_id(workout_id)
+    if sign_in_result.is_registered:
+        await call.message.answer('Вы уже записаны на эту тренировку')
+        await call.answer('Уже записаны')
+        return
+
+    if sign_in_result.is_waiting:
+        await call.message.answer('Вы уже в листе ожидания этой тренировки')
+        await call.answer('Уже в листе ожидания')
+        return
 
-    date = workout_data[0][0].date.strftime('%m.%d в %H:%M')
-    workout_type = workout_data[0][1].type_name
+    if not sign_in_result.is_new:
+        await offer_waitlist(call, workout_id)
+        return
+
+    date = sign_in_result.date.strftime('%m.%d в %H:%M')
 
     await call.message.answer(f'Вы записаны на тренировку:\n'
-                              f'<b>{date} тебя ждет {workout_type}</b>')
+                              f'<b>{date} тебя ждет {sign_in_result.type_name}</b>')
     await call.answer('Вы записаны на тренировку')
 
 
+async def offer_waitlist(call: CallbackQuery, workout_id: int) -> None:
+    """Сообщение об отсутствии мест с кнопкой постановки в лист ожидания"""
+    waitlist_kb = InlineKeyboardBuilder()
+    waitlist_kb.button(text='Встать в лист ожидания', callback_data=f'wait_{workout_id}')
+    await call.message.answer('Свободных мест нет. Когда кто-то отменит запись, место получит первый '
+                              'в листе ожидания - бот пришлет сообщение',
+                              reply_markup=waitlist_kb.as_markup())
+    await call.answer('Свободных мест нет')
+
+
+async def join_waitlist_handler(call: CallbackQuery, session: AsyncSession) -> None:
+    """Постановка в лист ожидания - кнопка wait_<id тренировки>
+
+    Если место успело освободиться, предлагает записаться вместо ожидания
+    """
+    workout_id = int(call.data.split('_')[-1])
+
+    result = await RegistrationRequests.join_waitlist(call.from_user.id, workout_id, session=session)
+    # Блокировка мест тренировки (pg_advisory_xact_lock) не должна удерживаться на время ответов пользователю
+    await session.commit()
+
+    if result is None:
+        await call.message.answer('Запись на эту тренировку уже недоступна')
+        await call.answer('Тренировка недоступна')
+        return
+
+    if result.is_active:
+        await call.message.answer('Вы уже записаны на эту тренировку')
+        await call.answer('Уже записаны')
+        return
+
+    if result.position is None:  # места есть - в лист ожидания не поставлен
+        sign_up_kb = InlineKeyboardBuilder()
+        sign_up_kb.button(text='Записаться', callback_data=f'signup_{workout_id}')
+        await call.message.answer('Место уже освободилось, можно записаться', reply_markup=sign_up_kb.as_markup())
+        await call.answer('Есть свободные места')
+        return
+
+    date = result.date.strftime('%d.%m в %H:%M')
+    prefix = 'Вы в листе ожидания' if result.is_new else 'Вы уже в листе ожидания'
+    await call.message.answer(f'{prefix} на тренировку <b>{result.type_name}</b> - {date}.\n'
+                              f'Ваше место в очереди: {result.position}. '
+                              f'Выйти из листа ожидания можно в /my_walks')
+    await call.answer('Вы в листе ожидания')
+
+
 async def no_available_workout_handler(call: CallbackQuery) -> None:
     """Обработчик ответа на несуществующую тренировку"""
     await call.answer('Ожидайте добавления тренировок')
@@ -3,18 +3,23 @@
 """
 from aiogram import Bot
 from aiogram.types import Message, BotCommand, BotCommandScopeChat
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from loader import MainSettings
+from database.psql_engine import after_commit
 from database.requests import UserRequest
+from utils.known_users import known_users
 
 
-async def start_handler(message: Message, bot: Bot):
+async def start_handler(message: Message, bot: Bot, session: AsyncSession):
     """
     Обработчик команды /start - регистрация пользователя в БД
 
+    Уже известный пользователь с прежним именем в БД не записывается.
+    В реестр известных пользователей он попадает только после фиксации транзакции
     :param message:
     :param bot:
+    :param session:
     :return:
     """
     user_id = message.from_user.id
@@ -26,10 +31,9 @@ async def start_handler(message: Message, bot: Bot):
         user_name = message.from_user.full_name
 
     # Добавляем пользователя в БД и устанавливаем его команды
-    try:
-        await UserRequest.add_user(user_id, user_name)
-    except InvalidRequestError as e:
-        print(e)
+    if not await known_users.is_saved(user_id, user_name):
+        await UserRequest.add_user(user_id, user_name, session=session)
+        after_commit(session, lambda: known_users.mark_saved(user_id, user_name))
 
     await set_menu_commands(user_id, MainSettings.ADMIN_LIST, bot)
     await message.answer(f'Привет, {user_name}! Рады приветствовать тебя в рядах ходоков!\n'
@@ -42,6 +46,7 @@ async def set_menu_commands(user_id: int, admins: list, bot: Bot):
     """
     Установка меню в зависимости от роли пользователя
 
+    Запрос к API не выполняется, если этот набор команд уже установлен пользователю
     :param user_id:
     :param admins:
     :param bot:
@@ -52,7 +57,10 @@ async def set_menu_commands(user_id: int, admins: list, bot: Bot):
         commands = [
             BotCommand(command='add_walk', description='Добавить тренировку'),
             BotCommand(command='show_walk', description='Показывает запланированные тренировки'),
-            BotCommand(command='check_walks', description='Проверка посещаемости')
+            BotCommand(command='check_walks', description='Проверка посещаемости'),
+            BotCommand(command='stats', description='Статистика посещаемости'),
+            BotCommand(command='export', description='Выгрузка записей в CSV/XLSX'),
+            BotCommand(command='add_schedule', description='Добавить повторяющееся расписание'),
         ]
     else:
         # Команды для остальных пользователей
@@ -61,5 +69,11 @@ async def set_menu_commands(user_id: int, admins: list, bot: Bot):
             BotCommand(command='my_walks', description='Просмотреть список тренировок'),
         ]
 
+    # Набор команд запоминается целиком, чтобы новые команды дошли до пользователей с уже установленным меню
+    command_set = ','.join(command.command for command in commands)
+    if await known_users.has_commands(user_id, command_set):
+        return
+
     # Установка команд
     await bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=user_id))
+    await known_users.mark_commands(user_id, command_set)
@@ -3,6 +3,7 @@
 """
 import dataclasses
 import os
+import socket
 
 from dotenv import load_dotenv, find_dotenv
 
@@ -13,18 +14,141 @@ else:
     load_dotenv()
 
 
+def _env_flag(name: str, default: bool = False) -> bool:
+    """Чтение логического флага из переменных окружения"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 @dataclasses.dataclass
 class MainSettings:
     TOKEN = os.getenv('TOKEN')
     SUPERUSER = int(os.getenv('SUPERUSER'))
     ADMIN_LIST = [int(x) for x in os.getenv('ADMIN_LIST').split(' ')]
+    # Тренеры, получающие список участников перед тренировкой
+    TRAINERS = [int(x) for x in os.getenv('TRAINERS', os.getenv('SUPERUSER')).split(' ')]
+    # Способ получения обновлений: polling или webhook
+    UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+
+
+class WebhookSettings:
+    # Публичный адрес, по которому Telegram будет отправлять обновления: BASE_URL + PATH
+    BASE_URL = os.getenv('WEBHOOK_BASE_URL')
+    PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    SECRET = os.getenv('WEBHOOK_SECRET')
+    HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+    # Сколько обновлений обрабатывается одновременно
+    MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', 50))
 
 
 class DBSettings:
     POSTGRES_USER = os.getenv('POSTGRES_USER')
     POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
     DB_NAME = os.getenv('DB_NAME')
+    # Если DB_HOST не задан, адрес определяется по Docker-контейнеру DB_CONTAINER
+    DB_HOST = os.getenv('DB_HOST')
+    DB_PORT = int(os.getenv('DB_PORT', 5432))
+    DB_CONTAINER = os.getenv('DB_CONTAINER', 'north_walk_db')
+
+    POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+    POOL_PRE_PING = _env_flag('DB_POOL_PRE_PING', True)
+    STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))
+    WARM_UP_CONNECTIONS = int(os.getenv('DB_WARM_UP_CONNECTIONS', 0))
+    ECHO = _env_flag('DB_ECHO')
 
 
 class RedisSettings:
     REDIS_HOST = os.getenv('REDIS_DB_URL')
+    # База Redis для задач планировщика
+    JOBS_DB = int(os.getenv('REDIS_JOBS_DB', 2))
+
+
+class CacheSettings:
+    UPCOMING_WORKOUTS_TTL = int(os.getenv('UPCOMING_WORKOUTS_TTL', 60))
+    KEYBOARD_TTL = int(os.getenv('KEYBOARD_CACHE_TTL', 60))
+
+    PROFILE_PHOTO_TTL = int(os.getenv('PROFILE_PHOTO_TTL', 30 * 24 * 3600))
+    PROFILE_PHOTO_REFRESH_AFTER = int(os.getenv('PROFILE_PHOTO_REFRESH_AFTER', 24 * 3600))
+    PROFILE_PHOTO_FETCH_CONCURRENCY = int(os.getenv('PROFILE_PHOTO_FETCH_CONCURRENCY', 5))
+
+
+class DeliverySettings:
+    GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', 30))
+    CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', 1))
+    CHAT_BURST = float(os.getenv('DELIVERY_CHAT_BURST', 3))
+    WORKERS = int(os.getenv('DELIVERY_WORKERS', 8))
+    MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', 3))
+
+
+class ReminderSettings:
+    # За сколько минут до начала тренировки отправлять напоминания
+    OFFSETS_MINUTES = [int(x) for x in os.getenv('REMINDER_OFFSETS_MINUTES', '1440 60').split(' ')]
+
+
+class StatsSettings:
+    # Час ежедневного полного пересчета статистики посещаемости
+    REBUILD_HOUR = int(os.getenv('STATS_REBUILD_HOUR', 4))
+    TOP_USERS = int(os.getenv('STATS_TOP_USERS', 10))
+
+
+class TemplateSettings:
+    # На сколько дней вперед создаются тренировки по бессрочным шаблонам
+    HORIZON_DAYS = int(os.getenv('TEMPLATE_HORIZON_DAYS', 28))
+    # Час ежедневного создания тренировок по шаблонам
+    GENERATOR_HOUR = int(os.getenv('TEMPLATE_GENERATOR_HOUR', 2))
+    MAX_WEEKS = int(os.getenv('TEMPLATE_MAX_WEEKS', 26))
+
+
+class ArchiveSettings:
+    # Тренировки старше MONTHS месяцев переносятся в архив порциями по BATCH_SIZE тренировок
+    MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', 6))
+    BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 200))
+    # Час ежедневного переноса в архив
+    HOUR = int(os.getenv('ARCHIVE_HOUR', 3))
+
+
+class ExportSettings:
+    # Строк, получаемых из БД за одно обращение к курсору
+    CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+    # Размер файла выгрузки в памяти, после которого он переносится на диск
+    SPOOL_MAX_SIZE = int(os.getenv('EXPORT_SPOOL_MAX_SIZE', 5 * 1024 * 1024))
+    DEFAULT_DAYS = int(os.getenv('EXPORT_DEFAULT_DAYS', 31))
+
+
+class ClusterSettings:
+    # Несколько экземпляров бота работают с общими Redis и Postgres
+    ENABLED = _env_flag('CLUSTER_MODE')
+    INSTANCE_ID = os.getenv('INSTANCE_ID', f'{socket.gethostname()}:{os.getpid()}')
+    UPDATE_DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', 600))
+    USER_LOCK_TIMEOUT = int(os.getenv('USER_LOCK_TIMEOUT', 30))
+    USER_LOCK_WAIT = int(os.getenv('USER_LOCK_WAIT', 10))
+    LEADER_TTL = int(os.getenv('SCHEDULER_LEADER_TTL', 30))
+    LEADER_RENEW_INTERVAL = int(os.getenv('SCHEDULER_LEADER_RENEW_INTERVAL', 10))
+
+
+class MetricsSettings:
+    # Метрики в формате Prometheus отдаются по http://HOST:PORT/metrics
+    ENABLED = _env_flag('METRICS_ENABLED')
+    HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    PORT = int(os.getenv('METRICS_PORT', 9100))
+    # Запросы дольше порога пишутся в лог, 0 - не писать
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
+
+
+class CapacitySettings:
+    # Количество мест на новой тренировке, 0 - без ограничения
+    DEFAULT_CAPACITY = int(os.getenv('WORKOUT_DEFAULT_CAPACITY', 0))
+    # Через сколько секунд счетчик мест в Redis сверяется с Postgres
+    SEATS_TTL = int(os.getenv('SEATS_TTL', 300))
+
+
+class KeyboardSettings:
+    # Количество тренировок на одной странице inline-клавиатуры
+    PAGE_SIZE = int(os.getenv('KEYBOARD_PAGE_SIZE', 8))
+    # Количество участников на странице списка проверки посещаемости (Telegram допускает до 100 кнопок)
+    ROSTER_PAGE_SIZE = int(os.getenv('ROSTER_PAGE_SIZE', 40))
@@ -1,4 +1,5 @@
 import asyncio
+import logging
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
@@ -6,72 +7,143 @@ from aiogram.filters import Command
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram_calendar import SimpleCalendarCallback
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.jobstores.redis import RedisJobStore
 from apscheduler_di import ContextSchedulerDecorator
 
-from loader import MainSettings, RedisSettings
+from loader import MainSettings, RedisSettings, ClusterSettings, MetricsSettings
 from utils.support_commands import start_bot_sup_handler, stop_bot_sup_handler
 from utils.states import ChooseWorkoutTimeState
-from utils.middelwares import ApschedulerMiddleware
+from utils.middelwares import ApschedulerMiddleware, UpdateDeduplicationMiddleware, UserLockMiddleware, \
+    DbSessionMiddleware, CommitBeforeRequestMiddleware
+from utils.cluster import SchedulerLeaderElection
+from utils.metrics import HandlerMetricsMiddleware, MetricsServer
+from database.redis_engine import get_redis
+from utils.delivery import outbound_queue
+from utils.jobstores import BulkRedisJobStore, create_jobstore
+from utils.webhook import run_webhook
 
 from filters.is_admin_filter import IsAdmin
 
 from handlers.admin.add_workout import add_workout, set_time_for_workout, process_simple_calendar, \
     choose_time_for_workout_handler, custom_time_handler
 from handlers.admin.show_walk_handler import show_walks_handler, inspect_workout, \
-    delete_workout_kb_handler
-from handlers.admin.check_workout_handler import check_workout_kb_handler, check_workouts, user_status_change_kb_handler
+    delete_workout_kb_handler, all_workouts_page_handler
+from handlers.admin.delivery_stats_handler import delivery_stats_handler
+from handlers.admin.capacity_handler import set_capacity_handler
+from handlers.admin.stats_handler import stats_handler
+from handlers.admin.export_handler import export_handler
+from handlers.admin.schedule_handler import add_schedule_handler, schedules_handler, stop_schedule_handler
+from handlers.admin.check_workout_handler import check_workout_kb_handler, check_workouts, user_status_change_kb_handler, \
+    roster_toggle_handler, roster_save_handler, check_workout_photos_handler, moderate_workout_page_handler, \
+    roster_page_handler
 
 from handlers.sign_up_workouts_handler import no_available_workout_handler, sign_up_workout_handler, \
-    sign_up_workout_to_db
-from handlers.show_registration_handler import show_my_registrations, give_up_handler, delete_registration
+    sign_up_workout_to_db, choose_workout_page_handler, join_waitlist_handler
+from handlers.show_registration_handler import show_my_registrations, give_up_handler, delete_registration, \
+    my_registrations_page_handler
 from handlers.start_handler import start_handler
 
 
 storage = RedisStorage.from_url(RedisSettings.REDIS_HOST)
-jobstores = {
-    'default': RedisJobStore(
-        jobs_key='dispatcher_trips_jobs',
-        run_times_key='dispatcher_trips_running',
-        host='localhost',
-        db=2,
-        port=6379,
-    )
-}
+jobstore = create_jobstore()
 
 dispatcher = Dispatcher(storage=storage)
 init_bot = Bot(token=MainSettings.TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
 
 
 async def start_bot(bot: Bot, dp: Dispatcher):
-    """Запуск бота и его обработчиков"""
-    await bot.delete_webhook()
-    scheduler = ContextSchedulerDecorator(AsyncIOScheduler(timezone='Europe/Moscow', jobjobstores=jobstores))
+    """Запуск бота и его обработчиков
+
+    Режим получения обновлений (polling или webhook) задается MainSettings.UPDATE_MODE,
+    хуки запуска и остановки общие для обоих режимов.
+    Кластерный режим работает только с webhook: при polling экземпляры конкурируют за getUpdates
+    """
+    if ClusterSettings.ENABLED and MainSettings.UPDATE_MODE != 'webhook':
+        raise RuntimeError('Для CLUSTER_MODE необходим UPDATE_MODE=webhook: при polling несколько экземпляров '
+                           'получают от Telegram ошибку 409 Conflict на getUpdates')
+
+    # Транзакция обновления фиксируется до постановки запроса в очередь отправки
+    bot.session.middleware(CommitBeforeRequestMiddleware())
+    bot.session.middleware(outbound_queue)
+    scheduler = ContextSchedulerDecorator(AsyncIOScheduler(timezone='Europe/Moscow', jobstores={'default': jobstore}))
     scheduler.ctx.add_instance(bot, declared_class=Bot)
-    scheduler.start()
+    scheduler.ctx.add_instance(jobstore, declared_class=BulkRedisJobStore)
+    # В кластерном режиме задачи выполняет только лидер, остальные планировщики стоят на паузе
+    scheduler.start(paused=ClusterSettings.ENABLED)
+    dp.workflow_data.update(scheduler=scheduler, jobstore=jobstore)
 
     dp.update.middleware.register(ApschedulerMiddleware(scheduler))
 
+    if ClusterSettings.ENABLED:
+        redis = get_redis()
+        dp.update.outer_middleware.register(UpdateDeduplicationMiddleware(redis, ClusterSettings.UPDATE_DEDUP_TTL))
+        dp.update.middleware.register(UserLockMiddleware(redis, ClusterSettings.USER_LOCK_TIMEOUT,
+                                                         ClusterSettings.USER_LOCK_WAIT))
+        leader_election = SchedulerLeaderElection(scheduler, redis, ClusterSettings.INSTANCE_ID,
+                                                  ClusterSettings.LEADER_TTL, ClusterSettings.LEADER_RENEW_INTERVAL)
+        dp.startup.register(leader_election.start)
+        dp.shutdown.register(leader_election.stop)
+
+    # Одна сессия БД на обновление, открывается после блокировки пользователя
+    dp.update.middleware.register(DbSessionMiddleware())
+
+    if MetricsSettings.ENABLED:
+        dp.message.middleware(HandlerMetricsMiddleware())
+        dp.callback_query.middleware(HandlerMetricsMiddleware())
+        metrics_server = MetricsServer(MetricsSettings.HOST, MetricsSettings.PORT)
+        dp.startup.register(metrics_server.start)
+        dp.shutdown.register(metrics_server.stop)
+
     dp.startup.register(start_bot_sup_handler)
     dp.shutdown.register(stop_bot_sup_handler)
 
+    register_handlers(dp)
+
+    if MainSettings.UPDATE_MODE == 'webhook':
+        await run_webhook(bot, dp)
+        return
+
+    await bot.delete_webhook()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await bot.session.close()
+
+
+def register_handlers(dp: Dispatcher):
+    """Регистрация обработчиков сообщений и нажатий на кнопки"""
     dp.callback_query.register(process_simple_calendar, SimpleCalendarCallback.filter()) # от календаря
     dp.callback_query.register(choose_time_for_workout_handler, F.data.startswith('choose_')) # выбор времени тренировки
     dp.callback_query.register(set_time_for_workout, F.data.startswith('time_')) # выбор времени тренировки
     dp.callback_query.register(inspect_workout, F.data.startswith('walks_')) # проверка информации о тренировки
     dp.callback_query.register(delete_workout_kb_handler, F.data.startswith('delete_')) # удаление тренировки админом
+    dp.callback_query.register(all_workouts_page_handler, F.data.startswith('swpg_')) # страницы доступных тренировок
     dp.callback_query.register(check_workout_kb_handler, F.data.startswith('check_')) # проверка присутствия
+    dp.callback_query.register(moderate_workout_page_handler, F.data.startswith('chpg_')) # страницы проверки присутствия
+    dp.callback_query.register(roster_toggle_handler, F.data.startswith('rost_')) # отметка участника в списке
+    dp.callback_query.register(roster_save_handler, F.data.startswith('rsave_')) # сохранение отметок списка
+    dp.callback_query.register(roster_page_handler, F.data.startswith('rpg_')) # страницы списка участников
+    dp.callback_query.register(check_workout_photos_handler, F.data.startswith('checkph_')) # проверка по одному
     dp.callback_query.register(user_status_change_kb_handler, F.data.startswith('stat_')) # изменение статуса
 
     dp.callback_query.register(sign_up_workout_to_db, F.data.startswith('signup_')) # запись на тренировку
+    dp.callback_query.register(join_waitlist_handler, F.data.startswith('wait_')) # лист ожидания тренировки
+    dp.callback_query.register(choose_workout_page_handler, F.data.startswith('supg_')) # страницы записи на тренировку
     dp.callback_query.register(no_available_workout_handler, F.data == 'None') # нет доступных тренировок
     dp.callback_query.register(give_up_handler, F.data.startswith('giveup_')) # отмена записи на тренировку
     dp.callback_query.register(delete_registration, F.data.startswith('delMy_')) # проверка подтверждения удаления
+    dp.callback_query.register(my_registrations_page_handler, F.data.startswith('mypg_')) # страницы записей пользователя
 
     dp.message.register(add_workout, Command(commands='add_walk'), IsAdmin())
     dp.message.register(custom_time_handler, ChooseWorkoutTimeState.CHOOSE_TIME)
     dp.message.register(show_walks_handler, Command(commands='show_walk'))
     dp.message.register(check_workouts, Command(commands='check_walks'), IsAdmin())
+    dp.message.register(delivery_stats_handler, Command(commands='queue_stats'), IsAdmin())
+    dp.message.register(set_capacity_handler, Command(commands='set_capacity'), IsAdmin())
+    dp.message.register(stats_handler, Command(commands='stats'), IsAdmin())
+    dp.message.register(export_handler, Command(commands='export'), IsAdmin())
+    dp.message.register(add_schedule_handler, Command(commands='add_schedule'), IsAdmin())
+    dp.message.register(schedules_handler, Command(commands='schedules'), IsAdmin())
+    dp.message.register(stop_schedule_handler, Command(commands='stop_schedule'), IsAdmin())
 
     dp.message.register(start_handler, Command(commands='start'))
     dp.message.register(show_my_registrations, Command(commands='my_walks'))
@@ -79,11 +151,7 @@ async def start_bot(bot: Bot, dp: Dispatcher):
 
     # dp.message.register(is_admin_test, IsAdmin())
 
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await bot.session.close()
-
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(start_bot(init_bot, dispatcher))
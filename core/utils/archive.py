@@ -0,0 +1,49 @@
+"""
+Модуль периодического переноса прошедших тренировок в архив
+"""
+import calendar
+import logging
+from datetime import datetime
+from time import perf_counter
+
+from apscheduler.schedulers.base import BaseScheduler
+
+from database.requests import ArchiveRequests
+from loader import ArchiveSettings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_JOB_ID = 'workouts_archive'
+
+
+def schedule_archive(scheduler: BaseScheduler) -> None:
+    """Ежедневная задача переноса тренировок в архив в ArchiveSettings.HOUR часов"""
+    scheduler.add_job(archive_old_workouts,
+                      trigger='cron',
+                      hour=ArchiveSettings.HOUR,
+                      id=ARCHIVE_JOB_ID,
+                      replace_existing=True)
+
+
+async def archive_old_workouts() -> int:
+    """
+    Перенос в архив тренировок старше ArchiveSettings.MONTHS месяцев
+
+    Каждая порция переносится в своей транзакции, поэтому блокировки держатся недолго
+    :return: количество перенесенных тренировок
+    """
+    started = perf_counter()
+    before = months_before(datetime.now(), ArchiveSettings.MONTHS)
+    total = 0
+    while moved := await ArchiveRequests.archive_workouts(before, ArchiveSettings.BATCH_SIZE):
+        total += moved
+    logger.info('В архив перенесено тренировок до %s: %s за %.0f мс', before.strftime('%d.%m.%Y'), total,
+                (perf_counter() - started) * 1000)
+    return total
+
+
+def months_before(moment: datetime, months: int) -> datetime:
+    """Та же дата months месяцев назад (последний день месяца, если такого числа нет)"""
+    year, month = divmod(moment.year * 12 + moment.month - 1 - months, 12)
+    day = min(moment.day, calendar.monthrange(year, month + 1)[1])
+    return moment.replace(year=year, month=month + 1, day=day)
@@ -0,0 +1,30 @@
+"""
+Модуль периодического пересчета статистики посещаемости
+"""
+import logging
+from time import perf_counter
+
+from apscheduler.schedulers.base import BaseScheduler
+
+from database.requests import AttendanceRequests
+from loader import StatsSettings
+
+logger = logging.getLogger(__name__)
+
+STATS_REBUILD_JOB_ID = 'attendance_stats_rebuild'
+
+
+def schedule_stats_rebuild(scheduler: BaseScheduler) -> None:
+    """Ежедневная задача полного пересчета статистики в StatsSettings.REBUILD_HOUR часов"""
+    scheduler.add_job(rebuild_attendance_stats,
+                      trigger='cron',
+                      hour=StatsSettings.REBUILD_HOUR,
+                      id=STATS_REBUILD_JOB_ID,
+                      replace_existing=True)
+
+
+async def rebuild_attendance_stats() -> None:
+    """Полный пересчет attendance_stats по текущим записям registrations и архиву attendance_history"""
+    started = perf_counter()
+    rows = await AttendanceRequests.rebuild_stats()
+    logger.info('Статистика посещаемости пересчитана за %.0f мс, строк: %s', (perf_counter() - started) * 1000, rows)
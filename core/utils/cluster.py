@@ -0,0 +1,95 @@
+"""
+Модуль работы нескольких экземпляров бота
+
+Задачи планировщика выполняет только один экземпляр - лидер, выбранный через Redis
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from apscheduler_di import ContextSchedulerDecorator
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+# Продление ключа своим владельцем или захват свободного ключа
+ACQUIRE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Удаление ключа, только если он принадлежит этому экземпляру
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SchedulerLeaderElection:
+    """
+    Выбор лидера для выполнения задач AsyncIOScheduler
+
+    Лидер держит ключ в Redis с временем жизни ttl и продлевает его каждые renew_interval секунд.
+    Планировщики остальных экземпляров стоят на паузе: задачи в общее хранилище они добавляют,
+    но не выполняют. Лидер периодически будит планировщик, чтобы увидеть задачи других экземпляров
+    """
+    KEY = 'scheduler:leader'
+
+    def __init__(self, scheduler: ContextSchedulerDecorator, redis: Redis, instance_id: str,
+                 ttl: int, renew_interval: int):
+        self.scheduler = scheduler
+        self.redis = redis
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Запуск фонового цикла выборов"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка цикла выборов и освобождение лидерства"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self.redis.eval(RELEASE_SCRIPT, 1, self.KEY, self.instance_id)
+            self._set_leader(False)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                acquired = await self.redis.eval(ACQUIRE_SCRIPT, 1, self.KEY, self.instance_id, self.ttl * 1000)
+            except Exception as e:  # без связи с Redis лидерство не подтверждено
+                logger.warning('Не удалось продлить лидерство планировщика: %s', e)
+                acquired = False
+
+            self._set_leader(bool(acquired))
+            if self.is_leader:
+                self.scheduler.wakeup()
+            await asyncio.sleep(self.renew_interval)
+
+    def _set_leader(self, is_leader: bool) -> None:
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        if is_leader:
+            logger.info('Экземпляр %s стал лидером планировщика', self.instance_id)
+            self.scheduler.resume()
+        else:
+            logger.info('Экземпляр %s больше не лидер планировщика', self.instance_id)
+            self.scheduler.pause()
@@ -0,0 +1,275 @@
+"""
+Модуль исходящей доставки сообщений
+
+Все отправки бота в чаты проходят через OutboundQueue - middleware сессии бота.
+Запросы ставятся в очередь с приоритетом и выполняются с учетом ограничений Telegram:
+общего (около 30 сообщений в секунду) и для одного чата (около 1 сообщения в секунду)
+"""
+import asyncio
+import itertools
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (TelegramMethod, SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage,
+                             ForwardMessage, EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+from loader import DeliverySettings
+
+logger = logging.getLogger(__name__)
+
+# Методы, на которые распространяются ограничения Telegram на отправку сообщений
+QUEUED_METHODS = (SendMessage, SendPhoto, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+                  EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+PRIORITY_INTERACTIVE = 0  # ответы пользователю на его действия
+PRIORITY_BROADCAST = 10  # рассылки и напоминания
+
+_priority: ContextVar[int] = ContextVar('delivery_priority', default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def broadcast_priority():
+    """Отправки внутри блока уступают очередь ответам пользователям"""
+    token = _priority.set(PRIORITY_BROADCAST)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты отправки
+
+    Токены пополняются со скоростью rate в секунду до capacity. Токен резервируется сразу,
+    даже если его еще нет - тогда reserve() возвращает время, через которое он появится
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает время ожидания до него в секундах"""
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def postpone(self, seconds: float) -> None:
+        """Запрещает отправку на seconds секунд (ответ Telegram RetryAfter)"""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        """Ограничитель полон - его можно удалить без потери состояния"""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+@dataclass(order=True)
+class _Delivery:
+    """Запрос в очереди отправки"""
+    priority: int
+    seq: int
+    bot: Bot = field(compare=False)
+    method: TelegramMethod = field(compare=False)
+    make_request: NextRequestMiddlewareType = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    key: Optional[Tuple[str, str]] = field(compare=False, default=None)
+    enqueued_at: float = field(compare=False, default_factory=monotonic)
+    attempts: int = field(compare=False, default=0)
+    chat_reserved: bool = field(compare=False, default=False)
+
+    @property
+    def chat_id(self) -> Union[int, str, None]:
+        return getattr(self.method, 'chat_id', None)
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """
+    Очередь исходящих сообщений бота
+
+    Подключается через bot.session.middleware(...). Запросы из QUEUED_METHODS выполняются
+    воркерами в порядке приоритета, остальные запросы проходят без очереди.
+    Одинаковые запросы, ожидающие отправки, схлопываются в один.
+    При ответе RetryAfter запрос повторяется после указанной паузы
+    """
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, workers: int, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._chat_buckets: Dict[Union[int, str], TokenBucket] = {}
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._seq = itertools.count()
+        self._delayed = 0
+        self._in_flight = 0
+        self._latencies = deque(maxlen=1000)
+        self.counters = {'sent': 0, 'failed': 0, 'retried': 0, 'collapsed': 0}
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        if not self._worker_tasks or not isinstance(method, QUEUED_METHODS):
+            return await make_request(bot, method)
+
+        key = self._collapse_key(method)
+        if key in self._pending:
+            self.counters['collapsed'] += 1
+            return await asyncio.shield(self._pending[key])
+
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._pending[key] = future
+        self._queue.put_nowait(_Delivery(_priority.get(), next(self._seq), bot, method, make_request, future, key))
+        return await asyncio.shield(future)
+
+    def start(self) -> None:
+        """Запуск воркеров очереди"""
+        if self._worker_tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Остановка воркеров после отправки уже поставленных в очередь сообщений"""
+        if not self._worker_tasks:
+            return
+        deadline = monotonic() + timeout
+        while (self.depth or self._in_flight) and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            logger.warning('Очередь отправки остановлена, не отправлено: %s', self.depth)
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    @property
+    def depth(self) -> int:
+        """Количество сообщений, ожидающих отправки"""
+        return (self._queue.qsize() if self._queue else 0) + self._delayed
+
+    def stats(self) -> Dict[str, float]:
+        """Текущее состояние очереди: глубина, счетчики и задержка доставки в мс"""
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'delayed': self._delayed,
+            'in_flight': self._in_flight,
+            **self.counters,
+            'latency_p50_ms': round(percentile(0.5), 1),
+            'latency_p95_ms': round(percentile(0.95), 1),
+            'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        }
+
+    async def _worker(self) -> None:
+        while True:
+            delivery = await self._queue.get()
+            try:
+                await self._deliver(delivery)
+            except Exception as e:  # воркер не должен останавливаться из-за одного запроса
+                self._finish(delivery, exception=e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, delivery: _Delivery) -> None:
+        if not delivery.chat_reserved:
+            delay = self._chat_bucket(delivery.chat_id).reserve()
+            if delay > 0:
+                # Чат исчерпал лимит - сообщение вернется в очередь, воркер не простаивает
+                delivery.chat_reserved = True
+                self._requeue_later(delivery, delay)
+                return
+
+        await asyncio.sleep(self.global_bucket.reserve())
+        delivery.chat_reserved = False
+
+        self._in_flight += 1
+        try:
+            result = await delivery.make_request(delivery.bot, delivery.method)
+        except TelegramRetryAfter as e:
+            if delivery.attempts >= self.max_retries:
+                self._finish(delivery, exception=e)
+                return
+            delivery.attempts += 1
+            self.counters['retried'] += 1
+            logger.warning('Telegram RetryAfter %s с для чата %s', e.retry_after, delivery.chat_id)
+            self._chat_bucket(delivery.chat_id).postpone(e.retry_after)
+            delivery.chat_reserved = True
+            self._requeue_later(delivery, e.retry_after)
+        except Exception as e:
+            self._finish(delivery, exception=e)
+        else:
+            self._finish(delivery, result=result)
+        finally:
+            self._in_flight -= 1
+
+    def _finish(self, delivery: _Delivery, result: Any = None, exception: Optional[BaseException] = None) -> None:
+        if delivery.key is not None:
+            self._pending.pop(delivery.key, None)
+        if delivery.future.done():
+            return
+
+        if exception is None:
+            self.counters['sent'] += 1
+            self._latencies.append(monotonic() - delivery.enqueued_at)
+            delivery.future.set_result(result)
+        else:
+            self.counters['failed'] += 1
+            delivery.future.set_exception(exception)
+
+    def _requeue_later(self, delivery: _Delivery, delay: float) -> None:
+        self._delayed += 1
+
+        def requeue():
+            self._delayed -= 1
+            self._queue.put_nowait(delivery)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    def _chat_bucket(self, chat_id: Union[int, str, None]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10_000:
+                self._chat_buckets = {chat: b for chat, b in self._chat_buckets.items() if not b.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    def _collapse_key(method: TelegramMethod) -> Optional[Tuple[str, str]]:
+        """Ключ для схлопывания одинаковых запросов; None, если запрос нельзя сравнить (файлы)"""
+        try:
+            return type(method).__name__, method.model_dump_json(exclude_defaults=True)
+        except ValueError:
+            return None
+
+
+outbound_queue = OutboundQueue(global_rate=DeliverySettings.GLOBAL_RATE,
+                               chat_rate=DeliverySettings.CHAT_RATE,
+                               chat_burst=DeliverySettings.CHAT_BURST,
+                               workers=DeliverySettings.WORKERS,
+                               max_retries=DeliverySettings.MAX_RETRIES)
@@ -0,0 +1,132 @@
+"""
+Модуль выгрузки записей на тренировки в CSV/XLSX
+
+Строки читаются из БД порциями через курсор на стороне сервера и сразу дописываются в
+SpooledTemporaryFile: пока файл небольшой, он хранится в памяти, затем переносится на диск.
+Запись в файл и чтение из него выполняются в потоке (asyncio.to_thread), чтобы не блокировать цикл событий.
+XLSX требует пакета openpyxl, он импортируется только при выгрузке в этом формате
+"""
+import asyncio
+import csv
+import io
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import AsyncGenerator, Optional, Sequence, Tuple
+
+from aiogram import Bot
+from aiogram.types import InputFile
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.requests import RegistrationRequests
+from loader import ExportSettings
+
+COLUMNS = ('ID записи', 'Дата записи', 'ID тренировки', 'Дата тренировки', 'Тип тренировки',
+           'ID пользователя', 'Имя', 'Статус', 'Оплачено')
+DATE_FORMAT = '%d.%m.%Y %H:%M'
+FORMATS = ('csv', 'xlsx')
+
+
+def format_payed(is_payed: Optional[bool]) -> str:
+    if is_payed is None:
+        return ''
+    return 'да' if is_payed else 'нет'
+
+
+class CsvWriter:
+    """Построчная запись в CSV: UTF-8 с BOM и разделитель ';' - файл открывается в Excel без настройки"""
+    def __init__(self, file: SpooledTemporaryFile):
+        self._text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        self._writer = csv.writer(self._text, delimiter=';')
+        self._writer.writerow(COLUMNS)
+
+    def write_rows(self, rows: Sequence[Row]) -> None:
+        self._writer.writerows(
+            (row.registration_id, _format_date(row.registered_at), row.workout_id, _format_date(row.date),
+             row.type_name, row.user_id, row.name, row.status_name, format_payed(row.is_payed))
+            for row in rows)
+
+    def close(self) -> None:
+        # detach оставляет файл открытым для отправки
+        self._text.flush()
+        self._text.detach()
+
+
+class XlsxWriter:
+    """Запись в XLSX книгой openpyxl в режиме write_only: строки не накапливаются в памяти"""
+    def __init__(self, file: SpooledTemporaryFile):
+        from openpyxl import Workbook
+
+        self._file = file
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet('Записи')
+        self._sheet.append(COLUMNS)
+
+    def write_rows(self, rows: Sequence[Row]) -> None:
+        for row in rows:
+            self._sheet.append((row.registration_id, row.registered_at, row.workout_id, row.date, row.type_name,
+                                row.user_id, row.name, row.status_name, format_payed(row.is_payed)))
+
+    def close(self) -> None:
+        self._workbook.save(self._file)
+
+
+WRITERS = {'csv': CsvWriter, 'xlsx': XlsxWriter}
+
+
+def xlsx_available() -> bool:
+    """Установлен ли openpyxl для выгрузки в XLSX"""
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class SpooledInputFile(InputFile):
+    """
+    Документ для отправки из SpooledTemporaryFile
+
+    Файл читается порциями с начала при каждой отправке, поэтому повторная попытка отправляет его целиком
+    """
+    def __init__(self, file: SpooledTemporaryFile, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        await asyncio.to_thread(self.file.seek, 0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+
+async def export_registrations(date_from: datetime, date_to: datetime, file_format: str,
+                               session: Optional[AsyncSession] = None) -> Tuple[SpooledInputFile, int]:
+    """
+    Выгрузка записей на тренировки за период в файл
+
+    Файл нужно закрыть после отправки (input_file.file.close())
+    :param date_from: начало периода, включительно
+    :param date_to: конец периода, не включительно
+    :param file_format: csv или xlsx
+    :param session:
+    :return: (документ для отправки, количество строк)
+    """
+    file = SpooledTemporaryFile(max_size=ExportSettings.SPOOL_MAX_SIZE)
+    try:
+        writer = await asyncio.to_thread(WRITERS[file_format], file)
+        rows_count = 0
+        async for rows in RegistrationRequests.stream_registrations(date_from, date_to, ExportSettings.CHUNK_SIZE,
+                                                                    session=session):
+            await asyncio.to_thread(writer.write_rows, rows)
+            rows_count += len(rows)
+        await asyncio.to_thread(writer.close)
+    except BaseException:
+        file.close()
+        raise
+
+    filename = f'registrations_{date_from:%Y%m%d}_{date_to:%Y%m%d}.{file_format}'
+    return SpooledInputFile(file, filename), rows_count
+
+
+def _format_date(value: Optional[datetime]) -> str:
+    return value.strftime(DATE_FORMAT) if value else ''
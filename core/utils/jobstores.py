@@ -0,0 +1,92 @@
+"""
+Модуль хранилища задач планировщика
+"""
+import pickle
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Tuple
+from urllib.parse import urlparse
+
+from apscheduler.job import Job
+from apscheduler.jobstores.redis import RedisJobStore
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.util import datetime_to_utc_timestamp, convert_to_datetime
+
+from loader import RedisSettings
+
+# (id задачи, функция, время запуска, kwargs)
+DateJobSpec = Tuple[str, Callable, datetime, Dict[str, Any]]
+
+
+class BulkRedisJobStore(RedisJobStore):
+    """
+    RedisJobStore с пакетными операциями
+
+    Позволяет прочитать, создать и удалить множество задач за одно обращение к Redis
+    """
+
+    def get_run_times(self) -> Dict[str, float]:
+        """Все запланированные задачи и время их запуска (UTC timestamp) одним запросом"""
+        return {job_id.decode(): run_time
+                for job_id, run_time in self.redis.zrange(self.run_times_key, 0, -1, withscores=True)}
+
+    def to_timestamp(self, run_date: datetime) -> float:
+        """UTC timestamp времени запуска в часовом поясе планировщика, как он хранится в Redis"""
+        return datetime_to_utc_timestamp(convert_to_datetime(run_date, self._scheduler.timezone, 'run_date'))
+
+    def add_date_jobs(self, specs: Iterable[DateJobSpec]) -> int:
+        """
+        Создание или замена одноразовых задач одним pipeline
+
+        Зависимости функций (bot) подставляются apscheduler_di при запуске задачи,
+        поэтому в kwargs их передавать не нужно
+        :return: количество сохраненных задач
+        """
+        scheduler = self._scheduler
+        saved = 0
+        with self.redis.pipeline() as pipe:
+            for job_id, func, run_date, kwargs in specs:
+                trigger = DateTrigger(run_date, timezone=scheduler.timezone)
+                job = Job(scheduler,
+                          id=job_id,
+                          func=func,
+                          trigger=trigger,
+                          executor='default',
+                          args=(),
+                          kwargs={'bot': None, **kwargs},  # проверка сигнатуры функции при создании Job
+                          name=func.__name__,
+                          next_run_time=trigger.run_date,
+                          **scheduler._job_defaults)
+                job.kwargs = kwargs
+                pipe.hset(self.jobs_key, job.id, pickle.dumps(job.__getstate__(), self.pickle_protocol))
+                pipe.zadd(self.run_times_key, {job.id: datetime_to_utc_timestamp(job.next_run_time)})
+                saved += 1
+            pipe.execute()
+        return saved
+
+    def wakeup_scheduler(self) -> None:
+        """Пересчет времени ближайшего запуска после пакетного добавления задач"""
+        self._scheduler.wakeup()
+
+    def remove_jobs(self, job_ids: Iterable[str]) -> None:
+        """Удаление задач одним pipeline"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self.redis.pipeline() as pipe:
+            pipe.hdel(self.jobs_key, *job_ids)
+            pipe.zrem(self.run_times_key, *job_ids)
+            pipe.execute()
+
+
+def create_jobstore() -> BulkRedisJobStore:
+    """Хранилище задач в Redis по адресу RedisSettings.REDIS_HOST и базе RedisSettings.JOBS_DB"""
+    url = urlparse(RedisSettings.REDIS_HOST)
+    return BulkRedisJobStore(
+        jobs_key='dispatcher_trips_jobs',
+        run_times_key='dispatcher_trips_running',
+        db=RedisSettings.JOBS_DB,
+        host=url.hostname or 'localhost',
+        port=url.port or 6379,
+        username=url.username,
+        password=url.password,
+    )
@@ -0,0 +1,121 @@
+"""
+Модуль общего кэша готовых inline-клавиатур
+
+Клавиатура, одинаковая для всех пользователей, строится один раз и хранится в Redis в виде JSON
+под номером версии содержимого. Изменение данных (создание и удаление тренировок, изменение
+количества мест) увеличивает версию, и следующий запрос строит клавиатуру заново.
+Часто меняющиеся числа (свободные места) в клавиатуру не входят: вместе с ней хранится список id,
+и тот же скрипт читает их счетчики. Запись на тренировку поэтому версию не меняет, а версия,
+клавиатура и счетчики читаются одним обращением к Redis - кэш общий для всех экземпляров бота
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+from redis.commands.core import AsyncScript
+
+from database.cache import upcoming_workouts_cache
+from database.redis_engine import get_redis
+from loader import CacheSettings
+from utils.seats import SeatCounter, SeatsValues
+
+# Текущая версия, клавиатура этой версии и счетчики ее id:
+# {version, markup, id1, capacity1, taken1, ...} или {version}, если клавиатуры нет
+GET_SCRIPT = """
+local version = redis.call('GET', KEYS[1]) or '0'
+local markup_key = ARGV[1] .. version .. ':' .. ARGV[2]
+local markup = redis.call('GET', markup_key)
+if not markup then
+    return {version}
+end
+local result = {version, markup}
+if ARGV[3] ~= '' then
+    local ids = redis.call('GET', markup_key .. ':ids') or ''
+    for id in string.gmatch(ids, '%d+') do
+        local counter = redis.call('HMGET', ARGV[3] .. id, 'capacity', 'taken')
+        table.insert(result, id)
+        table.insert(result, counter[1])
+        table.insert(result, counter[2])
+    end
+end
+return result
+"""
+
+
+class KeyboardCache:
+    """
+    Кэш клавиатуры name в Redis
+
+    Ключи: keyboard:<name>:version - версия содержимого, keyboard:<name>:<версия>:<страница> - JSON клавиатуры,
+    keyboard:<name>:<версия>:<страница>:ids - id для чтения счетчиков <counters_prefix><id> вместе с клавиатурой.
+    Клавиатуры прежних версий никто не читает, они удаляются по истечении ttl.
+    on_change вызывается, когда экземпляр бота видит новую версию, - так сбрасываются
+    локальные кэши данных, из которых строится клавиатура
+    """
+    def __init__(self, name: str, ttl: int, on_change: Optional[Callable[[], None]] = None,
+                 counters_prefix: str = ''):
+        self.ttl = ttl
+        self.on_change = on_change
+        self.counters_prefix = counters_prefix
+        self.version_key = f'keyboard:{name}:version'
+        self.markup_prefix = f'keyboard:{name}:'
+        self._seen_version: Optional[str] = None
+        self._script: Optional[AsyncScript] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self, page: str, build: Callable[[], Awaitable[Tuple[InlineKeyboardMarkup, List[int]]]]
+                  ) -> Tuple[InlineKeyboardMarkup, SeatsValues]:
+        """
+        Клавиатура страницы page текущей версии и счетчики ее id
+
+        При отсутствии в кэше клавиатуру строит только один запрос экземпляра бота, остальные ждут его
+        :param page: ключ страницы
+        :param build: построение клавиатуры, возвращает (клавиатура, id для счетчиков)
+        :return: (клавиатура, {id: (capacity, taken)}); у только что построенной клавиатуры счетчики
+            не прочитаны - (None, None)
+        """
+        version, markup, counters = await self._read(page)
+        if markup is not None:
+            return markup, counters
+
+        async with self._lock:
+            version, markup, counters = await self._read(page)
+            if markup is not None:
+                return markup, counters
+
+            markup, ids = await build()
+            markup_key = self._markup_key(version, page)
+            async with get_redis().pipeline(transaction=True) as pipe:
+                pipe.set(markup_key, markup.model_dump_json(exclude_none=True), ex=self.ttl)
+                pipe.set(f'{markup_key}:ids', ','.join(map(str, ids)), ex=self.ttl)
+                await pipe.execute()
+            return markup, {workout_id: (None, None) for workout_id in ids}
+
+    async def bump(self) -> None:
+        """Новая версия содержимого: клавиатуры всех страниц будут построены заново"""
+        await get_redis().incr(self.version_key)
+
+    async def _read(self, page: str) -> Tuple[str, Optional[InlineKeyboardMarkup], SeatsValues]:
+        if self._script is None:
+            self._script = get_redis().register_script(GET_SCRIPT)
+        version, *cached = await self._script(keys=[self.version_key],
+                                              args=[self.markup_prefix, page, self.counters_prefix])
+
+        if version != self._seen_version:
+            self._seen_version = version
+            if self.on_change is not None:
+                self.on_change()
+
+        if not cached:
+            return version, None, {}
+        counters: Dict[int, Tuple[Optional[str], Optional[str]]] = {
+            int(cached[i]): (cached[i + 1], cached[i + 2]) for i in range(1, len(cached), 3)}
+        return version, InlineKeyboardMarkup.model_validate_json(cached[0]), counters
+
+    def _markup_key(self, version: str, page: str) -> str:
+        return f'{self.markup_prefix}{version}:{page}'
+
+
+sign_up_keyboard_cache = KeyboardCache('sign_up', CacheSettings.KEYBOARD_TTL,
+                                       on_change=upcoming_workouts_cache.invalidate,
+                                       counters_prefix=SeatCounter.KEY_PREFIX)
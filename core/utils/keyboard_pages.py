@@ -0,0 +1,48 @@
+"""
+Модуль кнопок перелистывания страниц inline-клавиатур
+
+Кнопка хранит в callback_data направление и ключ (date, workout_id) крайней строки текущей страницы:
+<prefix>_<p|n>_<дата ГГГГММДДччммссмкс>_<workout_id>. Такая строка укладывается в лимит Telegram 64 байта
+"""
+from datetime import datetime
+from typing import Tuple
+
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from database.pagination import Page, PageCursor
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+PREV, NEXT = 'p', 'n'
+
+
+def page_callback_data(prefix: str, direction: str, cursor: PageCursor) -> str:
+    """callback_data кнопки перехода на соседнюю страницу"""
+    return f'{prefix}_{direction}_{cursor.date.strftime(CURSOR_DATE_FORMAT)}_{cursor.workout_id}'
+
+
+def parse_page_callback(data: str) -> Tuple[PageCursor, bool]:
+    """
+    Разбор callback_data кнопки перелистывания
+
+    :return: (ключ страницы, перелистывание назад)
+    """
+    _, direction, date, workout_id = data.split('_')
+    return PageCursor(datetime.strptime(date, CURSOR_DATE_FORMAT), int(workout_id)), direction == PREV
+
+
+def add_page_buttons(builder: InlineKeyboardBuilder, prefix: str, page: Page) -> None:
+    """
+    Добавление строки кнопок "назад/вперед" в конец клавиатуры
+
+    Вызывается после builder.adjust: кнопки добавляются отдельной строкой
+    """
+    buttons = []
+    if page.prev_cursor is not None:
+        buttons.append(InlineKeyboardButton(text='⬅️ Назад',
+                                            callback_data=page_callback_data(prefix, PREV, page.prev_cursor)))
+    if page.next_cursor is not None:
+        buttons.append(InlineKeyboardButton(text='Вперед ➡️',
+                                            callback_data=page_callback_data(prefix, NEXT, page.next_cursor)))
+    if buttons:
+        builder.row(*buttons)
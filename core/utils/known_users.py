@@ -0,0 +1,73 @@
+"""
+Модуль реестра известных боту пользователей
+
+Повторный /start от уже зарегистрированного пользователя не обращается к БД, если имя не изменилось,
+и не вызывает setMyCommands, если этот набор команд ему уже установлен.
+Реестр хранится в памяти процесса и в Redis, чтобы другие экземпляры бота и перезапуски видели
+уже установленные команды
+"""
+from typing import Awaitable, Callable, Dict, Optional
+
+from database.redis_engine import get_redis
+
+
+class KnownUsers:
+    """
+    Реестр пользователей: имя, записанное в БД, и установленный набор команд меню
+
+    В Redis - хэши known_users:names и known_users:commands с полями user_id.
+    При запуске имена загружаются из таблицы users и заменяют хэш имен в Redis (БД могла быть пересоздана),
+    наборы команд загружаются из Redis
+    """
+    NAMES_KEY = 'known_users:names'
+    COMMANDS_KEY = 'known_users:commands'
+
+    def __init__(self):
+        self._names: Dict[int, str] = {}
+        self._commands: Dict[int, str] = {}
+
+    async def warm_up(self, load_names: Callable[[], Awaitable[Dict[int, str]]]) -> None:
+        """
+        Заполнение реестра при запуске бота
+
+        :param load_names: загрузка {user_id: name} из БД
+        """
+        self._names = await load_names()
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.delete(self.NAMES_KEY)
+        if self._names:
+            pipe.hset(self.NAMES_KEY, mapping={str(user_id): name for user_id, name in self._names.items()})
+        pipe.hgetall(self.COMMANDS_KEY)
+        *_, commands = await pipe.execute()
+        self._commands = {int(user_id): command_set for user_id, command_set in commands.items()}
+
+    async def is_saved(self, user_id: int, name: str) -> bool:
+        """Пользователь уже есть в БД с таким именем"""
+        return await self._get(self._names, self.NAMES_KEY, user_id) == name
+
+    async def mark_saved(self, user_id: int, name: str) -> None:
+        """Запоминание пользователя после записи в БД"""
+        self._names[user_id] = name
+        await get_redis().hset(self.NAMES_KEY, str(user_id), name)
+
+    async def has_commands(self, user_id: int, command_set: str) -> bool:
+        """Набор команд меню command_set уже установлен пользователю"""
+        return await self._get(self._commands, self.COMMANDS_KEY, user_id) == command_set
+
+    async def mark_commands(self, user_id: int, command_set: str) -> None:
+        """Запоминание набора команд после установки меню"""
+        self._commands[user_id] = command_set
+        await get_redis().hset(self.COMMANDS_KEY, str(user_id), command_set)
+
+    @staticmethod
+    async def _get(local: Dict[int, str], key: str, user_id: int) -> Optional[str]:
+        """Значение из памяти, при отсутствии - из Redis (запись мог сделать другой экземпляр бота)"""
+        value = local.get(user_id)
+        if value is None:
+            value = await get_redis().hget(key, str(user_id))
+            if value is not None:
+                local[user_id] = value
+        return value
+
+
+known_users = KnownUsers()
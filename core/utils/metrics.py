@@ -0,0 +1,223 @@
+"""
+Модуль метрик бота в формате Prometheus
+
+Собирает задержки обработчиков, время SQL-запросов с привязкой к методу *Requests и время получения
+соединения из пула. Метрики отдаются aiohttp-сервером по адресу /metrics (MetricsSettings)
+"""
+import functools
+import inspect
+import logging
+import weakref
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Message, CallbackQuery
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from loader import MetricsSettings
+from utils.delivery import outbound_queue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Метод *Requests, выполняющий текущие SQL-запросы
+_query_source: ContextVar[str] = ContextVar('query_source', default='other')
+
+
+class Histogram:
+    """
+    Гистограмма Prometheus с метками
+
+    Для каждого набора значений меток хранит количество попаданий в корзины, сумму и число наблюдений
+    """
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            # len(buckets) + 1 корзин (последняя - +Inf), затем сумма и количество
+            series = self._series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {series[-2]}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {series[-1]}')
+        return lines
+
+    def _labels(self, values: Tuple[str, ...], **extra: Any) -> str:
+        pairs = [*zip(self.labelnames, values), *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(str(value))}"' for name, value in pairs) + '}'
+
+
+def escape_label(value: str) -> str:
+    """Экранирование значения метки по правилам текстового формата Prometheus"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_gauge(name: str, documentation: str, value: float) -> List[str]:
+    """Строки метрики-gauge без меток"""
+    return [f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {value}']
+
+
+handler_duration = Histogram('bot_handler_duration_seconds', 'Время обработки события обработчиком',
+                             ('handler', 'prefix', 'status'))
+sql_duration = Histogram('bot_sql_duration_seconds', 'Время выполнения SQL-запроса', ('source',), SQL_BUCKETS)
+pool_checkout_duration = Histogram('bot_db_pool_checkout_seconds', 'Время получения соединения из пула',
+                                   buckets=SQL_BUCKETS)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    inner-middleware, замеряющее время работы обработчиков
+
+    Метка prefix - команда сообщения или префикс callback_data до первого '_'
+    """
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        status = 'error'
+        started = perf_counter()
+        try:
+            result = await handler(event, data)
+            status = 'ok'
+            return result
+        finally:
+            handler_duration.observe(perf_counter() - started, name, self._prefix(event), status)
+
+    @staticmethod
+    def _prefix(event: TelegramObject) -> str:
+        if isinstance(event, CallbackQuery) and event.data:
+            return event.data.split('_')[0]
+        if isinstance(event, Message) and event.text and event.text.startswith('/'):
+            return event.text.split()[0]
+        return ''
+
+
+def tag_queries(cls: type) -> type:
+    """
+    Декоратор класса *Requests: SQL-запросы его асинхронных статических методов
+    помечаются именем метода, например WorkoutsRequests.show_workouts
+    """
+    for name, attr in list(vars(cls).items()):
+        if isinstance(attr, staticmethod) and inspect.iscoroutinefunction(attr.__func__):
+            setattr(cls, name, staticmethod(_tagged(attr.__func__, f'{cls.__name__}.{name}')))
+    return cls
+
+
+def _tagged(func: Callable[..., Awaitable[Any]], source: str) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _query_source.set(source)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _query_source.reset(token)
+    return wrapper
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Подписка на события выполнения запросов двигателя
+
+    :param engine: синхронный двигатель (AsyncEngine.sync_engine)
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    elapsed = perf_counter() - conn.info['query_started'].pop()
+    source = _query_source.get()
+    sql_duration.observe(elapsed, source)
+
+    if MetricsSettings.SLOW_QUERY_MS and elapsed * 1000 >= MetricsSettings.SLOW_QUERY_MS:
+        logger.warning('Медленный запрос %s: %.1f мс\n%s', source, elapsed * 1000, statement[:1000])
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений, замеряющий время ожидания соединения"""
+    instances: 'weakref.WeakSet[TimedQueuePool]' = weakref.WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        TimedQueuePool.instances.add(self)
+
+    def connect(self):
+        started = perf_counter()
+        try:
+            return super().connect()
+        finally:
+            pool_checkout_duration.observe(perf_counter() - started)
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for histogram in (handler_duration, sql_duration, pool_checkout_duration):
+        lines.extend(histogram.render())
+
+    for pool in TimedQueuePool.instances:
+        lines.extend(render_gauge('bot_db_pool_checked_out', 'Соединений пула в работе', pool.checkedout()))
+        lines.extend(render_gauge('bot_db_pool_size', 'Размер пула соединений', pool.size()))
+
+    for key, value in outbound_queue.stats().items():
+        lines.extend(render_gauge(f'bot_outbound_{key}', f'Очередь отправки: {key}', value))
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+
+class MetricsServer:
+    """HTTP-сервер для сбора метрик Prometheus"""
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info('Метрики доступны на http://%s:%s/metrics', self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
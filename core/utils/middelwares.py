@@ -1,12 +1,27 @@
 """
-Модуль для передачи scheduler в обработчики
+Модуль middleware: передача scheduler и сессии БД в обработчики, работа нескольких экземпляров бота
 """
+import asyncio
 import dataclasses
-from typing import Any, Callable, Dict, Awaitable
+import logging
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Awaitable, Optional, Tuple
 
-from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject, Message
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject, Message, Update
 from apscheduler_di import ContextSchedulerDecorator
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.psql_engine import get_session_maker, run_after_commit
+
+logger = logging.getLogger(__name__)
+
+# Сессия обрабатываемого обновления и задача, в которой выполняется его обработчик
+_update_session: ContextVar[Optional[Tuple[AsyncSession, asyncio.Task]]] = ContextVar('update_session', default=None)
 
 
 @dataclasses.dataclass
@@ -26,4 +41,113 @@ class ApschedulerMiddleware(BaseMiddleware):
         data['scheduler'] = self.scheduler
         result = await handler(event, data)
         return result
-        # Если в хэндлере сделать return, то это значение попадёт в result
\ No newline at end of file
+        # Если в хэндлере сделать return, то это значение попадёт в result
+
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """
+    outer-middleware для пропуска обновлений, уже принятых другим экземпляром бота
+
+    update_id отмечается в Redis через SET NX с ограниченным временем жизни
+    """
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any],
+    ) -> Any:
+        is_new = await self.redis.set(f'update:{event.update_id}', 1, nx=True, ex=self.ttl)
+        if not is_new:
+            return None
+        return await handler(event, data)
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """
+    middleware для последовательной обработки обновлений одного пользователя
+
+    Пока обновление обрабатывается, пользователь заблокирован распределенной блокировкой в Redis.
+    Если блокировку не удалось получить за wait секунд, обновление обрабатывается без нее
+    """
+    def __init__(self, redis: Redis, timeout: int, wait: int):
+        self.redis = redis
+        self.timeout = timeout
+        self.wait = wait
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        lock = self.redis.lock(f'lock:user:{user.id}', timeout=self.timeout, blocking_timeout=self.wait)
+        if not await lock.acquire():
+            logger.warning('Не удалось получить блокировку пользователя %s', user.id)
+            return await handler(event, data)
+
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await lock.release()
+            except LockError:  # блокировка истекла, пока обновление обрабатывалось
+                logger.warning('Блокировка пользователя %s истекла до окончания обработки', user.id)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    middleware, открывающее одну сессию БД на обновление (unit of work)
+
+    Сессия передается обработчику в data['session'] и в методы *Requests. Транзакция фиксируется
+    после обработчика, при исключении откатывается. Соединение из пула берется при первом запросе,
+    поэтому обновления без обращения к БД его не занимают. Перед каждым запросом к Telegram открытая
+    транзакция фиксируется (CommitBeforeRequestMiddleware): соединение возвращается в пул и не ждет
+    отправки ответа в очереди, следующий запрос к БД начинает новую транзакцию
+    """
+    def __init__(self, session_maker: Optional[async_sessionmaker[AsyncSession]] = None):
+        self.session_maker = session_maker
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        session_maker = self.session_maker or get_session_maker()
+        async with session_maker() as session:
+            data['session'] = session
+            token = _update_session.set((session, asyncio.current_task()))
+            try:
+                result = await handler(event, data)
+                await session.commit()
+            finally:
+                _update_session.reset(token)
+                await run_after_commit(session)
+        return result
+
+
+class CommitBeforeRequestMiddleware(BaseRequestMiddleware):
+    """
+    middleware сессии бота: фиксация транзакции обновления перед запросом к Telegram
+
+    Подключается через bot.session.middleware(...) раньше очереди отправки. Ответы пользователю ждут
+    ограничений Telegram и повторов RetryAfter, и транзакция с соединением из пула не должна
+    удерживаться на это время. Блокировки транзакции (pg_advisory_xact_lock) снимаются тем же коммитом.
+    Фоновые задачи, созданные обработчиком, наследуют контекст, но сессию не фиксируют -
+    ею владеет только задача обработчика
+    """
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod) -> Any:
+        current = _update_session.get()
+        if current is not None:
+            session, task = current
+            if task is asyncio.current_task() and session.in_transaction():
+                await session.commit()
+        return await make_request(bot, method)
@@ -0,0 +1,112 @@
+"""
+Модуль кэширования аватарок пользователей
+
+Соответствие user_id -> file_id фотографии профиля хранится в Redis, чтобы повторные проверки
+посещаемости не обращались к getUserProfilePhotos
+"""
+import asyncio
+import logging
+from time import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from database.redis_engine import get_redis
+from loader import CacheSettings
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilePhotoCache:
+    """
+    Кэш file_id аватарок пользователей в Redis
+
+    Значение хранится в виде "<время загрузки>:<file_id>", пустой file_id означает, что фото нет.
+    Отсутствующие в кэше аватарки загружаются параллельно (не более concurrency запросов одновременно),
+    устаревшие - отдаются из кэша и обновляются в фоне
+    """
+    KEY = 'profile_photo:{user_id}'
+
+    def __init__(self, ttl: int, refresh_after: int, concurrency: int):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.concurrency = concurrency
+        self._refreshing: Set[int] = set()
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    async def get_many(self, bot: Bot, user_ids: Iterable[int]) -> Dict[int, Optional[str]]:
+        """
+        Получение file_id аватарок для списка пользователей
+
+        :param bot:
+        :param user_ids:
+        :return: {user_id: file_id или None, если фото нет}
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+
+        values = await get_redis().mget([self.KEY.format(user_id=user_id) for user_id in user_ids])
+
+        photos, missing, stale = {}, [], []
+        now = time()
+        for user_id, value in zip(user_ids, values):
+            if value is None:
+                missing.append(user_id)
+                continue
+
+            fetched_at, file_id = value.split(':', 1)
+            photos[user_id] = file_id or None
+            if now - float(fetched_at) > self.refresh_after and user_id not in self._refreshing:
+                stale.append(user_id)
+
+        if missing:
+            photos.update(await self._fetch_and_store(bot, missing))
+
+        if stale:
+            self._refresh_in_background(bot, stale)
+
+        return photos
+
+    def _refresh_in_background(self, bot: Bot, user_ids: List[int]) -> None:
+        """Фоновое обновление устаревших записей кэша"""
+        self._refreshing.update(user_ids)
+        task = asyncio.create_task(self._fetch_and_store(bot, user_ids))
+        self._background_tasks.add(task)
+
+        def on_done(done_task: asyncio.Task) -> None:
+            self._background_tasks.discard(done_task)
+            self._refreshing.difference_update(user_ids)
+            if not done_task.cancelled() and done_task.exception():
+                logger.warning('Не удалось обновить кэш аватарок', exc_info=done_task.exception())
+
+        task.add_done_callback(on_done)
+
+    async def _fetch_and_store(self, bot: Bot, user_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Загрузка аватарок из Telegram и сохранение их в Redis одним pipeline"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(user_id: int):
+            async with semaphore:
+                try:
+                    file = await bot.get_user_profile_photos(user_id, limit=1)
+                except TelegramBadRequest as e:
+                    logger.warning('Не удалось получить аватарку пользователя %s', user_id, exc_info=e)
+                    return user_id, None
+            return user_id, file.photos[0][0].file_id if file.photos else None
+
+        photos = dict(await asyncio.gather(*(fetch(user_id) for user_id in user_ids)))
+
+        now = time()
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for user_id, file_id in photos.items():
+                pipe.set(self.KEY.format(user_id=user_id), f'{now}:{file_id or ""}', ex=self.ttl)
+            await pipe.execute()
+
+        return photos
+
+
+profile_photo_cache = ProfilePhotoCache(CacheSettings.PROFILE_PHOTO_TTL,
+                                        CacheSettings.PROFILE_PHOTO_REFRESH_AFTER,
+                                        CacheSettings.PROFILE_PHOTO_FETCH_CONCURRENCY)
@@ -0,0 +1,158 @@
+"""
+Модуль напоминаний о предстоящих тренировках
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Dict, Iterable, List, Tuple
+
+from aiogram import Bot
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.base import BaseScheduler
+
+from database.requests import RegistrationRequests, WorkoutsRequests
+from loader import MainSettings, ReminderSettings
+from utils.delivery import broadcast_priority
+from utils.jobstores import BulkRedisJobStore, DateJobSpec
+
+logger = logging.getLogger(__name__)
+
+
+def reminder_job_id(workout_id: int, offset_minutes: int) -> str:
+    """Идентификатор задачи напоминания в планировщике"""
+    return f'reminder_{workout_id}_{offset_minutes}'
+
+
+def format_offset(offset_minutes: int) -> str:
+    """Человекочитаемое время до тренировки"""
+    if offset_minutes % 60:
+        return f'{offset_minutes} мин'
+    return f'{offset_minutes // 60} ч'
+
+
+def schedule_workout_reminders(scheduler: BaseScheduler, workout_id: int, workout_date: datetime) -> None:
+    """
+    Создание задач напоминаний для тренировки на все интервалы ReminderSettings.OFFSETS_MINUTES
+
+    Напоминания, время которых уже прошло, не создаются
+    :param scheduler:
+    :param workout_id:
+    :param workout_date:
+    """
+    now = datetime.now()
+    for offset_minutes in ReminderSettings.OFFSETS_MINUTES:
+        run_date = workout_date - timedelta(minutes=offset_minutes)
+        if run_date <= now:
+            continue
+        scheduler.add_job(remind_workout_participants,
+                          trigger='date',
+                          run_date=run_date,
+                          id=reminder_job_id(workout_id, offset_minutes),
+                          replace_existing=True,
+                          kwargs={'workout_id': workout_id, 'offset_minutes': offset_minutes})
+
+
+def reminder_job_specs(workout_id: int, workout_date: datetime, now: datetime) -> List[DateJobSpec]:
+    """Задачи напоминаний тренировки для пакетного создания в хранилище, без уже прошедших"""
+    specs = []
+    for offset_minutes in ReminderSettings.OFFSETS_MINUTES:
+        run_date = workout_date - timedelta(minutes=offset_minutes)
+        if run_date <= now:
+            continue
+        specs.append((reminder_job_id(workout_id, offset_minutes), remind_workout_participants, run_date,
+                      {'workout_id': workout_id, 'offset_minutes': offset_minutes}))
+    return specs
+
+
+def schedule_reminders_bulk(jobstore: BulkRedisJobStore, workouts: Iterable[Tuple[int, datetime]]) -> int:
+    """
+    Создание напоминаний для множества тренировок одним обращением к Redis
+
+    :param jobstore: хранилище задач планировщика
+    :param workouts: [(workout_id, date)]
+    :return: количество созданных задач
+    """
+    now = datetime.now()
+    specs = [spec for workout_id, workout_date in workouts
+             for spec in reminder_job_specs(workout_id, workout_date, now)]
+    saved = jobstore.add_date_jobs(specs)
+    jobstore.wakeup_scheduler()
+    return saved
+
+
+def remove_workout_reminders(scheduler: BaseScheduler, workout_id: int) -> None:
+    """Удаление задач напоминаний удаленной тренировки"""
+    for offset_minutes in ReminderSettings.OFFSETS_MINUTES:
+        try:
+            scheduler.remove_job(reminder_job_id(workout_id, offset_minutes))
+        except JobLookupError:
+            pass
+
+
+async def reconcile_reminder_jobs(scheduler: BaseScheduler, jobstore: BulkRedisJobStore) -> None:
+    """
+    Сверка задач напоминаний с предстоящими тренировками при запуске бота
+
+    Тренировки выбираются одним запросом, задачи хранилища - одним обращением к Redis.
+    Недостающие и перенесенные напоминания создаются, лишние удаляются пакетно
+    :param scheduler:
+    :param jobstore: хранилище, в котором лежат задачи напоминаний
+    """
+    started = perf_counter()
+    now = datetime.now()
+
+    expected: Dict[str, DateJobSpec] = {}
+    for workout, _ in await WorkoutsRequests.show_workouts():
+        for spec in reminder_job_specs(workout.workout_id, workout.date, now):
+            expected[spec[0]] = spec
+
+    existing = {job_id: run_time for job_id, run_time in jobstore.get_run_times().items()
+                if job_id.startswith('reminder_')}
+
+    stale = [job_id for job_id in existing if job_id not in expected]
+    missing = [spec for job_id, spec in expected.items()
+               if job_id not in existing
+               or abs(existing[job_id] - jobstore.to_timestamp(spec[2])) >= 1]
+
+    jobstore.remove_jobs(stale)
+    jobstore.add_date_jobs(missing)
+    scheduler.wakeup()
+
+    logger.info('Напоминания сверены за %.0f мс: создано %s, удалено %s, без изменений %s',
+                (perf_counter() - started) * 1000, len(missing), len(stale), len(expected) - len(missing))
+
+
+async def remind_workout_participants(bot: Bot, workout_id: int, offset_minutes: int):
+    """
+    Рассылка напоминания всем записавшимся на тренировку и списка участников тренерам
+
+    Участники выбираются одним запросом, сообщения отправляются параллельно
+    через очередь отправки с низким приоритетом
+    :param bot:
+    :param workout_id:
+    :param offset_minutes: за сколько минут до начала отправляется напоминание
+    """
+    participants = await RegistrationRequests.get_workout_username_and_id(workout_id)
+    users_list = "\n".join(f'{number}. {participant.name}' for number, participant in enumerate(participants, 1))
+
+    sends = [bot.send_message(chat_id=trainer_id,
+                              text=f"Через {format_offset(offset_minutes)} тренировка #{workout_id}.\n"
+                                   f"Записаны:\n{users_list}")
+             for trainer_id in MainSettings.TRAINERS]
+
+    if participants:
+        date = participants[0].date.strftime('%d.%m в %H:%M')
+        text = (f'Напоминаем: через {format_offset(offset_minutes)} тренировка '
+                f'<b>{participants[0].type_name}</b> - {date}.\n'
+                f'Если не получается прийти, отмените запись в /my_walks')
+        sends.extend(bot.send_message(chat_id=participant.user_id, text=text) for participant in participants)
+
+    with broadcast_priority():
+        results = await asyncio.gather(*sends, return_exceptions=True)
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    logger.info('Напоминание о тренировке %s: отправлено %s, ошибок %s',
+                workout_id, len(results) - len(failed), len(failed))
+    for error in failed:
+        logger.warning('Напоминание о тренировке %s не доставлено: %s', workout_id, error)
@@ -0,0 +1,160 @@
+"""
+Модуль учета свободных мест на тренировках
+
+Счетчик мест хранится в Redis и служит быстрым фильтром: когда мест нет, пользователь получает
+ответ без обращения к БД. Окончательно вместимость проверяет запрос записи в Postgres
+"""
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from redis.commands.core import AsyncScript
+
+from database.redis_engine import get_redis
+from loader import CapacitySettings
+
+# Загрузка из БД: {workout_id: (capacity или None, количество активных записей)}
+SeatsLoader = Callable[[List[int]], Awaitable[Dict[int, Tuple[Optional[int], int]]]]
+# Поля счетчиков, уже прочитанные из Redis: {workout_id: (capacity, taken)}, None - счетчика нет
+SeatsValues = Dict[int, Tuple[Optional[str], Optional[str]]]
+
+UNLIMITED = -1
+
+RESERVE_SCRIPT = """
+local capacity = redis.call('HGET', KEYS[1], 'capacity')
+if not capacity then
+    return -1
+end
+capacity = tonumber(capacity)
+if capacity < 0 then
+    return 2
+end
+if tonumber(redis.call('HGET', KEYS[1], 'taken')) >= capacity then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'taken', 1)
+return 1
+"""
+
+RELEASE_SCRIPT = """
+local taken = redis.call('HGET', KEYS[1], 'taken')
+if taken and tonumber(taken) > 0 then
+    redis.call('HINCRBY', KEYS[1], 'taken', -1)
+    return 1
+end
+return 0
+"""
+
+INIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'capacity', ARGV[1], 'taken', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class SeatCounter:
+    """
+    Счетчики занятых мест тренировок в Redis
+
+    Ключ seats:<workout_id> - хэш с полями capacity (-1 - без ограничения) и taken.
+    Отсутствующий счетчик заполняется из Postgres. Время жизни ключа ограничено ttl,
+    после чего счетчик заново сверяется с БД
+    """
+    KEY_PREFIX = 'seats:'
+    KEY = KEY_PREFIX + '{workout_id}'
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._scripts: Dict[str, AsyncScript] = {}
+
+    async def reserve(self, workout_id: int, load: SeatsLoader) -> Optional[bool]:
+        """
+        Атомарное резервирование места
+
+        :param workout_id:
+        :param load: загрузка данных о местах из БД, если счетчика еще нет
+        :return: True - место зарезервировано, False - мест нет, None - тренировка без ограничения мест
+        """
+        reserve = self._script(RESERVE_SCRIPT)
+        key = self.KEY.format(workout_id=workout_id)
+
+        result = await reserve(keys=[key])
+        if result == -1:
+            await self._init(await load([workout_id]))
+            result = await reserve(keys=[key])
+
+        if result in (-1, 2):  # тренировки нет в БД или места не ограничены - решает запрос записи
+            return None
+        return result == 1
+
+    async def release(self, workout_id: int) -> bool:
+        """
+        Освобождение места после отмены записи или неудачной попытки записи
+
+        :return: True, если количество свободных мест изменилось
+        """
+        release = self._script(RELEASE_SCRIPT)
+        return bool(await release(keys=[self.KEY.format(workout_id=workout_id)]))
+
+    async def remaining(self, workout_ids: Iterable[int], load: SeatsLoader,
+                        values: Optional[SeatsValues] = None) -> Dict[int, Optional[int]]:
+        """
+        Количество свободных мест для списка тренировок
+
+        :param workout_ids:
+        :param load: загрузка данных о местах из БД для тренировок без счетчика
+        :param values: счетчики, уже прочитанные вместе с клавиатурой (KeyboardCache) - тогда
+            Redis не запрашивается, из БД загружаются только отсутствующие
+        :return: {workout_id: свободных мест или None, если количество не ограничено}
+        """
+        workout_ids = list(workout_ids)
+        if not workout_ids:
+            return {}
+
+        if values is None:
+            pipe = get_redis().pipeline(transaction=False)
+            for workout_id in workout_ids:
+                pipe.hmget(self.KEY.format(workout_id=workout_id), 'capacity', 'taken')
+            values = dict(zip(workout_ids, await pipe.execute()))
+        else:
+            values = {workout_id: values.get(workout_id, (None, None)) for workout_id in workout_ids}
+
+        missing = [workout_id for workout_id, (capacity, _) in values.items() if capacity is None]
+        if missing:
+            loaded = await load(missing)
+            await self._init(loaded)
+            for workout_id, (capacity, taken) in loaded.items():
+                values[workout_id] = (UNLIMITED if capacity is None else capacity, taken)
+
+        remaining = {}
+        for workout_id, (capacity, taken) in values.items():
+            if capacity is None or int(capacity) < 0:
+                remaining[workout_id] = None
+            else:
+                remaining[workout_id] = max(int(capacity) - int(taken), 0)
+        return remaining
+
+    async def reset(self, workout_id: int) -> None:
+        """Сброс счетчика после изменения вместимости или удаления тренировки"""
+        await get_redis().delete(self.KEY.format(workout_id=workout_id))
+
+    async def _init(self, seats: Dict[int, Tuple[Optional[int], int]]) -> None:
+        """Заполнение отсутствующих счетчиков данными из БД"""
+        if not seats:
+            return
+        init = self._script(INIT_SCRIPT)
+        pipe = get_redis().pipeline(transaction=False)
+        for workout_id, (capacity, taken) in seats.items():
+            await init(keys=[self.KEY.format(workout_id=workout_id)],
+                       args=[UNLIMITED if capacity is None else capacity, taken, self.ttl], client=pipe)
+        await pipe.execute()
+
+    def _script(self, source: str) -> AsyncScript:
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = get_redis().register_script(source)
+        return script
+
+
+seat_counter = SeatCounter(CapacitySettings.SEATS_TTL)
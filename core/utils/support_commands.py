@@ -2,20 +2,44 @@
 Вспомогательные команды для оповещения администратора и страта бота
 """
 from aiogram import Bot
+from apscheduler_di import ContextSchedulerDecorator
 
 from loader import MainSettings
-from database.requests import StartServiceRequest
+from database.psql_engine import warm_up_pool, dispose_engine
+from database.redis_engine import close_redis
+from database.requests import StartServiceRequest, UserRequest
+from utils.delivery import outbound_queue
+from utils.jobstores import BulkRedisJobStore
+from utils.known_users import known_users
+from utils.reminders import reconcile_reminder_jobs
+from utils.attendance import schedule_stats_rebuild
+from utils.archive import schedule_archive
+from utils.templates import generate_template_workouts, schedule_template_generator
 
 
-async def start_bot_sup_handler(bot: Bot) -> None:
+async def start_bot_sup_handler(bot: Bot, scheduler: ContextSchedulerDecorator, jobstore: BulkRedisJobStore) -> None:
     """Запуск бота
 
-    Отправляет сообщение админимтратору и запускает процесс создания и проверки БД
+    Запускает очередь отправки сообщений, прогревает пул соединений с БД,
+    запускает процесс создания и проверки БД, загружает реестр известных пользователей,
+    дополняет расписание по шаблонам, восстанавливает задачи напоминаний, пересчета статистики,
+    переноса в архив и создания тренировок по шаблонам и отправляет сообщение админимтратору
     """
+    outbound_queue.start()
+    await warm_up_pool()
     await StartServiceRequest.create_and_fill_db()
+    await known_users.warm_up(UserRequest.get_user_names)
+    await generate_template_workouts(jobstore)
+    await reconcile_reminder_jobs(scheduler, jobstore)
+    schedule_stats_rebuild(scheduler)
+    schedule_archive(scheduler)
+    schedule_template_generator(scheduler)
     await bot.send_message(MainSettings.SUPERUSER, 'Бот запущен')
 
 
 async def stop_bot_sup_handler(bot: Bot) -> None:
     """Остановка бота"""
     await bot.send_message(MainSettings.SUPERUSER, 'Бот остановлен')
+    await outbound_queue.stop()
+    await dispose_engine()
+    await close_redis()
@@ -0,0 +1,43 @@
+"""
+Модуль создания тренировок по шаблонам повторяющегося расписания
+"""
+import logging
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from apscheduler.schedulers.base import BaseScheduler
+
+from database.requests import TemplateRequests
+from loader import TemplateSettings
+from utils.jobstores import BulkRedisJobStore
+from utils.reminders import schedule_reminders_bulk
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_GENERATOR_JOB_ID = 'workout_templates_generator'
+
+
+def schedule_template_generator(scheduler: BaseScheduler) -> None:
+    """Ежедневная задача создания тренировок по шаблонам в TemplateSettings.GENERATOR_HOUR часов"""
+    scheduler.add_job(generate_template_workouts,
+                      trigger='cron',
+                      hour=TemplateSettings.GENERATOR_HOUR,
+                      id=TEMPLATE_GENERATOR_JOB_ID,
+                      replace_existing=True)
+
+
+async def generate_template_workouts(jobstore: BulkRedisJobStore) -> int:
+    """
+    Заполнение расписания по всем действующим шаблонам на TemplateSettings.HORIZON_DAYS дней вперед
+
+    Повторный запуск ничего не создает, поэтому задача безопасна при перезапусках и нескольких экземплярах бота.
+    jobstore подставляется apscheduler_di
+    :return: количество созданных тренировок
+    """
+    started = perf_counter()
+    workouts = await TemplateRequests.materialize_workouts(
+        datetime.now() + timedelta(days=TemplateSettings.HORIZON_DAYS))
+    reminders = schedule_reminders_bulk(jobstore, workouts) if workouts else 0
+    logger.info('Тренировки по шаблонам созданы за %.0f мс: тренировок %s, напоминаний %s',
+                (perf_counter() - started) * 1000, len(workouts), reminders)
+    return len(workouts)
@@ -0,0 +1,41 @@
+"""
+Модуль уведомлений листа ожидания
+
+Пользователи переводятся из листа ожидания в записавшиеся в транзакции отмены записи или
+изменения количества мест (RegistrationRequests.promote_waitlist), уведомления отправляются
+после ее фиксации (after_commit)
+"""
+import asyncio
+import logging
+from typing import Sequence
+
+from aiogram import Bot
+from sqlalchemy import Row
+
+from utils.workouts_types import workout_types
+
+logger = logging.getLogger(__name__)
+
+
+async def notify_promoted(bot: Bot, promoted: Sequence[Row]) -> None:
+    """
+    Сообщения пользователям, получившим место из листа ожидания
+
+    :param bot:
+    :param promoted: [Row(registration_id, user_id, date, type_id)]
+    """
+    if not promoted:
+        return
+
+    sends = [bot.send_message(chat_id=row.user_id,
+                              text=f'Освободилось место! Вы записаны на тренировку '
+                                   f'<b>{workout_types.get(row.type_id, "")}</b> - '
+                                   f'{row.date.strftime("%d.%m в %H:%M")}.\n'
+                                   f'Если не получается прийти, отмените запись в /my_walks')
+             for row in promoted]
+    results = await asyncio.gather(*sends, return_exceptions=True)
+
+    for row, result in zip(promoted, results):
+        if isinstance(result, Exception):
+            logger.warning('Уведомление о записи из листа ожидания %s не доставлено: %s',
+                           row.registration_id, result)
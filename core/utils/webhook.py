@@ -0,0 +1,67 @@
+"""
+Модуль получения обновлений через webhook
+
+Обновления принимает aiohttp-сервер, проверяет секретный токен и передает их в Dispatcher
+"""
+import asyncio
+import logging
+from typing import Any, Dict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from loader import WebhookSettings
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook-запросов с ограничением числа одновременно обрабатываемых обновлений
+
+    Telegram получает ответ сразу, обновление обрабатывается в фоне
+    """
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_concurrency: int, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+
+async def set_webhook_handler(bot: Bot, dispatcher: Dispatcher) -> None:
+    """Регистрация адреса webhook в Telegram при запуске бота"""
+    await bot.set_webhook(url=f'{WebhookSettings.BASE_URL}{WebhookSettings.PATH}',
+                          secret_token=WebhookSettings.SECRET,
+                          allowed_updates=dispatcher.resolve_used_update_types())
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    """
+    Запуск aiohttp-сервера для приема обновлений
+
+    Хуки dp.startup и dp.shutdown вызываются при запуске и остановке сервера
+    """
+    if not WebhookSettings.BASE_URL or not WebhookSettings.SECRET:
+        raise RuntimeError('Для режима webhook необходимо задать WEBHOOK_BASE_URL и WEBHOOK_SECRET')
+
+    dp.startup.register(set_webhook_handler)
+
+    app = web.Application()
+    setup_application(app, dp, bot=bot)
+    BoundedRequestHandler(dp, bot,
+                          secret_token=WebhookSettings.SECRET,
+                          max_concurrency=WebhookSettings.MAX_CONCURRENCY).register(app, path=WebhookSettings.PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WebhookSettings.HOST, WebhookSettings.PORT)
+    await site.start()
+    logger.info('Webhook-сервер запущен на %s:%s%s', WebhookSettings.HOST, WebhookSettings.PORT, WebhookSettings.PATH)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
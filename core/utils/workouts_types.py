@@ -1,2 +1,6 @@
-"""Модуль типов втренировок"""
+"""Модуль типов втренировок, статусов записей и дней недели"""
 workout_types = {1: 'Руки 💪', 2: 'Ноги 🦶🦶', 3: 'Длительная ⌛️⌛️⌛️', 4: 'Скоростная 🏎'}
+statuses = {1: 'Записан', 2: 'Посетил', 3: 'Ожидает подтверждения', 4: 'Отменил', 5: 'Не посетил', 6: 'В листе ожидания',
+            7: 'Вышел из листа ожидания'}
+# Дни недели ISO для шаблонов тренировок
+weekdays = {'пн': 1, 'вт': 2, 'ср': 3, 'чт': 4, 'пт': 5, 'сб': 6, 'вс': 7}